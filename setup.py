@@ -31,7 +31,7 @@ requires = [
     'venusian',
     'zope.sqlalchemy',
     'decorator',
-    'pyOpenSSL',
+    'pyOpenSSL>=0.15',
 ]
 
 setup(
@@ -23,17 +23,109 @@ from BaseHTTPServer import HTTPServer
 import os
 import logging
 import logging.config
+import select
 import socket
+import threading
+import time
+import traceback
+import zlib
+import Queue
 
 import transaction
 from sqlalchemy import engine_from_config
-from OpenSSL import SSL
+from OpenSSL import SSL, crypto
+try:
+    # pyOpenSSL has no public way to tell a resumed session apart.
+    from OpenSSL._util import lib as _ssl_lib
+except ImportError:
+    _ssl_lib = None
 
 import sflvault_server.model
+import sflvault_server.views
 from sflvault_server.views import XMLRPCDispatcher
+from sflvault_server.lib.context import RequestContext
+from sflvault_server.lib import crypto_pool, keypair_pool, stats, jsonrpc
+from sflvault_server.lib.sessions import session_store_from_config, \
+    challenge_store_from_config, SessionSweeper
 
 log = logging.getLogger(__name__)
 
+# Connections accepted and responses sent by this process, kept-alive
+# connections closed because too many were idle, and bytes saved by
+# compressing responses.
+http_counters = stats.Counters('connections', 'requests', 'idle_closed',
+                               'compressed_responses', 'bytes_saved')
+stats.register('http', http_counters.stats)
+# TLS handshakes, complete or resuming a session (from the session cache or
+# a ticket). Not counted when session_reused() can't tell.
+tls_counters = stats.Counters('full_handshakes', 'resumed_handshakes')
+stats.register('tls', tls_counters.stats)
+
+
+def session_reused(connection):
+    """Whether the handshake of an SSL.Connection resumed a session, or
+    None if this pyOpenSSL doesn't let us know."""
+    try:
+        return bool(_ssl_lib.SSL_session_reused(connection._ssl))
+    except AttributeError:
+        return None
+
+
+# zlib window bits of the content codings we compress and decompress.
+CODINGS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+class RequestReader(object):
+    """Buffered reader of the requests sent on a connection (a socket or
+    an SSL.Connection), which tells whether it holds data not read yet,
+    such as a pipelined request."""
+
+    def __init__(self, connection, bufsize=8192):
+        self.connection = connection
+        self.bufsize = bufsize
+        self.buffer = ''
+
+    def buffered(self):
+        """Number of bytes received but not read yet"""
+        return len(self.buffer)
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        received = len(self.buffer)
+        while size < 0 or received < size:
+            want = self.bufsize if size < 0 else \
+                max(self.bufsize, min(size - received, 65536))
+            data = self.connection.recv(want)
+            if not data:
+                break
+            chunks.append(data)
+            received += len(data)
+        data = ''.join(chunks)
+        if size < 0:
+            size = len(data)
+        data, self.buffer = data[:size], data[size:]
+        return data
+
+    def readline(self, size=-1):
+        start = 0
+        while True:
+            end = self.buffer.find('\n', start) + 1
+            if end or 0 <= size <= len(self.buffer):
+                break
+            start = len(self.buffer)
+            data = self.connection.recv(self.bufsize)
+            if not data:
+                end = len(self.buffer)
+                break
+            self.buffer += data
+        if not end or 0 <= size < end:
+            end = size
+        data, self.buffer = self.buffer[:end], self.buffer[end:]
+        return data
+
+    def close(self):
+        self.buffer = ''
+
+
 # SSL handling based on http://code.activestate.com/recipes/496786-simple-xml-rpc-server-over-https/
 
 class SFLvaultRequestHandler(SimpleXMLRPCRequestHandler):
@@ -44,39 +136,249 @@ class SFLvaultRequestHandler(SimpleXMLRPCRequestHandler):
 
     def setup(self):
         self.connection = self.request
-        self.rfile = socket._fileobject(self.request, "rb", self.rbufsize)
+        self.rfile = RequestReader(self.request)
         self.wfile = socket._fileobject(self.request, "wb", self.wbufsize)
+        # Persistent connections (HTTP/1.1) when the server has a
+        # keepalive_timeout, one request per connection otherwise.
+        self.keepalive_timeout = getattr(self.server, 'keepalive_timeout', 0)
+        self.keepalive_max_requests = getattr(self.server, 'keepalive_max_requests', 0)
+        if self.keepalive_timeout:
+            self.protocol_version = 'HTTP/1.1'
+        self.requests = 0
+        http_counters.add('connections')
+        if isinstance(self.request, SSL.Connection):
+            # Handshake now, rather than on the first read, to count it.
+            self.request.do_handshake()
+            reused = session_reused(self.request)
+            if reused:
+                tls_counters.add('resumed_handshakes')
+            elif reused is not None:
+                tls_counters.add('full_handshakes')
+
+    def handle(self):
+        """Serve requests until the client closes the connection, leaves it
+        idle for keepalive_timeout seconds, or keepalive_max_requests were
+        served on it."""
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection and self._wait_for_request():
+            try:
+                self.handle_one_request()
+            except (socket.error, SSL.ZeroReturnError, SSL.SysCallError):
+                # The client closed the connection between two requests.
+                break
+
+    def handle_one_request(self):
+        self.requests += 1
+        SimpleXMLRPCRequestHandler.handle_one_request(self)
+
+    def _wait_for_request(self):
+        """Wait for the next request on the connection, return False if it
+        stayed idle for keepalive_timeout seconds, or if the server can't
+        have one more idle connection."""
+        # Data already read from the socket, but not yet parsed: in our read
+        # buffer, or decrypted by OpenSSL.
+        if self.rfile.buffered():
+            return True
+        if isinstance(self.request, SSL.Connection) and self.request.pending():
+            return True
+        wait_idle = getattr(self.server, 'wait_idle', None)
+        if wait_idle is not None:
+            return wait_idle(self.request, self.keepalive_timeout)
+        readable, _, _ = select.select([self.request], [], [], self.keepalive_timeout)
+        return bool(readable)
+
+    def end_headers(self):
+        if self.protocol_version == 'HTTP/1.1' and not self.close_connection:
+            if self.keepalive_max_requests and \
+                    self.requests >= self.keepalive_max_requests:
+                # Sets close_connection.
+                self.send_header('Connection', 'close')
+            else:
+                self.send_header('Keep-Alive', 'timeout=%d' % max(1, self.keepalive_timeout))
+        http_counters.add('requests')
+        SimpleXMLRPCRequestHandler.end_headers(self)
+
+    # Largest decompressed request body.
+    max_request_size = 20 * 1024 * 1024
+
+    def do_POST(self):
+        """Handle an XML-RPC call, as SimpleXMLRPCRequestHandler does, or a
+        JSON-RPC one at /jsonrpc, with gzip or deflate request and response
+        bodies."""
+        if not self.is_rpc_path_valid():
+            self.report_404()
+            return
+
+        try:
+            # Read in chunks, as SimpleXMLRPCRequestHandler does: some
+            # platforms have trouble with reads of 10 MB and more.
+            max_chunk_size = 10 * 1024 * 1024
+            size_remaining = int(self.headers["content-length"])
+            chunks = []
+            while size_remaining:
+                chunk = self.rfile.read(min(size_remaining, max_chunk_size))
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                size_remaining -= len(chunk)
+            data = self.decode_request_content(''.join(chunks))
+            if data is None:
+                return  # response has been sent
+            if self.path == '/jsonrpc':
+                content_type = "application/json"
+                response = jsonrpc.marshaled_dispatch(data, self._dispatch,
+                                                      self.server.instance.registry)
+            else:
+                content_type = "text/xml"
+                response = self.server._marshaled_dispatch(data, self._dispatch, self.path)
+        except Exception, e:  # This should only happen if the module is buggy
+            self.send_response(500)
+            if getattr(self.server, '_send_traceback_header', False):
+                self.send_header("X-exception", str(e))
+                self.send_header("X-traceback", traceback.format_exc())
+            self.send_header("Content-length", "0")
+            self.end_headers()
+        else:
+            if response is None:
+                # Only JSON-RPC notifications.
+                self.send_response(204)
+                self.send_header("Content-length", "0")
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-type", content_type)
+            response = self.encode_response_content(response)
+            self.send_header("Content-length", str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+    def encode_response_content(self, response):
+        """Compress responses larger than the server's compress_threshold
+        with the coding the client prefers, sending its Content-Encoding."""
+        threshold = getattr(self.server, 'compress_threshold', self.encode_threshold)
+        if threshold is None or len(response) <= threshold:
+            return response
+        accepted = self.accept_encodings()
+        codings = [c for c in ('gzip', 'deflate') if accepted.get(c, 0) > 0]
+        if not codings:
+            return response
+        coding = max(codings, key=lambda c: accepted[c])
+        compressor = zlib.compressobj(getattr(self.server, 'compress_level', 6),
+                                      zlib.DEFLATED, CODINGS[coding])
+        body = compressor.compress(response) + compressor.flush()
+        if len(body) >= len(response):
+            return response
+        self.send_header("Content-Encoding", coding)
+        http_counters.add('compressed_responses')
+        http_counters.add('bytes_saved', len(response) - len(body))
+        return body
+
+    def decode_request_content(self, data):
+        encoding = self.headers.get("content-encoding", "identity").lower()
+        if encoding not in CODINGS:
+            return SimpleXMLRPCRequestHandler.decode_request_content(self, data)
+        decompressor = zlib.decompressobj(CODINGS[encoding])
+        try:
+            data = decompressor.decompress(data, self.max_request_size)
+        except zlib.error:
+            self.send_response(400, "error decoding %s content" % encoding)
+        else:
+            if not decompressor.unconsumed_tail:
+                return data
+            self.send_response(413, "decoded content too large")
+        self.send_header("Content-length", "0")
+        self.end_headers()
 
     def _dispatch(self, method, params):
         address = self.client_address
 
-        request = {
-            'REMOTE_ADDR': address[0],
-            'PORT': address[1],
-            'rpc_args': params,
-            'settings': SFLvaultServer.settings,
-        }
+        request = RequestContext(
+            remote_addr=address[0],
+            port=address[1],
+            rpc_args=params,
+            settings=SFLvaultServer.settings,
+        )
 
-        return self.server.instance._dispatch(request, method, params)
+        try:
+            return self.server.instance._dispatch(request, method, params)
+        finally:
+            # Each request gets its own SQLAlchemy session: whatever was left
+            # uncommitted is rolled back, and the thread-local session is
+            # discarded so that no ORM state leaks into the next request.
+            transaction.abort()
+            sflvault_server.model.meta.Session.remove()
 
-    rpc_paths = ('/vault', '/vault/rpc', '/',)
+    rpc_paths = ('/vault', '/vault/rpc', '/', '/jsonrpc',)
 
 class SecureXMLRPCServer(HTTPServer, SimpleXMLRPCDispatcher):
-    def __init__(self, server_address, requestHandler, keyfile, certfile, logRequests=True, allow_none=False):
+    def __init__(self, server_address, requestHandler, keyfile, certfile, logRequests=True, allow_none=False,
+                 bind_and_activate=True, ciphers=None, ecdh_curve=None, session_timeout=300,
+                 session_tickets=True, ticket_key_lifetime=3600):
         """Secure XML-RPC server.
 
         It it very similar to SimpleXMLRPCServer but it uses HTTPS for transporting XML data.
+
+        ciphers - OpenSSL cipher list, for TLS up to 1.2. None for OpenSSL's.
+        ecdh_curve - name of the only curve used for ECDHE. None lets OpenSSL
+                     pick one the client supports.
+        session_timeout - seconds a client may resume its TLS session, from
+                          the session cache or a ticket. 0 disables resumption.
+        session_tickets - False to resume sessions from the cache only.
+        ticket_key_lifetime - seconds before the keys encrypting tickets are
+                              replaced, along with the session cache. 0 to
+                              keep them as long as the server runs.
         """
         self.logRequests = logRequests
 
         SimpleXMLRPCDispatcher.__init__(self, allow_none=allow_none)
         SocketServer.BaseServer.__init__(self, server_address, requestHandler)
+        self.keyfile = keyfile
+        self.certfile = certfile
+        self.ciphers = ciphers
+        self.ecdh_curve = ecdh_curve
+        self.session_timeout = session_timeout
+        self.session_tickets = session_tickets
+        self.ticket_key_lifetime = ticket_key_lifetime
+        self.context = self.create_context()
+        self.context_created = time.time()
+        self.socket = SSL.Connection(self.context, socket.socket(self.address_family, self.socket_type))
+        if bind_and_activate:
+            self.server_bind()
+            self.server_activate()
+
+    def create_context(self):
+        """Return a new SSL context, with its own session cache and ticket keys."""
         ctx = SSL.Context(SSL.SSLv23_METHOD)
-        ctx.use_privatekey_file(keyfile)
-        ctx.use_certificate_file(certfile)
-        self.socket = SSL.Connection(ctx, socket.socket(self.address_family, self.socket_type))
-        self.server_bind()
-        self.server_activate()
+        ctx.set_options(SSL.OP_NO_SSLv2 | SSL.OP_NO_SSLv3 | SSL.OP_NO_COMPRESSION |
+                        SSL.OP_CIPHER_SERVER_PREFERENCE | SSL.OP_SINGLE_ECDH_USE)
+        if self.ciphers:
+            ctx.set_cipher_list(self.ciphers)
+        if self.ecdh_curve:
+            ctx.set_tmp_ecdh(crypto.get_elliptic_curve(self.ecdh_curve))
+        if self.session_timeout:
+            ctx.set_session_cache_mode(SSL.SESS_CACHE_SERVER)
+            # Sessions are only resumed within the same session id context.
+            ctx.set_session_id('sflvault')
+            ctx.set_timeout(self.session_timeout)
+        else:
+            ctx.set_session_cache_mode(SSL.SESS_CACHE_OFF)
+        if not (self.session_timeout and self.session_tickets):
+            ctx.set_options(SSL.OP_NO_TICKET)
+        ctx.use_privatekey_file(self.keyfile)
+        ctx.use_certificate_file(self.certfile)
+        return ctx
+
+    def get_request(self):
+        # OpenSSL can't replace the keys of a context's tickets, so the
+        # connections accepted from now on get a new context. Their clients
+        # resume sessions from the new one only.
+        if self.ticket_key_lifetime and \
+                time.time() - self.context_created > self.ticket_key_lifetime:
+            self.context = self.create_context()
+            self.context_created = time.time()
+            self.socket.set_context(self.context)
+        return HTTPServer.get_request(self)
 
     def shutdown_request(self, request):
         # Our SSL connection doesn't take an argument on shutdown so we have to override the method
@@ -89,23 +391,173 @@ class SecureXMLRPCServer(HTTPServer, SimpleXMLRPCDispatcher):
             pass # some platforms may raise ENOTCONN here
         self.close_request(request)
 
+class ThreadPoolMixIn:
+    """Mix-in class to serve requests from a bounded pool of worker threads.
+
+    Accepted connections are put on a queue holding at most ``queue_size``
+    entries, from which ``workers`` long-lived threads pick them up. When the
+    queue is full, the accept loop blocks until a worker frees up, and new
+    connections wait in the listen backlog.
+
+    A kept-alive connection holds its worker while it waits for the next
+    request: at most ``max_idle`` (half the workers by default) wait at
+    once, the others are closed, so that idle clients can't take every
+    worker.
+    """
+    workers = 8
+    queue_size = 32
+    max_idle = None
+    daemon_threads = True
+
+    def start_workers(self):
+        self.request_queue = Queue.Queue(self.queue_size)
+        if self.max_idle is None:
+            self.max_idle = self.workers // 2
+        self.idle_connections = 0
+        self.idle_lock = threading.Lock()
+        for i in range(self.workers):
+            t = threading.Thread(target=self.process_request_worker,
+                                 name='sflvault-worker-%d' % i)
+            t.setDaemon(self.daemon_threads)
+            t.start()
+
+    def process_request_worker(self):
+        while True:
+            request, client_address = self.request_queue.get()
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                self.request_queue.task_done()
+
+    def process_request(self, request, client_address):
+        self.request_queue.put((request, client_address))
+
+    def wait_idle(self, connection, timeout):
+        """Wait up to `timeout` seconds for the next request on a kept-alive
+        connection. Return False if none came, or if max_idle connections
+        are waiting already."""
+        with self.idle_lock:
+            if self.idle_connections >= self.max_idle:
+                http_counters.add('idle_closed')
+                return False
+            self.idle_connections += 1
+        try:
+            # select() rather than a socket timeout, which pyOpenSSL doesn't
+            # support on blocking connections.
+            readable, _, _ = select.select([connection], [], [], timeout)
+        finally:
+            with self.idle_lock:
+                self.idle_connections -= 1
+        return bool(readable)
+
+    def serve_forever(self, poll_interval=0.5):
+        self.start_workers()
+        SocketServer.BaseServer.serve_forever(self, poll_interval)
+
+    def drain(self):
+        """Wait until every accepted request has been served."""
+        self.request_queue.join()
+
+class ThreadedXMLRPCServer(ThreadPoolMixIn, SimpleXMLRPCServer):
+    pass
+
+class ThreadedSecureXMLRPCServer(ThreadPoolMixIn, SecureXMLRPCServer):
+    pass
+
 class SFLvaultServer(object):
 
-    def __init__(self, config_file_name):
+    def __init__(self, config_file_name, processes=1, listen=True):
+        """processes - number of worker processes that will serve requests,
+                      which need to share their sessions when more than one.
+        listen - False to only set up the database, for maintenance
+                 commands.
+        """
         self.server = None
+        self.processes = processes
         SFLvaultServer.settings = self.get_settings(config_file_name)
 
         self.start_sqlalchemy()
         self.initialize_models()
+        if not listen:
+            return
         self.create_admin_if_necessary()
+        self.initialize_access()
+        self.initialize_search()
+        self.initialize_sessions()
         self.initialize_server()
 
     def get_settings(self, config_file_name=None):
         result = {
             'sflvault.vault.session_timeout': '15',
             'sflvault.vault.setup_timeout': '300',
+            # 'memory' sessions are private to a process, 'sqlite' ones are
+            # shared by all the processes using the same session_file.
+            'sflvault.vault.session_backend': 'sqlite' if self.processes > 1 else 'memory',
+            'sflvault.vault.session_file': '%s/sflvault-sessions.db' % os.getcwd(),
+            # Login challenges must be seen by the process serving
+            # sflvault.authenticate, which may not be the one that served
+            # sflvault.login.
+            'sflvault.vault.challenge_backend': 'sqlite' if self.processes > 1 else 'memory',
+            'sflvault.vault.session_sweep_interval': '60',
+            'sflvault.vault.max_sessions': '10000',
+            'sflvault.vault.max_sessions_per_user': '20',
+            # Parsed user and group public keys kept by each process.
+            'sflvault.vault.pubkey_cache_size': '1024',
+            # Users whose accessible services are cached, for access checks.
+            # Only with a single process, as invalidations aren't shared.
+            'sflvault.vault.acl_cache_size': '0',
+            # Maintain user_service_access, and use it for access checks.
+            'sflvault.vault.access_table': 'false',
+            # Maintain search_documents, and search through its full-text
+            # index (SQLite FTS5 or PostgreSQL).
+            'sflvault.vault.search_index': 'false',
+            # Most results in a page of search results, 0 for no limit.
+            'sflvault.vault.search_max_results': '1000',
+            # Number of pages of search results cached, 0 to disable.
+            # Forced to 0 with more than one worker process.
+            'sflvault.vault.search_cache_size': '0',
+            # Processes encrypting secrets for many groups or users at once,
+            # in each worker process. 0 encrypts in the request's thread.
+            'sflvault.crypto_workers': '0',
+            # Group keypairs each worker process keeps ready for group_add.
+            # 0 generates them in the request's thread.
+            'sflvault.keypair_pool_size': '0',
             'sflvault.host': 'localhost',
             'sflvault.port': '5000',
+            # 'single' serves one request at a time, 'threaded' uses a pool
+            # of sflvault.workers threads.
+            'sflvault.server_mode': 'single',
+            'sflvault.workers': '8',
+            'sflvault.queue_size': '32',
+            'sflvault.backlog': '5',
+            # Seconds an idle HTTP/1.1 connection is kept open for the
+            # client's next request, 0 closes it after each request. At
+            # most keepalive_max_requests are served on one connection (0
+            # for no limit). Only in 'threaded' mode. Idle connections
+            # hold a worker thread: at most keepalive_max_idle (less than
+            # sflvault.workers, half of them if empty) wait at once.
+            'sflvault.keepalive_timeout': '0',
+            'sflvault.keepalive_max_requests': '100',
+            'sflvault.keepalive_max_idle': '',
+            # Responses larger than compress_threshold bytes are compressed
+            # (gzip or deflate) for clients accepting it, at compress_level.
+            'sflvault.compress_responses': 'true',
+            'sflvault.compress_threshold': '1400',
+            'sflvault.compress_level': '6',
+            # TLS: OpenSSL cipher list and ECDHE curve, empty for OpenSSL's
+            # defaults. OpenSSL 1.0 enables no curve by default, leaving no
+            # usable cipher in this ECDHE-only list without one.
+            'sflvault.ssl_ciphers': 'ECDHE+AESGCM:ECDHE+CHACHA20:ECDHE+AES:!aNULL:!MD5:!RC4:!3DES',
+            'sflvault.ssl_ecdh_curve': 'prime256v1',
+            # Seconds a TLS session can be resumed, 0 to disable resumption.
+            'sflvault.ssl_session_timeout': '300',
+            'sflvault.ssl_session_tickets': 'true',
+            # Seconds before ticket keys (and the session cache) are
+            # replaced, 0 to never replace them.
+            'sflvault.ssl_ticket_key_lifetime': '3600',
             'sqlalchemy.url': 'sqlite:///%s/sflvault.db' % os.getcwd()
         }
         if config_file_name:
@@ -119,7 +571,39 @@ class SFLvaultServer(object):
 
     def initialize_models(self):
         sflvault_server.model.init_model(self.engine)
+        sflvault_server.model.pubkey_cache.maxsize = \
+            int(SFLvaultServer.settings['sflvault.vault.pubkey_cache_size'])
+        acl_cache_size = int(SFLvaultServer.settings['sflvault.vault.acl_cache_size'])
+        if acl_cache_size and self.processes > 1:
+            log.warning("sflvault.vault.acl_cache_size ignored: the ACL cache "
+                        "can't be used with more than one worker process.")
+            acl_cache_size = 0
+        sflvault_server.model.acl_cache.maxsize = acl_cache_size
+        sflvault_server.model.access_table_enabled = \
+            SFLvaultServer.settings['sflvault.vault.access_table'].lower() in ['1', 'true', 't']
+        search_index = \
+            SFLvaultServer.settings['sflvault.vault.search_index'].lower() in ['1', 'true', 't']
+        if search_index and self.engine.dialect.name not in ['sqlite', 'postgresql']:
+            log.warning("sflvault.vault.search_index needs SQLite or PostgreSQL, "
+                        "searching without the full-text index.")
+            search_index = False
+        if search_index and self.engine.dialect.name == 'sqlite' \
+                and not sflvault_server.model.sqlite_fts5:
+            log.warning("sflvault.vault.search_index needs SQLite with FTS5, "
+                        "searching without the full-text index.")
+            search_index = False
+        sflvault_server.model.search_index_enabled = search_index
+        sflvault_server.model.search_max_results = \
+            int(SFLvaultServer.settings['sflvault.vault.search_max_results'])
+        search_cache_size = int(SFLvaultServer.settings['sflvault.vault.search_cache_size'])
+        if search_cache_size and self.processes > 1:
+            log.warning("sflvault.vault.search_cache_size ignored: the search "
+                        "cache can't be used with more than one worker process.")
+            search_cache_size = 0
+        sflvault_server.model.search_cache.maxsize = search_cache_size
         sflvault_server.model.meta.metadata.create_all(self.engine)
+        sflvault_server.model.create_missing_indexes(self.engine)
+        sflvault_server.model.create_missing_search_index(self.engine)
 
     def create_admin_if_necessary(self):
         if not sflvault_server.model.query(sflvault_server.model.User).filter_by(username='admin').first():
@@ -134,6 +618,25 @@ class SFLvaultServer(object):
             sflvault_server.model.meta.Session.add(u)
             transaction.commit()
 
+    def initialize_access(self):
+        # The table isn't maintained while disabled, so it may be stale.
+        if sflvault_server.model.access_table_enabled:
+            log.info("Rebuilding the user_service_access table")
+            sflvault_server.model.rebuild_access()
+            transaction.commit()
+
+    def initialize_search(self):
+        # The index isn't maintained while disabled, so it may be stale.
+        if sflvault_server.model.search_index_enabled:
+            log.info("Rebuilding the search index")
+            sflvault_server.model.rebuild_search()
+            transaction.commit()
+
+    def initialize_sessions(self):
+        sflvault_server.views.session_store = \
+            session_store_from_config(SFLvaultServer.settings, self.engine)
+        sflvault_server.views.challenge_store = challenge_store_from_config(SFLvaultServer.settings)
+
     def initialize_server(self):
         dispatcher = self._create_request_dispatcher()
         host = SFLvaultServer.settings['sflvault.host']
@@ -141,24 +644,67 @@ class SFLvaultServer(object):
         address = (host, port)
         keyfile = SFLvaultServer.settings.get('sflvault.keyfile')
         certfile = SFLvaultServer.settings.get('sflvault.certfile')
+        server_mode = SFLvaultServer.settings['sflvault.server_mode']
+        if server_mode not in ('single', 'threaded'):
+            raise ValueError("Invalid sflvault.server_mode: %s" % server_mode)
+        threaded = server_mode == 'threaded'
         if keyfile and certfile:
             log.info("Starting in SSL mode")
-            self.server = SecureXMLRPCServer(
+            server_class = ThreadedSecureXMLRPCServer if threaded else SecureXMLRPCServer
+            self.server = server_class(
                 address,
                 requestHandler=SFLvaultRequestHandler,
                 keyfile=keyfile,
                 certfile=certfile,
                 logRequests=False,
                 allow_none=True,
+                bind_and_activate=False,
+                ciphers=SFLvaultServer.settings['sflvault.ssl_ciphers'] or None,
+                ecdh_curve=SFLvaultServer.settings['sflvault.ssl_ecdh_curve'] or None,
+                session_timeout=int(SFLvaultServer.settings['sflvault.ssl_session_timeout']),
+                session_tickets=SFLvaultServer.settings[
+                    'sflvault.ssl_session_tickets'].lower() in ['1', 'true', 't'],
+                ticket_key_lifetime=int(SFLvaultServer.settings['sflvault.ssl_ticket_key_lifetime']),
             )
         else:
             log.info("Starting in insecure mode")
-            self.server = SimpleXMLRPCServer(
+            server_class = ThreadedXMLRPCServer if threaded else SimpleXMLRPCServer
+            self.server = server_class(
                 address,
                 requestHandler=SFLvaultRequestHandler,
                 logRequests=False,
                 allow_none=True,
+                bind_and_activate=False,
             )
+        if threaded:
+            self.server.workers = int(SFLvaultServer.settings['sflvault.workers'])
+            self.server.queue_size = int(SFLvaultServer.settings['sflvault.queue_size'])
+            max_idle = SFLvaultServer.settings['sflvault.keepalive_max_idle']
+            if max_idle:
+                self.server.max_idle = int(max_idle)
+                if self.server.max_idle >= self.server.workers:
+                    log.warning("sflvault.keepalive_max_idle must be less than "
+                                "sflvault.workers, using %d.", self.server.workers - 1)
+                    self.server.max_idle = self.server.workers - 1
+            log.info("Serving requests with %d worker threads", self.server.workers)
+        self.server.request_queue_size = int(SFLvaultServer.settings['sflvault.backlog'])
+        self.server.keepalive_timeout = float(SFLvaultServer.settings['sflvault.keepalive_timeout'])
+        self.server.keepalive_max_requests = \
+            int(SFLvaultServer.settings['sflvault.keepalive_max_requests'])
+        if SFLvaultServer.settings['sflvault.compress_responses'].lower() in ['1', 'true', 't']:
+            self.server.compress_threshold = int(SFLvaultServer.settings['sflvault.compress_threshold'])
+        else:
+            self.server.compress_threshold = None
+        self.server.compress_level = int(SFLvaultServer.settings['sflvault.compress_level'])
+        if not 0 <= self.server.compress_level <= 9:
+            raise ValueError("Invalid sflvault.compress_level: %d (0-9)" %
+                             self.server.compress_level)
+        if self.server.keepalive_timeout and not threaded:
+            log.warning("sflvault.keepalive_timeout ignored: with sflvault.server_mode = "
+                        "single, other clients would wait while a connection is idle.")
+            self.server.keepalive_timeout = 0
+        self.server.server_bind()
+        self.server.server_activate()
         self.server.register_introspection_functions()
         self.server.register_instance(dispatcher)
 
@@ -168,7 +714,27 @@ class SFLvaultServer(object):
         return dispatcher
 
     def start_server(self):
+        # Started here rather than in __init__, so that every pre-forked
+        # worker gets its own.
+        # Forked before any request thread exists.
+        crypto_pool.executor.processes = int(SFLvaultServer.settings['sflvault.crypto_workers'])
+        crypto_pool.executor.start()
+        keypair_pool.pool.size = int(SFLvaultServer.settings['sflvault.keypair_pool_size'])
+        keypair_pool.pool.start()
+        sweep_interval = int(SFLvaultServer.settings['sflvault.vault.session_sweep_interval'])
+        if sweep_interval > 0:
+            SessionSweeper(sflvault_server.views.session_store, sweep_interval).start()
+            SessionSweeper(sflvault_server.views.challenge_store, sweep_interval).start()
+        else:
+            log.warning("sflvault.vault.session_sweep_interval is %d: expired sessions "
+                        "won't be swept.", sweep_interval)
         self.server.serve_forever()
+        # Once shut down, let the worker threads finish the requests that
+        # were already accepted.
+        if hasattr(self.server, 'drain'):
+            self.server.drain()
+        crypto_pool.executor.shutdown()
+        keypair_pool.pool.shutdown()
 
     def get_dict_for_config_section(self, config, section):
         my_dict = {}
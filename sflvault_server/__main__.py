@@ -18,17 +18,66 @@
 import argparse
 import logging
 import logging.config
+import sys
 
-from . import SFLvaultServer
+import transaction
+
+from . import SFLvaultServer, model
+from .prefork import PreforkSupervisor
+
+log = logging.getLogger(__name__)
+
+def maintain(args):
+    """Rebuild or check user_service_access, or rebuild search_documents.
+    Return the exit status."""
+    SFLvaultServer(args.config_file, listen=False)
+    if args.rebuild_search:
+        model.rebuild_search()
+        transaction.commit()
+        print "search_documents rebuilt."
+    if args.rebuild_access:
+        model.rebuild_access()
+        transaction.commit()
+        print "user_service_access rebuilt."
+    if args.check_access:
+        missing, extra = model.check_access()
+        for row in missing:
+            print "Missing: user %s, service %s, group %s" % row[:3]
+        for row in extra:
+            print "Extra: user %s, service %s, group %s" % row[:3]
+        if missing or extra:
+            print "user_service_access is out of date: %d rows missing, " \
+                  "%d extra." % (len(missing), len(extra))
+            return 1
+        print "user_service_access is up to date."
+    return 0
 
 def main():
     parser = argparse.ArgumentParser(description="Launch the SFLVault server")
     parser.add_argument('config_file', nargs='?', default=None, help="INI config file")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of pre-forked worker processes (default: 1, no forking)")
+    parser.add_argument('--rebuild-access', action='store_true',
+                        help="Rebuild the user_service_access table, and exit")
+    parser.add_argument('--check-access', action='store_true',
+                        help="Check the user_service_access table is up to date, and exit")
+    parser.add_argument('--rebuild-search', action='store_true',
+                        help="Rebuild the search index, and exit")
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
     if args.config_file:
-        logging.config.fileConfig(args.config_file)
-    server = SFLvaultServer(args.config_file)
-    server.start_server()
+        logging.config.fileConfig(args.config_file, disable_existing_loggers=False)
+    if args.rebuild_access or args.check_access or args.rebuild_search:
+        sys.exit(maintain(args))
+    server = SFLvaultServer(args.config_file, processes=args.workers)
+    if args.workers > 1:
+        if server.settings['sflvault.vault.session_backend'] == 'memory':
+            log.warning("Authentication sessions are kept in each worker process: "
+                        "clients may have to log in again when served by another worker.")
+        PreforkSupervisor(server, args.workers).run()
+    else:
+        server.start_server()
 
 if __name__ == '__main__':
     main()
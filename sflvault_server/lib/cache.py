@@ -0,0 +1,98 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""In-process caches, private to each worker process."""
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Thread-safe mapping keeping at most `maxsize` entries, evicting the
+    least recently used one first. A maxsize of 0 disables the cache.
+
+    `generation` changes whenever entries are invalidated. A value computed
+    while it changed may be stale: pass the generation read before
+    computing it to set(), which then drops it.
+
+    With `sizeof`, a function returning the approximate size of a value in
+    bytes, stats() also reports the total size of the entries.
+    """
+
+    def __init__(self, maxsize, sizeof=None):
+        self.maxsize = maxsize
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.entries.pop(key, self)
+            if value is self:
+                self.misses += 1
+                return default
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value, generation=None):
+        if not self.maxsize:
+            return
+        size = self.sizeof(value) if self.sizeof else 0
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._pop(key)
+            self.entries[key] = value
+            self.sizes[key] = size
+            self.bytes += size
+            while len(self.entries) > self.maxsize:
+                self._pop(next(iter(self.entries)))
+
+    def _pop(self, key):
+        self.entries.pop(key, None)
+        self.bytes -= self.sizes.pop(key, 0)
+
+    def discard(self, key):
+        with self.lock:
+            self.generation += 1
+            self._pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.sizes.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        stats = {'size': len(self.entries),
+                 'hits': self.hits,
+                 'misses': self.misses}
+        if self.sizeof:
+            stats['bytes'] = self.bytes
+        return stats
@@ -0,0 +1,63 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Per-request state passed from the request handler down to the Vault."""
+
+from .. import model
+
+
+class RequestContext(dict):
+    """State of a single request made to the vault.
+
+    It is the ``request`` dictionary handed to every view (REMOTE_ADDR,
+    PORT, rpc_args and settings), and also carries the identity of the
+    caller once its session has been validated.  A new one is built for
+    each request, so concurrent requests never see each other's user.
+    """
+
+    def __init__(self, remote_addr=None, port=None, rpc_args=(),
+                 settings=None):
+        dict.__init__(self, {
+            'REMOTE_ADDR': remote_addr,
+            'PORT': port,
+            'rpc_args': rpc_args,
+            'settings': settings if settings is not None else {},
+        })
+        self.user_id = None
+        self.username = None
+        self.is_admin = False
+        self._user = None
+
+    @property
+    def settings(self):
+        return self['settings']
+
+    @property
+    def user(self):
+        """The authenticated User, loaded on first access."""
+        if self._user is None and self.user_id is not None:
+            self._user = model.query(model.User).get(self.user_id)
+        return self._user
+
+    def set_user(self, user_id, username, is_admin=False):
+        """Record the caller's identity, as found in its session."""
+        self.user_id = user_id
+        self.username = username
+        self.is_admin = is_admin
+        self._user = None
@@ -0,0 +1,105 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Process pool encrypting a message for many ElGamal public keys at once.
+
+Encrypting a service's symmetric key for each of its groups (or a group's
+private key for each admin) is one big-integer exponentiation per
+recipient. With more than one recipient, the executor spreads them over
+a pool of processes, so they use every core instead of one thread.
+
+The pool is started by SFLvaultServer.start_server(), in every worker
+process, before any request thread exists. Without processes, or when
+called from another process than the one that started the pool,
+encryption happens inline.
+"""
+
+import multiprocessing
+import os
+import signal
+import threading
+
+from Crypto import Random
+from sflvault.common.crypto import encrypt_longmsg
+
+from sflvault_server.model import cached_elgamal
+
+
+def _init_worker():
+    # Never share the random pool with the parent process. ^C is for the
+    # parent: it stops the pool itself.
+    Random.atfork()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _encrypt(args):
+    kind, id, pubkey, message = args
+    return encrypt_longmsg(cached_elgamal(kind, id, pubkey), message)
+
+
+class CryptoExecutor(object):
+    """Encrypts for many recipients, in `processes` processes (0 to
+    encrypt inline)."""
+
+    def __init__(self, processes=0):
+        self.processes = processes
+        self.pool = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.encryptions = 0
+
+    def start(self):
+        """Start the pool of the current process."""
+        if self.processes and self.pid != os.getpid():
+            self.pool = multiprocessing.Pool(self.processes,
+                                             initializer=_init_worker)
+            self.pid = os.getpid()
+
+    def shutdown(self):
+        """Let the pool finish the pending encryptions, then stop it."""
+        if self.pool is not None and self.pid == os.getpid():
+            self.pool.close()
+            self.pool.join()
+        self.pool = None
+        self.pid = None
+
+    def encrypt_for(self, recipients, message):
+        """Return `message` encrypted (as with encrypt_longmsg) for each of
+        `recipients`, in order. Recipients are Users or Groups."""
+        jobs = [(r.__class__.__name__, r.id, r.pubkey, message)
+                for r in recipients]
+        pool = self.pool if self.pid == os.getpid() else None
+        with self.lock:
+            self.encryptions += len(jobs)
+            if len(jobs) > 1 and pool is not None:
+                self.batches += 1
+        if len(jobs) > 1 and pool is not None:
+            return pool.map(_encrypt, jobs)
+        return [_encrypt(job) for job in jobs]
+
+    def stats(self):
+        return {'processes': self.processes if self.pool else 0,
+                'batches': self.batches,
+                'encryptions': self.encryptions}
+
+
+# SFLvaultServer sets the number of processes from sflvault.crypto_workers.
+executor = CryptoExecutor()
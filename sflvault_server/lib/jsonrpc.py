@@ -0,0 +1,127 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""JSON-RPC 2.0 (http://www.jsonrpc.org/specification), served at /jsonrpc
+alongside XML-RPC, for the methods of XMLRPCDispatcher.
+
+Parameters are passed by position, as with XML-RPC. Datetimes, including
+xmlrpclib.DateTime, are sent as ISO 8601 strings, xmlrpclib.Binary as
+base64 strings.
+"""
+
+import inspect
+import json
+import sys
+import xmlrpclib
+from base64 import b64encode
+from datetime import date, datetime
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+
+
+class JSONRPCEncoder(json.JSONEncoder):
+
+    def default(self, o):
+        if isinstance(o, (datetime, date)):
+            return o.isoformat()
+        if isinstance(o, xmlrpclib.DateTime):
+            # From its '20140508T10:30:15'.
+            v = o.value
+            return '%s-%s-%sT%s' % (v[:4], v[4:6], v[6:8], v[9:])
+        if isinstance(o, xmlrpclib.Binary):
+            return b64encode(o.data)
+        return json.JSONEncoder.default(self, o)
+
+
+def dumps(obj):
+    return json.dumps(obj, cls=JSONRPCEncoder, separators=(',', ':'))
+
+
+def error(id, code, message):
+    return dumps({'jsonrpc': '2.0', 'error': {'code': code, 'message': message},
+                  'id': id})
+
+
+def takes(func, count):
+    """Whether `func`, a method of XMLRPCDispatcher, takes `count` params
+    after the request. True when it can't be told."""
+    try:
+        args, varargs, _, defaults = inspect.getargspec(func)
+    except TypeError:
+        return True
+    most = len(args) - 1
+    least = most - len(defaults or ())
+    return least <= count and (count <= most or varargs is not None)
+
+
+def call(request, dispatch, methods):
+    """Return the encoded response to a request object, None for a
+    notification."""
+    if not isinstance(request, dict) or request.get('jsonrpc') != '2.0' or \
+            not isinstance(request.get('method'), basestring) or \
+            isinstance(request.get('id'), bool) or \
+            not isinstance(request.get('id'), (basestring, int, long, float, type(None))):
+        return error(None, INVALID_REQUEST, 'Invalid Request')
+    id = request.get('id')
+    params = request.get('params', [])
+    if not isinstance(params, list):
+        response = error(id, INVALID_PARAMS, 'Invalid params: pass them by position')
+    elif request['method'] not in methods:
+        response = error(id, METHOD_NOT_FOUND, 'Method not found')
+    elif isinstance(methods, dict) and not takes(methods[request['method']], len(params)):
+        response = error(id, INVALID_PARAMS, 'Invalid params: wrong number of params')
+    else:
+        try:
+            response = dumps({'jsonrpc': '2.0', 'id': id,
+                              'result': dispatch(request['method'], tuple(params))})
+        except xmlrpclib.Fault, fault:
+            response = error(id, fault.faultCode, fault.faultString)
+        except:
+            # As SimpleXMLRPCDispatcher reports them.
+            exc_type, exc_value = sys.exc_info()[:2]
+            response = error(id, INTERNAL_ERROR, '%s:%s' % (exc_type, exc_value))
+    if 'id' in request:
+        return response
+
+
+def marshaled_dispatch(data, dispatch, methods):
+    """Return the response to the JSON-RPC request, or batch of requests,
+    in `data`, calling dispatch(method, params) for the names in `methods`.
+    None when there's nothing to answer (notifications only).
+
+    When `methods` maps names to the functions dispatch() calls, with the
+    request then the params, calls with too many or too few params are
+    answered with INVALID_PARAMS.
+    """
+    try:
+        request = json.loads(data)
+    except ValueError:
+        return error(None, PARSE_ERROR, 'Parse error')
+    if not isinstance(request, list):
+        return call(request, dispatch, methods)
+    if not request:
+        return error(None, INVALID_REQUEST, 'Invalid Request')
+    responses = [response for response in (call(r, dispatch, methods) for r in request)
+                 if response is not None]
+    if responses:
+        return '[%s]' % ','.join(responses)
@@ -0,0 +1,130 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Group keypairs generated ahead of time, off the request path.
+
+Generating an ElGamal keypair means finding large primes, which takes
+seconds. A KeypairPool keeps `size` keypairs ready, generated by a
+separate process and refilled by a background thread as group_add takes
+them. Keypairs are only held in memory, and each is handed out once.
+When the pool is empty (or disabled), keypairs are generated inline.
+"""
+
+import collections
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+
+from Crypto import Random
+from sflvault.common.crypto import generate_elgamal_keypair, \
+    serial_elgamal_pubkey, serial_elgamal_privkey, elgamal_pubkey, \
+    elgamal_bothkeys
+
+log = logging.getLogger(__name__)
+
+
+def _init_worker():
+    Random.atfork()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def generate_keypair():
+    """Return a new keypair, as (serialized pubkey, serialized keys)"""
+    keys = generate_elgamal_keypair()
+    return (serial_elgamal_pubkey(elgamal_pubkey(keys)),
+            serial_elgamal_privkey(elgamal_bothkeys(keys)))
+
+
+class KeypairPool(object):
+
+    # Seconds to wait before generating again after a failure.
+    retry_delay = 5
+
+    def __init__(self, size=0):
+        self.size = size
+        self.keypairs = collections.deque()
+        self.cond = threading.Condition()
+        self.process = None
+        self.stopping = False
+        self.taken = 0
+        self.generated_inline = 0
+
+    def start(self):
+        """Start the generating process and the thread refilling the pool."""
+        if not self.size:
+            return
+        self.stopping = False
+        self.process = multiprocessing.Pool(1, initializer=_init_worker)
+        t = threading.Thread(target=self._fill, name='sflvault-keypair-pool')
+        t.setDaemon(True)
+        t.start()
+
+    def shutdown(self):
+        with self.cond:
+            self.stopping = True
+            self.keypairs.clear()
+            self.cond.notify_all()
+        if self.process is not None:
+            self.process.terminate()
+            self.process = None
+
+    def take(self):
+        """Return a keypair, as generate_keypair() does, from the pool if
+        one is ready."""
+        with self.cond:
+            if self.keypairs:
+                self.taken += 1
+                self.cond.notify_all()
+                return self.keypairs.popleft()
+            self.generated_inline += 1
+        return generate_keypair()
+
+    def _fill(self):
+        while True:
+            with self.cond:
+                while len(self.keypairs) >= self.size and not self.stopping:
+                    self.cond.wait()
+                if self.stopping:
+                    return
+                process = self.process
+            try:
+                keypair = process.apply(generate_keypair)
+            except Exception:
+                if self.stopping:
+                    return
+                log.exception("Failed to generate a keypair")
+                time.sleep(self.retry_delay)
+                continue
+            with self.cond:
+                if self.stopping:
+                    return
+                self.keypairs.append(keypair)
+
+    def stats(self):
+        return {'size': self.size,
+                'depth': len(self.keypairs),
+                'taken': self.taken,
+                'generated_inline': self.generated_inline}
+
+
+# SFLvaultServer sets the size from sflvault.keypair_pool_size.
+pool = KeypairPool()
@@ -0,0 +1,569 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Storage backends for the authentication sessions.
+
+A session is a dict holding at least 'timeout' (a datetime), 'user_id',
+'username', 'is_admin' and 'remote_addr', keyed by the authtok returned by
+sflvault.authenticate. Values must be plain data, so that backends shared
+between processes can serialize them.
+
+Expired sessions are removed by sweep(), which SessionSweeper calls
+periodically, so that tokens never presented again don't pile up.
+
+SignedTokenSessionStore keeps no sessions at all: the session travels in
+the token itself, signed by the server.
+
+The same backends hold the login challenges sent by sflvault.login, keyed
+by username, until sflvault.authenticate consumes them.
+"""
+
+import base64
+import hashlib
+import heapq
+import hmac
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy import MetaData, Table, Column, types, sql, create_engine
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.exc import IntegrityError
+
+log = logging.getLogger(__name__)
+
+
+# Revocations of signed tokens, in the vault's database so that every
+# worker process and node sees them. Tokens are stored as their SHA-256.
+revocations_metadata = MetaData()
+revoked_tokens_table = Table('revoked_tokens', revocations_metadata,
+                             Column('token_hash', types.String(64), primary_key=True),
+                             Column('expiry', types.Float, nullable=False, index=True))
+revoked_users_table = Table('revoked_users', revocations_metadata,
+                            Column('user_id', types.Integer, primary_key=True),
+                            Column('revoked', types.Float, nullable=False),
+                            Column('expiry', types.Float, nullable=False, index=True))
+
+
+def _to_timestamp(dt):
+    return time.mktime(dt.timetuple()) + dt.microsecond / 1e6
+
+
+class SessionStore(object):
+    """Interface of the session backends.
+
+    max_sessions - total number of sessions kept, 0 for no limit
+    max_sessions_per_user - number of sessions kept for each user, 0 for
+                            no limit
+
+    When a limit is reached, the oldest sessions are evicted.
+    """
+
+    def __init__(self, max_sessions=0, max_sessions_per_user=0):
+        self.max_sessions = max_sessions
+        self.max_sessions_per_user = max_sessions_per_user
+        self.expired = 0
+        self.evicted = 0
+
+    def create(self, value):
+        """Store a new session, and return the authtok identifying it."""
+        authtok = base64.b64encode(os.urandom(32))
+        self.set(authtok, value)
+        return authtok
+
+    def get(self, authtok):
+        """Return the session stored for authtok, or None."""
+        raise NotImplementedError
+
+    def set(self, authtok, value):
+        """Store (or replace) the session for authtok."""
+        raise NotImplementedError
+
+    def pop(self, authtok):
+        """Remove the session for authtok and return it, or None.
+
+        When several callers pop the same session, only one gets it.
+        """
+        raise NotImplementedError
+
+    def delete(self, authtok):
+        """Forget about authtok. Unknown tokens are ignored."""
+        raise NotImplementedError
+
+    def expire(self, authtok):
+        """Forget about authtok, found to have timed out."""
+        self.delete(authtok)
+        self.expired += 1
+
+    def revoke_user(self, user_id):
+        """Forget about every session of a user."""
+        raise NotImplementedError
+
+    def sweep(self, now=None):
+        """Remove every session that timed out before now."""
+        raise NotImplementedError
+
+    def count(self):
+        """Return the number of sessions stored."""
+        raise NotImplementedError
+
+    def stats(self):
+        return {'live': self.count(),
+                'expired': self.expired,
+                'evicted': self.evicted}
+
+
+class MemorySessionStore(SessionStore):
+    """Sessions kept in memory, private to the current process.
+
+    Sessions are kept in least recently used order, with an index of the
+    tokens of each user, and a heap ordered by timeout for the sweeper.
+    """
+
+    def __init__(self, max_sessions=0, max_sessions_per_user=0):
+        SessionStore.__init__(self, max_sessions, max_sessions_per_user)
+        self.sessions = OrderedDict()
+        # user_id -> OrderedDict of that user's tokens, oldest first
+        self.user_tokens = {}
+        # (timeout, authtok). Entries of deleted or replaced sessions are
+        # left in there, and skipped when they reach the top, until they
+        # outnumber the live ones and the heap is rebuilt.
+        self.expiry = []
+        self.lock = threading.Lock()
+
+    def get(self, authtok):
+        with self.lock:
+            value = self.sessions.pop(authtok, None)
+            if value is None:
+                return None
+            self.sessions[authtok] = value
+            return dict(value)
+
+    def set(self, authtok, value):
+        value = dict(value)
+        with self.lock:
+            self._remove(authtok)
+            self.sessions[authtok] = value
+            self.user_tokens.setdefault(value.get('user_id'), OrderedDict())[authtok] = True
+            heapq.heappush(self.expiry, (value['timeout'], authtok))
+            self._enforce_limits(value.get('user_id'))
+            if len(self.expiry) > 2 * len(self.sessions) + 16:
+                self.expiry = [(v['timeout'], tok) for tok, v in self.sessions.items()]
+                heapq.heapify(self.expiry)
+
+    def pop(self, authtok):
+        with self.lock:
+            value = self.sessions.get(authtok)
+            self._remove(authtok)
+            return value
+
+    def delete(self, authtok):
+        with self.lock:
+            self._remove(authtok)
+
+    def revoke_user(self, user_id):
+        with self.lock:
+            for authtok in list(self.user_tokens.get(user_id, ())):
+                self._remove(authtok)
+
+    def sweep(self, now=None):
+        now = now or datetime.now()
+        swept = 0
+        with self.lock:
+            while self.expiry and self.expiry[0][0] < now:
+                timeout, authtok = heapq.heappop(self.expiry)
+                value = self.sessions.get(authtok)
+                if value is not None and value['timeout'] == timeout:
+                    self._remove(authtok)
+                    swept += 1
+            self.expired += swept
+        return swept
+
+    def count(self):
+        return len(self.sessions)
+
+    def _remove(self, authtok):
+        value = self.sessions.pop(authtok, None)
+        if value is None:
+            return
+        tokens = self.user_tokens.get(value.get('user_id'))
+        if tokens is not None:
+            tokens.pop(authtok, None)
+            if not tokens:
+                del self.user_tokens[value.get('user_id')]
+
+    def _enforce_limits(self, user_id):
+        if self.max_sessions_per_user:
+            tokens = self.user_tokens[user_id]
+            while len(tokens) > self.max_sessions_per_user:
+                self._remove(next(iter(tokens)))
+                self.evicted += 1
+        if self.max_sessions:
+            while len(self.sessions) > self.max_sessions:
+                self._remove(next(iter(self.sessions)))
+                self.evicted += 1
+
+
+class SQLiteSessionStore(SessionStore):
+    """Sessions kept in an SQLite database, in WAL mode.
+
+    Every worker process on the host opens the same file; WAL lets readers
+    proceed while another process writes. Each thread of each process uses
+    its own connection.
+
+    Evictions follow creation order, as tracking the last use of a session
+    would turn every read into a write. The expired and evicted counters
+    only account for what the current process did.
+
+    Several stores can share a file, each using its own table.
+    """
+
+    def __init__(self, path, timeout=5.0, max_sessions=0,
+                 max_sessions_per_user=0, table='sessions'):
+        SessionStore.__init__(self, max_sessions, max_sessions_per_user)
+        self.path = path
+        self.timeout = timeout
+        self.table = table
+        self.local = threading.local()
+        self._connect().executescript("""
+            CREATE TABLE IF NOT EXISTS %(table)s (
+                authtok TEXT PRIMARY KEY,
+                user_id INTEGER,
+                timeout REAL NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS %(table)s_timeout ON %(table)s (timeout);
+            CREATE INDEX IF NOT EXISTS %(table)s_user_id ON %(table)s (user_id);
+        """ % {'table': table})
+
+    def _connect(self):
+        # Connections must not cross a fork() either.
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def _execute(self, statement, params=()):
+        return self._connect().execute(statement % {'table': self.table}, params)
+
+    def get(self, authtok):
+        row = self._execute(
+            'SELECT timeout, data FROM %(table)s WHERE authtok = ?',
+            (authtok,)).fetchone()
+        if row is None:
+            return None
+        value = json.loads(row[1])
+        value['timeout'] = datetime.fromtimestamp(row[0])
+        return value
+
+    def set(self, authtok, value):
+        data = dict(value)
+        timeout = _to_timestamp(data.pop('timeout'))
+        self._execute(
+            'INSERT OR REPLACE INTO %(table)s (authtok, user_id, timeout, data) '
+            'VALUES (?, ?, ?, ?)',
+            (authtok, data.get('user_id'), timeout, json.dumps(data)))
+        if self.max_sessions_per_user:
+            cur = self._execute(
+                'DELETE FROM %(table)s WHERE user_id = ? AND rowid NOT IN '
+                '(SELECT rowid FROM %(table)s WHERE user_id = ? '
+                'ORDER BY rowid DESC LIMIT ?)',
+                (data.get('user_id'), data.get('user_id'),
+                 self.max_sessions_per_user))
+            self.evicted += cur.rowcount
+        if self.max_sessions:
+            cur = self._execute(
+                'DELETE FROM %(table)s WHERE rowid NOT IN '
+                '(SELECT rowid FROM %(table)s ORDER BY rowid DESC LIMIT ?)',
+                (self.max_sessions,))
+            self.evicted += cur.rowcount
+
+    def pop(self, authtok):
+        value = self.get(authtok)
+        if value is None:
+            return None
+        # Whoever deletes the row owns the session.
+        cur = self._execute('DELETE FROM %(table)s WHERE authtok = ?',
+                            (authtok,))
+        return value if cur.rowcount else None
+
+    def delete(self, authtok):
+        self._execute('DELETE FROM %(table)s WHERE authtok = ?', (authtok,))
+
+    def revoke_user(self, user_id):
+        self._execute('DELETE FROM %(table)s WHERE user_id = ?', (user_id,))
+
+    def sweep(self, now=None):
+        now = now or datetime.now()
+        cur = self._execute('DELETE FROM %(table)s WHERE timeout < ?',
+                            (_to_timestamp(now),))
+        self.expired += cur.rowcount
+        return cur.rowcount
+
+    def count(self):
+        return self._execute('SELECT COUNT(*) FROM %(table)s').fetchone()[0]
+
+
+class SignedTokenSessionStore(SessionStore):
+    """Sessions carried by the tokens themselves, signed with HMAC-SHA256.
+
+    A token holds the user id, username, admin flag, bound remote address,
+    issue time and expiry, so validating it takes no shared state: any
+    process, on any node configured with the same secret, accepts it.
+
+    As nothing is stored, tokens can't be deleted. Logged out tokens and
+    users are kept in a revocation list instead, until the tokens they
+    cover expire. With an `engine`, that list is in the revoked_tokens and
+    revoked_users tables of its database, shared by every process and node
+    using it, and checked by every get(). Without one, it is local to the
+    process.
+
+    secret - the HMAC key
+    lifetime - longest a token can be valid, in seconds: revocations are
+               dropped after that long.
+    engine - SQLAlchemy engine of the database holding the revocations.
+    pool_size - connections kept open to that database, from a pool of
+                the store's own (the worker threads check revocations on
+                every request, they mustn't starve the vault's pool).
+    """
+
+    def __init__(self, secret, lifetime, engine=None, pool_size=8):
+        SessionStore.__init__(self)
+        self.secret = secret
+        self.lifetime = lifetime
+        self.engine = engine
+        self.pool_size = pool_size
+        self.pool_engine = None
+        self.pool_pid = None
+        if engine is not None:
+            revocations_metadata.create_all(engine)
+            # Built, and compiled, once: compiling costs more than running it.
+            tokens, users = revoked_tokens_table, revoked_users_table
+            self.revoked_query = sql.select([sql.or_(
+                sql.exists().where(tokens.c.token_hash == sql.bindparam('token_hash')),
+                sql.exists().where(sql.and_(users.c.user_id == sql.bindparam('user_id'),
+                                            users.c.revoked >= sql.bindparam('issued'))))])
+            self.compiled_cache = {}
+        # authtok -> expiry timestamp
+        self.revoked_tokens = {}
+        # user_id -> (revocation timestamp, expiry timestamp)
+        self.revoked_users = {}
+        self.lock = threading.Lock()
+
+    def _sign(self, payload):
+        return base64.urlsafe_b64encode(
+            hmac.new(self.secret, payload, hashlib.sha256).digest())
+
+    def create(self, value):
+        payload = base64.urlsafe_b64encode(json.dumps({
+            'user_id': value['user_id'],
+            'username': value['username'],
+            'is_admin': value['is_admin'],
+            'remote_addr': value['remote_addr'],
+            'issued': time.time(),
+            'timeout': _to_timestamp(value['timeout']),
+            'nonce': base64.b64encode(os.urandom(12)),
+        }))
+        return '%s.%s' % (payload, self._sign(payload))
+
+    def get(self, authtok):
+        try:
+            payload, signature = str(authtok).split('.')
+            if not hmac.compare_digest(signature, self._sign(payload)):
+                return None
+            value = json.loads(base64.urlsafe_b64decode(payload))
+        except (ValueError, TypeError):
+            return None
+
+        if self._revoked(authtok, value['user_id'], value['issued']):
+            return None
+
+        value['timeout'] = datetime.fromtimestamp(value['timeout'])
+        del value['issued'], value['nonce']
+        return value
+
+    def _connect(self):
+        """Check out a connection from the store's pool, to close after
+        use. The pool is created in each process, as its connections can't
+        be shared across a fork(). It is a QueuePool even on SQLite, where
+        opening a connection (NullPool) costs more than the query."""
+        with self.lock:
+            if self.pool_pid != os.getpid():
+                connect_args = {}
+                if self.engine.dialect.name == 'sqlite':
+                    connect_args['check_same_thread'] = False
+                self.pool_engine = create_engine(
+                    self.engine.url, poolclass=QueuePool, pool_size=self.pool_size,
+                    max_overflow=self.pool_size, connect_args=connect_args)
+                self.pool_pid = os.getpid()
+        return self.pool_engine.connect().execution_options(
+            autocommit=True, compiled_cache=self.compiled_cache)
+
+    def _revoked(self, authtok, user_id, issued):
+        if self.engine is not None:
+            with self._connect() as conn:
+                return conn.scalar(self.revoked_query, token_hash=_token_hash(authtok),
+                                   user_id=user_id, issued=issued)
+        with self.lock:
+            if authtok in self.revoked_tokens:
+                return True
+            revoked = self.revoked_users.get(user_id)
+            return bool(revoked and issued <= revoked[0])
+
+    def set(self, authtok, value):
+        raise NotImplementedError("Signed tokens are created, not stored")
+
+    def delete(self, authtok):
+        expiry = time.time() + self.lifetime
+        if self.engine is not None:
+            try:
+                with self._connect() as conn:
+                    conn.execute(revoked_tokens_table.insert(),
+                                 token_hash=_token_hash(authtok), expiry=expiry)
+            except IntegrityError:
+                pass  # already revoked
+            return
+        with self.lock:
+            self.revoked_tokens[authtok] = expiry
+
+    def expire(self, authtok):
+        # Expired tokens fail the timeout check anyway.
+        self.expired += 1
+
+    def revoke_user(self, user_id):
+        now = time.time()
+        if self.engine is not None:
+            with self._connect() as conn, conn.begin():
+                conn.execute(revoked_users_table.delete()
+                             .where(revoked_users_table.c.user_id == user_id))
+                conn.execute(revoked_users_table.insert(), user_id=user_id,
+                             revoked=now, expiry=now + self.lifetime)
+            return
+        with self.lock:
+            self.revoked_users[user_id] = (now, now + self.lifetime)
+
+    def sweep(self, now=None):
+        now = _to_timestamp(now) if now else time.time()
+        if self.engine is not None:
+            with self._connect() as conn, conn.begin():
+                for table in (revoked_tokens_table, revoked_users_table):
+                    conn.execute(table.delete().where(table.c.expiry < now))
+            return 0
+        with self.lock:
+            for authtok, expiry in self.revoked_tokens.items():
+                if expiry < now:
+                    del self.revoked_tokens[authtok]
+            for user_id, (revoked, expiry) in self.revoked_users.items():
+                if expiry < now:
+                    del self.revoked_users[user_id]
+        return 0
+
+    def count(self):
+        stats = self.stats()
+        return stats['revoked_tokens'] + stats['revoked_users']
+
+    def stats(self):
+        if self.engine is not None:
+            count = sql.select([sql.func.count()])
+            with self._connect() as conn:
+                return {'revoked_tokens': conn.scalar(count.select_from(revoked_tokens_table)),
+                        'revoked_users': conn.scalar(count.select_from(revoked_users_table)),
+                        'expired': self.expired}
+        return {'revoked_tokens': len(self.revoked_tokens),
+                'revoked_users': len(self.revoked_users),
+                'expired': self.expired}
+
+
+def _token_hash(authtok):
+    return hashlib.sha256(str(authtok)).hexdigest()
+
+
+class SessionSweeper(threading.Thread):
+    """Daemon thread removing the expired sessions of a store every
+    `interval` seconds. Don't start it for an interval of 0 or less."""
+
+    def __init__(self, store, interval):
+        threading.Thread.__init__(self, name='sflvault-session-sweeper')
+        self.setDaemon(True)
+        self.store = store
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                swept = self.store.sweep()
+            except Exception:
+                log.exception("Failed to sweep expired sessions")
+                continue
+            if swept:
+                log.debug("Swept %d expired sessions, %d left", swept,
+                          self.store.count())
+
+
+def session_store_from_config(settings, engine=None):
+    """Build the session store selected by sflvault.vault.session_backend
+
+    engine - of the vault's database, where the 'signed' backend keeps its
+             revocations.
+    """
+    backend = settings.get('sflvault.vault.session_backend', 'memory')
+    limits = {
+        'max_sessions': int(settings.get('sflvault.vault.max_sessions', 0)),
+        'max_sessions_per_user': int(settings.get('sflvault.vault.max_sessions_per_user', 0)),
+    }
+    if backend == 'memory':
+        return MemorySessionStore(**limits)
+    elif backend == 'sqlite':
+        return SQLiteSessionStore(settings['sflvault.vault.session_file'], **limits)
+    elif backend == 'signed':
+        secret = settings.get('sflvault.vault.token_secret')
+        if not secret:
+            log.warning("No sflvault.vault.token_secret set, using a random one: "
+                        "tokens won't survive a restart, nor be accepted by other nodes.")
+            secret = os.urandom(32)
+        # A connection for each worker thread, and the sweeper.
+        return SignedTokenSessionStore(
+            secret, int(settings['sflvault.vault.session_timeout']), engine,
+            pool_size=int(settings.get('sflvault.workers', 8)) + 1)
+    raise ValueError("Invalid sflvault.vault.session_backend: %s" % backend)
+
+
+def challenge_store_from_config(settings):
+    """Build the login challenge store selected by
+    sflvault.vault.challenge_backend"""
+    backend = settings.get('sflvault.vault.challenge_backend', 'memory')
+    max_challenges = int(settings.get('sflvault.vault.max_sessions', 0))
+    if backend == 'memory':
+        return MemorySessionStore(max_sessions=max_challenges)
+    elif backend == 'sqlite':
+        return SQLiteSessionStore(settings['sflvault.vault.session_file'],
+                                  max_sessions=max_challenges,
+                                  table='challenges')
+    raise ValueError("Invalid sflvault.vault.challenge_backend: %s" % backend)
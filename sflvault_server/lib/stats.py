@@ -0,0 +1,52 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Server counters, returned by sflvault.server_stats.
+
+Components register a provider, a callable returning a dict of counters,
+under a name. Counters are those of the process serving the call.
+"""
+
+import threading
+
+providers = {}
+
+
+class Counters(object):
+    """Named counters, incremented from any thread."""
+
+    def __init__(self, *names):
+        self.lock = threading.Lock()
+        self.values = dict.fromkeys(names, 0)
+
+    def add(self, name, n=1):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + n
+
+    def stats(self):
+        with self.lock:
+            return dict(self.values)
+
+
+def register(name, provider):
+    providers[name] = provider
+
+
+def collect():
+    return dict((name, provider()) for name, provider in providers.items())
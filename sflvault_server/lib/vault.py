@@ -35,6 +35,7 @@ return clean responses to clean queries.
 
 import xmlrpclib
 import json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 
 from sqlalchemy import sql
 from sqlalchemy.exc import InvalidRequestError as InvalidReq
@@ -42,6 +43,8 @@ from sqlalchemy.orm import eagerload_all
 
 from .. import model
 from ..model import *
+from .context import RequestContext
+from . import crypto_pool, keypair_pool
 from sflvault.common import VaultError
 
 
@@ -68,15 +71,33 @@ class SFLvaultAccess(object):
         if method:
             return method(*params)
 
-    def __init__(self):
-        """Init obj."""
+    def __init__(self, context=None):
+        """Init obj.
 
-        # This gives this object the knowledge of which user_id is currently
-        # using the Vault
-        self.myself_id = None
-        # This gives this object the knowledge of which username is currently
-        # using the Vault
-        self.myself_username = None
+        context - the RequestContext of the caller. An anonymous one is
+                  created when the Vault is used locally.
+        """
+        self.context = context if context is not None else RequestContext()
+
+    # This gives this object the knowledge of which user_id is currently
+    # using the Vault
+    def _get_myself_id(self):
+        return self.context.user_id
+
+    def _set_myself_id(self, user_id):
+        self.context.user_id = user_id
+
+    myself_id = property(_get_myself_id, _set_myself_id)
+
+    # This gives this object the knowledge of which username is currently
+    # using the Vault
+    def _get_myself_username(self):
+        return self.context.username
+
+    def _set_myself_username(self, username):
+        self.context.username = username
+
+    myself_username = property(_get_myself_username, _set_myself_username)
 
     def _log_any(self, log_func, msg, data):
         # Need to do that for user-setup
@@ -154,6 +175,7 @@ class SFLvaultAccess(object):
 
         # Ok, let's save the things and reset waiting_setup.
         u.waiting_setup = None
+        model.forget_elgamal('User', u.id, u.pubkey)
         u.pubkey = pubkey
 
         # Save new informations
@@ -237,15 +259,20 @@ class SFLvaultAccess(object):
         t1 = model.usergroups_table
         meta.Session.execute(t1.delete(t1.c.user_id == usr.id))
         username = usr.username
+        uid = usr.id
+        model.forget_elgamal('User', uid, usr.pubkey)
         meta.Session.delete(usr)
+        model.refresh_access(user_ids=[uid])
         transaction.commit()
+        model.forget_access(uid)
 
         self.log_command(
             "user_del", username=username
         )
 
 
-        return vaultMsg(True, "User %s successfully deleted" % username)
+        return vaultMsg(True, "User %s successfully deleted" % username,
+                        {'user_id': uid})
 
 
     def user_list(self, groups=False):
@@ -256,7 +283,7 @@ class SFLvaultAccess(object):
         req = query(User)
         if groups:
             req = req.options(eagerload_all('groups_assoc.group'))
-        lst = query(User).all()
+        lst = req.all()
 
         out = []
         for x in lst:
@@ -315,8 +342,10 @@ class SFLvaultAccess(object):
         # url
         # notes
         # location
+        machine_ids = [s.machine_id]
         if 'machine_id' in data:
             s.machine_id = int(data['machine_id'])
+            machine_ids.append(s.machine_id)
         if 'parent_service_id' in data:
             if data['parent_service_id'] == '':
                 s.parent_service_id = None
@@ -329,7 +358,9 @@ class SFLvaultAccess(object):
         if 'metadata' in data:
             s.metadata = data['metadata']
 
+        model.refresh_search(machine_ids=machine_ids)
         transaction.commit()
+        model.forget_search()
 
         self.log_command(
             "service_put", service_id=service_id, data=data
@@ -346,101 +377,128 @@ class SFLvaultAccess(object):
                        {"service_id": service_id, "error": str(e)})
             raise VaultError("Service not found: %s (%s)" % (service_id,
                                                              str(e)))
-        # unused
-        #me = query(User).get(self.myself_id)
+
+        return self._services_data([s], group_id)[0]
+
+    def _services_data(self, services, group_id=None):
+        """Retrieve the information for the given Services, with two
+        queries whatever their number."""
+        service_ids = [s.id for s in services]
 
         # We need no aliasing, because we'll only use `cryptgroupkey`,
         # `cryptsymkey` and `group_id` in there.
-        req = sql.join(servicegroups_table, usergroups_table,
-                       ServiceGroup.group_id == UserGroup.group_id) \
-                 .join(users_table, User.id == UserGroup.user_id) \
-                 .select(use_labels=True) \
-                 .where(User.id == self.myself_id) \
-                 .where(ServiceGroup.service_id == s.id) \
-                 .order_by(ServiceGroup.group_id)
+        if model.access_table_enabled:
+            usa = model.user_service_access_table
+            req = sql.join(usa, usergroups_table,
+                           usa.c.usergroup_id == UserGroup.id) \
+                     .join(servicegroups_table,
+                           usa.c.servicegroup_id == ServiceGroup.id) \
+                     .select(use_labels=True) \
+                     .where(usa.c.user_id == self.myself_id) \
+                     .where(usa.c.service_id.in_(service_ids)) \
+                     .order_by(usa.c.group_id)
+        else:
+            req = sql.join(servicegroups_table, usergroups_table,
+                           ServiceGroup.group_id == UserGroup.group_id) \
+                     .join(users_table, User.id == UserGroup.user_id) \
+                     .select(use_labels=True) \
+                     .where(User.id == self.myself_id) \
+                     .where(ServiceGroup.service_id.in_(service_ids)) \
+                     .order_by(ServiceGroup.group_id)
 
         # Deal with group if specified..
         if group_id:
             req = req.where(ServiceGroup.group_id == group_id)
 
-        res = meta.Session.execute(req)
-
-        # Take the first one
-        uciphers = list(res)
-        if not uciphers:
-            ugcgk = ''
-            sgcsk = ''
-            uggi = ''
-        else:
-            ucipher = uciphers[0]
-            # WARN: these are table-name dependent!!
-            ugcgk = ucipher.users_groups_cryptgroupkey
-            sgcsk = ucipher.services_groups_cryptsymkey
-            uggi = ucipher.users_groups_group_id
+        # Take the first one of each service
+        uciphers = {}
+        for ucipher in meta.Session.execute(req):
+            uciphers.setdefault(ucipher.services_groups_service_id, ucipher)
 
         # Load groups too if required
 
-        groups_list = []
+        groups_lists = dict((sid, []) for sid in service_ids)
         req2 = sql.join(groups_table, servicegroups_table)\
                   .select(use_labels=True)\
-                  .where(ServiceGroup.service_id == service_id)
+                  .where(ServiceGroup.service_id.in_(service_ids))
 
         res2 = meta.Session.execute(req2)
         for grp in res2:
-            groups_list.append((grp.groups_id, grp.groups_name))
-
-        out = {'id': s.id,
-               'url': s.url,
-               'secret': s.secret,
-               'machine_id': s.machine_id,
-               'cryptgroupkey': ugcgk,
-               'cryptsymkey': sgcsk,
-               'group_id': uggi,
-               'groups_list': groups_list,
-               'parent_service_id': s.parent_service_id,
-               'secret_last_modified': s.secret_last_modified,
-               'metadata': s.metadata or {},
-               'notes': s.notes or ''}
+            groups_lists[grp.services_groups_service_id].append(
+                (grp.groups_id, grp.groups_name))
+
+        out = []
+        for s in services:
+            ucipher = uciphers.get(s.id)
+            if not ucipher:
+                ugcgk = ''
+                sgcsk = ''
+                uggi = ''
+            else:
+                # WARN: these are table-name dependent!!
+                ugcgk = ucipher.users_groups_cryptgroupkey
+                sgcsk = ucipher.services_groups_cryptsymkey
+                uggi = ucipher.users_groups_group_id
+
+            out.append({'id': s.id,
+                        'url': s.url,
+                        'secret': s.secret,
+                        'machine_id': s.machine_id,
+                        'cryptgroupkey': ugcgk,
+                        'cryptsymkey': sgcsk,
+                        'group_id': uggi,
+                        'groups_list': groups_lists[s.id],
+                        'parent_service_id': s.parent_service_id,
+                        'secret_last_modified': s.secret_last_modified,
+                        'metadata': s.metadata or {},
+                        'notes': s.notes or ''})
 
         return out
 
     def service_get_tree(self, service_id):
         """Get a service tree, starting with service_id"""
 
-        accessible_service_ids = []
-
-        my_groups = set(
-            g.id for g in query(UserGroup).filter_by(
-                user_id=self.myself_id
-            ).all()
-        )
-
-        out = []
-        while True:
-            try:
-                data = self._service_get_data(service_id)
-            except VaultError, e:
-                self.log_e('Show service: %(error)s', {"error": str(e)})
-                return vaultMsg(False, str(e))
-
-            service_groups = set(
-                g[0] for g in data['groups_list']
-            )
-
-            if my_groups.intersection(service_groups):
-                accessible_service_ids.append(data['id'])
-            out.append(data)
-
-            if not data['parent_service_id']:
-                break
-
-            # Load the parent...
-            service_id = data['parent_service_id']
-
-            # check if we're not in an infinite loop!
-            if service_id in [x['id'] for x in out]:
+        # pysqlite gives no result description for a WITH statement that
+        # returns no rows, so make sure the CTE anchor exists first.
+        if query(Service).get(service_id) is None:
+            self.log_e('Show service: %(error)s',
+                       {"error": "Service not found: %s" % service_id})
+            return vaultMsg(False, "Service not found: %s" % service_id)
+
+        # Load all its parents at once...
+        st = services_table
+        ancestors = sql.select([st.c.id, st.c.parent_service_id]) \
+                       .where(st.c.id == service_id) \
+                       .cte('ancestors', recursive=True)
+        # UNION, not UNION ALL: a circular chain stops once every
+        # service of the loop was found.
+        ancestors = ancestors.union(
+            sql.select([st.c.id, st.c.parent_service_id])
+               .where(st.c.id == ancestors.c.parent_service_id))
+        services = dict((s.id, s) for s in query(Service).join(
+            ancestors, Service.id == ancestors.c.id))
+
+        # ...then walk up the chain.
+        chain = []
+        seen = set()
+        while service_id:
+            service_id = int(service_id)
+            if service_id in seen:
                 self.log_e('Circular references of parent services, aborting.', {})
                 return vaultMsg(False, "Circular references of parent services, aborting.")
+            if service_id not in services:
+                self.log_e('Show service: %(error)s',
+                           {"error": "Service not found: %s" % service_id})
+                return vaultMsg(False, "Service not found: %s" % service_id)
+            seen.add(service_id)
+            chain.append(services[service_id])
+            service_id = services[service_id].parent_service_id
+
+        out = self._services_data(chain)
+
+        # The services I can decrypt are those shared with one of my groups.
+        accessible_service_ids = [data['id'] for data in out
+                                  if data['group_id'] != '']
 
         out.reverse()
 
@@ -461,13 +519,24 @@ class SFLvaultAccess(object):
         return self.service_get_tree(service_id)
 
 
-    def search(self, search_query, filters=None, verbose=False):
+    def search(self, search_query, filters=None, verbose=False, limit=None,
+               cursor=None):
         """Do the search, and return the result tree.
 
         filters - must be a dictionary with options on which to constraint
                   results.
+        limit - return at most that many results, and never more than
+                model.search_max_results.
+        cursor - the `cursor` returned with the previous page of results,
+                 empty when there are no more.
 
+        The first page comes with `total_estimate`, the number of results
+        (counted up to 10 pages).
         """
+        # A string holds space-separated words, don't search its characters.
+        if isinstance(search_query, basestring):
+            search_query = search_query.split()
+
         filter_types = ['groups', 'machines', 'customers']
         # Load objects on which to restrict the query:
         newfilters = {}
@@ -490,7 +559,43 @@ class SFLvaultAccess(object):
                     self.log_e('Search error: %(error)s', {"error": str(e)})
                     return vaultMsg(False, str(e))
 
-        search = model.search_query(search_query, newfilters, verbose)
+        try:
+            limit = int(limit or 0)
+        except ValueError:
+            return vaultMsg(False, "Invalid search limit: %s" % limit)
+        if limit < 0:
+            return vaultMsg(False, "Invalid search limit: %s" % limit)
+        if model.search_max_results and not 0 < limit <= model.search_max_results:
+            limit = model.search_max_results
+        after = None
+        if cursor:
+            try:
+                after = json.loads(urlsafe_b64decode(str(cursor)))
+                if len(after) != len(model.search_order):
+                    raise ValueError(after)
+            except (TypeError, ValueError):
+                self.log_e('Search error: %(error)s',
+                           {"error": "Invalid cursor"})
+                return vaultMsg(False, "Invalid search cursor")
+
+        # Words are matched case-insensitively, all of them, in any order.
+        cache_key = (tuple(sorted(set(word.lower() for word in search_query))),
+                     tuple(sorted((flt, tuple(sorted(ids)))
+                                  for flt, ids in newfilters.items())),
+                     bool(verbose), limit, cursor or '')
+        generation = model.search_cache.generation
+        page = model.search_cache.get(cache_key)
+        if page is not None:
+            return vaultMsg(True, "Here are the search results", page)
+
+        # One more row tells whether there is a next page.
+        search = list(model.search_query(search_query, newfilters, verbose,
+                                         limit and limit + 1, after))
+        next_cursor = ''
+        if limit and len(search) > limit:
+            search = search[:limit]
+            next_cursor = urlsafe_b64encode(
+                json.dumps(model.search_position(search[-1])))
 
 
         # Quick helper funcs, to create the hierarchical 'out' structure.
@@ -535,7 +640,15 @@ class SFLvaultAccess(object):
         #self.log_i('Search successfull for: %(search)s',
         #            {'search': search_query})
 
-        return vaultMsg(True, "Here are the search results", {'results': out})
+        page = {'results': out, 'cursor': next_cursor}
+        if not cursor:
+            if next_cursor:
+                page['total_estimate'] = model.search_count(
+                    search_query, newfilters, bound=10 * limit)
+            else:
+                page['total_estimate'] = len(search)
+        model.search_cache.set(cache_key, page, generation)
+        return vaultMsg(True, "Here are the search results", page)
 
 
     def customer_get(self, customer_id):
@@ -563,7 +676,9 @@ class SFLvaultAccess(object):
         if 'name' in data:
             cust.name = data['name']
 
+        model.refresh_search(customer_ids=[cust.id])
         transaction.commit()
+        model.forget_search()
 
         self.log_command(
             'customer_put', customer_id=customer_id, data=data
@@ -586,7 +701,9 @@ class SFLvaultAccess(object):
         meta.Session.add(nc)
         meta.Session.flush()
         cid = nc.id
+        model.refresh_search(customer_ids=[cid])
         transaction.commit()
+        model.forget_search()
 
         self.log_command(
             'customer_add', customer_name=customer_name, customer_id=cid
@@ -607,13 +724,17 @@ class SFLvaultAccess(object):
             )
             return vaultMsg(False, "Machine not found: %s" % str(e))
 
+        customer_ids = [m.customer_id]
         if 'customer_id' in data:
             m.customer_id = int(data['customer_id'])
+            customer_ids.append(m.customer_id)
 
         for x in ['ip', 'name', 'fqdn', 'location', 'notes']:
             if x in data:
                 m.__setattr__(x, data[x])
+        model.refresh_search(customer_ids=customer_ids)
         transaction.commit()
+        model.forget_search()
 
         self.log_command(
             "machine_put", machine_id=machine_id, data=data
@@ -657,8 +778,9 @@ class SFLvaultAccess(object):
         meta.Session.flush()
         nmid = nm.id
 
-
+        model.refresh_search(customer_ids=[nm.customer_id])
         transaction.commit()
+        model.forget_search()
         self.log_command("machine_add", machine_id=nmid)
         return vaultMsg(True, "Machine added.", {'machine_id': nmid})
 
@@ -698,12 +820,11 @@ class SFLvaultAccess(object):
         meta.Session.add(ns)
 
         # Encrypt symkey for each group, using it's own ElGamal pubkey
-        for g in groups:
-            eg = g.elgamal()
-
+        cryptsymkeys = crypto_pool.executor.encrypt_for(groups, seckey)
+        for g, cryptsymkey in zip(groups, cryptsymkeys):
             nsg = ServiceGroup()
             nsg.group_id = g.id
-            nsg.cryptsymkey = encrypt_longmsg(eg, seckey)
+            nsg.cryptsymkey = cryptsymkey
 
             ns.groups_assoc.append(nsg)
 
@@ -712,7 +833,11 @@ class SFLvaultAccess(object):
         meta.Session.flush()
         grouplist = [g.name for g in groups]
         nsid = ns.id
+        model.refresh_access(service_ids=[nsid])
+        model.refresh_search(machine_ids=[ns.machine_id])
         transaction.commit()
+        model.forget_search()
+        model.forget_access()
 
         self.log_command(
             "service_add", service_id=nsid
@@ -784,13 +909,13 @@ class SFLvaultAccess(object):
         me = query(User).get(self.myself_id)
         myeg = me.elgamal()
 
-        # Generate keypair
-        newkeys = generate_elgamal_keypair()
+        # Get a keypair
+        pubkey, bothkeys = keypair_pool.pool.take()
 
         ng = Group()
         ng.name = group_name
         ng.hidden = hidden
-        ng.pubkey = serial_elgamal_pubkey(elgamal_pubkey(newkeys))
+        ng.pubkey = pubkey
 
         meta.Session.add(ng)
 
@@ -798,15 +923,16 @@ class SFLvaultAccess(object):
         admins = set(query(User).filter_by(is_admin=True).all())
         admins.add(me)
 
-        for usr in list(admins):
+        admins = list(admins)
+        cryptgroupkeys = crypto_pool.executor.encrypt_for(admins, bothkeys)
+
+        for usr, cryptgroupkey in zip(admins, cryptgroupkeys):
             nug = UserGroup()
             # Make sure I'm admin of my newly created group
             if usr == me:
                 nug.is_admin = True
             nug.user_id = usr.id
-            nug.cryptgroupkey = encrypt_longmsg(usr.elgamal(),
-                                                serial_elgamal_privkey(
-                                                    elgamal_bothkeys(newkeys)))
+            nug.cryptgroupkey = cryptgroupkey
             ng.users_assoc.append(nug)
         name = ng.name
         gid = ng.id
@@ -847,9 +973,13 @@ class SFLvaultAccess(object):
         meta.Session.execute(q1)
 
         name = grp.name
+        model.forget_elgamal('Group', grp.id, grp.pubkey)
         # Delete Group and commit..
         meta.Session.delete(grp)
+        model.refresh_access(group_ids=[grp.id])
         transaction.commit()
+        model.forget_access()
+        model.forget_search()
 
         self.log_command(
             'group_del', group_id=group_id
@@ -865,35 +995,46 @@ class SFLvaultAccess(object):
         # FIXME: list_users is not used
         # FIXME: show_hidden is not used
 
-        groups = query(Group).options(eagerload_all('users_assoc.user')).all()
-        me = query(User).get(self.myself_id)
+        # One row per membership (or per empty group), ordered by group, with
+        # whether I'm a global admin tagging along.
+        ug = usergroups_table
+        me_admin = sql.select([users_table.c.is_admin]) \
+                      .where(users_table.c.id == self.myself_id) \
+                      .as_scalar()
+        req = sql.select([groups_table.c.id.label('group_id'),
+                          groups_table.c.name, groups_table.c.hidden,
+                          ug.c.user_id, ug.c.is_admin, ug.c.cryptgroupkey,
+                          users_table.c.username,
+                          me_admin.label('me_admin')],
+                         from_obj=groups_table.outerjoin(ug).outerjoin(
+                             users_table, users_table.c.id == ug.c.user_id)) \
+                 .order_by(groups_table.c.id, ug.c.id)
 
         out = []
-        for grp in groups:
-            myug = [ug for ug in grp.users_assoc if ug.user_id == me.id]
-
-            res = {'id': grp.id,
-                   'name': grp.name,
-                   'member': me in grp.users,
-                   'hidden': False,
-                   'admin': False}
-
-            if grp.hidden:
-                # Only for global-admin or members, if we're asked to hide
-                # hidden groups
-                if not show_hidden and not me.is_admin and not myug:
-                    continue
-                res['hidden'] = True
-
-            if len(myug):
-                res['cryptgroupkey'] = myug[0].cryptgroupkey
-                if myug[0].is_admin:
-                    res['admin'] = True
-
-            res['members'] = [(u.user_id, u.user.username, u.is_admin)
-                              for u in grp.users_assoc]
-
-            out.append(res)
+        res = None
+        me_is_admin = False
+        for row in meta.Session.execute(req):
+            me_is_admin = row.me_admin
+            if res is None or res['id'] != row.group_id:
+                res = {'id': row.group_id,
+                       'name': row.name,
+                       'member': False,
+                       'hidden': bool(row.hidden),
+                       'admin': False,
+                       'members': []}
+                out.append(res)
+            if row.user_id is None:
+                continue
+            res['members'].append((row.user_id, row.username, row.is_admin))
+            if row.user_id == self.myself_id and not res['member']:
+                res['member'] = True
+                res['cryptgroupkey'] = row.cryptgroupkey
+                res['admin'] = bool(row.is_admin)
+
+        # Hidden groups are only for global-admin or members, if we're asked
+        # to hide them
+        if not show_hidden and not me_is_admin:
+            out = [res for res in out if not res['hidden'] or res['member']]
 
         return vaultMsg(True, 'Here is the list of groups', {'list': out})
 
@@ -926,7 +1067,10 @@ class SFLvaultAccess(object):
         nsg.cryptsymkey = encrypt_longmsg(grpeg, symkey)
 
         meta.Session.add(nsg)
+        model.refresh_access(group_ids=[group_id], service_ids=[service_id])
         transaction.commit()
+        model.forget_access()
+        model.forget_search()
 
         self.log_command(
             'group_add_service', service_id=service_id, group_id=group_id
@@ -960,7 +1104,10 @@ class SFLvaultAccess(object):
 
         # Remove the GroupService from the Group object.
         meta.Session.delete(sg)
+        model.refresh_access(group_ids=[grp.id], service_ids=[service_id])
         transaction.commit()
+        model.forget_access()
+        model.forget_search()
 
         self.log_command('group_del_service', group_id=group_id, service_id=service_id)
         return vaultMsg(True, "Removed service from group successfully")
@@ -1025,7 +1172,9 @@ class SFLvaultAccess(object):
         nug.cryptgroupkey = cryptgroupkey
 
         meta.Session.add(nug)
+        model.refresh_access(group_ids=[group_id], user_ids=[usr.id])
         transaction.commit()
+        model.forget_access(usr.id)
 
         self.log_command('group_add_user', group_id=group_id, user_id=usr.id)
         return vaultMsg(True, "Added user to group successfully")
@@ -1096,7 +1245,9 @@ class SFLvaultAccess(object):
                 "to elect someone group-admin for further management of this group."
 
         meta.Session.delete(hisug[0])
+        model.refresh_access(group_ids=[group_id], user_ids=[usr.id])
         transaction.commit()
+        model.forget_access(usr.id)
 
         self.log_command('group_del_user', group_id=group_id, user_id=usr.id)
         return vaultMsg(True, "Removed user from group successfully" + ohoh, {})
@@ -1166,7 +1317,11 @@ class SFLvaultAccess(object):
         # meta.Session.execute(d3)
         # meta.Session.execute(d4)
 
+        model.refresh_access(service_ids=servs_ids)
+        model.refresh_search(customer_ids=[cust.id])
         transaction.commit()
+        model.forget_search()
+        model.forget_access()
 
         self.log_command('customer_del', customer_id=customer_id)
         return vaultMsg(True,
@@ -1230,7 +1385,11 @@ class SFLvaultAccess(object):
 #       meta.Session.execute(d2)
 #       meta.Session.execute(d3)
 
+        model.refresh_access(service_ids=servs_ids)
+        model.refresh_search(customer_ids=[machine.customer_id])
         transaction.commit()
+        model.forget_search()
+        model.forget_access()
 
         self.log_command("machine_del", machine_id=machine_id)
         return vaultMsg(True, 'Deleted machine m#%s successfully' % machine_id)
@@ -1265,7 +1424,11 @@ class SFLvaultAccess(object):
         query(model.ServiceGroup).filter(model.ServiceGroup.service_id == service_id).delete(synchronize_session=False)
         # Delete the service
         query(Service).filter(model.Service.id == service_id).delete(synchronize_session=False)
+        model.refresh_access(service_ids=[service_id])
+        model.refresh_search(machine_ids=[serv.machine_id])
         transaction.commit()
+        model.forget_search()
+        model.forget_access()
 
         self.log_command("service_del", service_id=service_id)
         return vaultMsg(True, 'Deleted service s#%s successfully' % service_id)
@@ -1353,9 +1516,11 @@ class SFLvaultAccess(object):
         serv.secret = ciphertext
         serv.secret_last_modified = datetime.now()
 
-        for sg in serv.groups_assoc:
-            eg = [g for g in groups if g.id == sg.group_id][0].elgamal()
-            sg.cryptsymkey = encrypt_longmsg(eg, seckey)
+        sgroups = [[g for g in groups if g.id == sg.group_id][0]
+                   for sg in serv.groups_assoc]
+        cryptsymkeys = crypto_pool.executor.encrypt_for(sgroups, seckey)
+        for sg, cryptsymkey in zip(serv.groups_assoc, cryptsymkeys):
+            sg.cryptsymkey = cryptsymkey
 
         grouplist = [g.name for g in groups]
         transaction.commit()
@@ -19,10 +19,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
+import logging
+import sqlite3
 from datetime import datetime
 
 from Crypto.PublicKey import ElGamal
-from sqlalchemy import Column, Table, types, ForeignKey
+import sqlalchemy
+import sqlalchemy.exc
+from sqlalchemy import Column, Table, Index, DDL, event, types, ForeignKey
 from sqlalchemy.orm import mapper, relation, backref
 from sqlalchemy.orm import scoped_session, sessionmaker, eagerload, lazyload
 from sqlalchemy.orm import eagerload_all
@@ -33,10 +38,13 @@ from . import meta
 from .meta import metadata
 from .custom_types import JSONEncodedDict
 from sflvault.common.crypto import *
-from zope.sqlalchemy import ZopeTransactionExtension
+from zope.sqlalchemy import ZopeTransactionExtension, mark_changed
+from sflvault_server.lib.cache import LRUCache
 
 # TODO: add an __all__ statement here, to speed up loading...
 
+log = logging.getLogger(__name__)
+
 
 def init_model(engine):
     """Call me before using any of the tables or classes in the model."""
@@ -49,6 +57,78 @@ def init_model(engine):
     meta.Session = scoped_session(sm)
 
 
+def _invalid_postgresql_indexes(engine):
+    """Names of the indexes of the current schema that PostgreSQL marks
+    INVALID, as a failed CREATE INDEX CONCURRENTLY leaves them"""
+    return set(row[0] for row in engine.execute(
+        "SELECT c.relname FROM pg_index i "
+        "JOIN pg_class c ON c.oid = i.indexrelid "
+        "JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE NOT i.indisvalid AND n.nspname = current_schema()"))
+
+
+def _create_index_concurrently(engine, index, invalid=False):
+    """Build `index` with CREATE INDEX CONCURRENTLY, after dropping the
+    invalid index of the same name if `invalid`. If the build fails, the
+    invalid index it leaves behind is dropped."""
+    preparer = engine.dialect.identifier_preparer
+    name = preparer.quote(index.name)
+    conn = engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    try:
+        if invalid:
+            conn.execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % name)
+        try:
+            conn.execute('CREATE %sINDEX CONCURRENTLY %s ON %s (%s)' % (
+                'UNIQUE ' if index.unique else '', name,
+                preparer.format_table(index.table),
+                ', '.join(preparer.quote(c.name) for c in index.columns)))
+        except sqlalchemy.exc.DBAPIError:
+            conn.execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % name)
+            raise
+    finally:
+        conn.close()
+
+
+def create_missing_indexes(engine):
+    """Create the indexes declared here that the database lacks.
+
+    metadata.create_all() only creates the indexes of the tables it
+    creates. On PostgreSQL, indexes are built CONCURRENTLY, without locking
+    out writes, and the INVALID indexes left by failed builds are dropped
+    and built again. An index that can't be built (e.g. the unique index on
+    usernames, over duplicate usernames) is logged and skipped.
+
+    Return the names of the indexes created.
+    """
+    inspector = sqlalchemy.inspect(engine)
+    invalid = set()
+    if engine.dialect.name == 'postgresql':
+        invalid = _invalid_postgresql_indexes(engine)
+    created = []
+    for table in metadata.sorted_tables:
+        existing = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            if index.name in invalid:
+                log.warning("Index %s on %s is INVALID, left by a failed "
+                            "build: dropping and building it again",
+                            index.name, table.name)
+            elif index.name in existing:
+                continue
+            log.info("Creating index %s on %s", index.name, table.name)
+            try:
+                if engine.dialect.name == 'postgresql':
+                    _create_index_concurrently(engine, index,
+                                               index.name in invalid)
+                else:
+                    index.create(engine)
+            except sqlalchemy.exc.DBAPIError, e:
+                log.error("Could not create index %s on %s: %s",
+                          index.name, table.name, e)
+                continue
+            created.append(index.name)
+    return created
+
+
 users_table = Table("users", metadata,
                     Column('id', types.Integer, primary_key=True),
                     Column('username', types.Unicode(50)),
@@ -143,11 +223,169 @@ services_table = Table('services', metadata,
                               default=datetime.now)
                        )
 
+# Indexes for the lookups done on every login, access check and listing.
+# Databases created before they were added get them from
+# create_missing_indexes().
+Index('users_username', users_table.c.username, unique=True)
+Index('users_groups_user_group',
+      usergroups_table.c.user_id, usergroups_table.c.group_id)
+Index('users_groups_group_user',
+      usergroups_table.c.group_id, usergroups_table.c.user_id)
+Index('services_groups_service_group',
+      servicegroups_table.c.service_id, servicegroups_table.c.group_id)
+Index('services_groups_group_service',
+      servicegroups_table.c.group_id, servicegroups_table.c.service_id)
+Index('services_parent_service_id', services_table.c.parent_service_id)
+Index('services_machine_id', services_table.c.machine_id)
+Index('machines_customer_id', machines_table.c.customer_id)
+
+# Denormalized users_groups JOIN services_groups: one row for each group
+# through which a user reaches a service, pointing at the membership rows
+# holding the cryptgroupkey and the cryptsymkey. Only maintained when
+# access_table_enabled. It holds nothing that can't be recomputed, hence no
+# foreign keys: rows are refreshed after the rows they point to change.
+user_service_access_table = Table('user_service_access', metadata,
+                                  Column('user_id', types.Integer, nullable=False),
+                                  Column('service_id', types.Integer, nullable=False),
+                                  Column('group_id', types.Integer, nullable=False),
+                                  Column('usergroup_id', types.Integer),
+                                  Column('servicegroup_id', types.Integer),
+                                  )
+Index('user_service_access_user_service',
+      user_service_access_table.c.user_id,
+      user_service_access_table.c.service_id)
+Index('user_service_access_service_id', user_service_access_table.c.service_id)
+Index('user_service_access_group_id', user_service_access_table.c.group_id)
+
+# One row for each row of customers LEFT OUTER JOIN machines LEFT OUTER
+# JOIN services (what search_query() searches), with the searched fields in
+# `body`, and the machine's fqdn and ip and the service's url again in
+# `fragments`. Only maintained when search_index_enabled, refreshed by
+# customer or by machine after those change. SQLite indexes `body` in the
+# search_fts FTS5 table and the trigrams of `fragments` in search_trigrams,
+# kept in sync by triggers, all created along with search_documents when
+# the index is enabled, or later by create_missing_search_index();
+# PostgreSQL in GIN indexes, created by create_missing_search_index().
+search_documents_table = Table('search_documents', metadata,
+                               Column('id', types.Integer, primary_key=True),
+                               Column('customer_id', types.Integer, nullable=False),
+                               Column('machine_id', types.Integer),
+                               Column('service_id', types.Integer),
+                               Column('body', types.UnicodeText),
+                               Column('fragments', types.UnicodeText),
+                               )
+Index('search_documents_customer_id', search_documents_table.c.customer_id)
+Index('search_documents_machine_id', search_documents_table.c.machine_id)
+
+
+def _has_fts5():
+    """Whether the SQLite of the sqlite3 module was built with FTS5"""
+    conn = sqlite3.connect(':memory:')
+    try:
+        conn.execute("CREATE VIRTUAL TABLE fts5_probe USING fts5(body)")
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        conn.close()
+
+
+# Without FTS5, SQLite searches with LIKE, even with search_index_enabled.
+sqlite_fts5 = _has_fts5()
+
+# The FTS5 trigram tokenizer appeared in SQLite 3.34. Without it, fragments
+# are searched with LIKE.
+sqlite_trigrams = sqlite_fts5 and sqlite3.sqlite_version_info >= (3, 34)
+
+search_fts_ddl = [
+    "CREATE VIRTUAL TABLE search_fts USING fts5(body, "
+    "content='search_documents', content_rowid='id')",
+    "CREATE TRIGGER search_documents_insert AFTER INSERT ON "
+    "search_documents BEGIN INSERT INTO search_fts (rowid, body) "
+    "VALUES (new.id, new.body); END",
+    "CREATE TRIGGER search_documents_delete AFTER DELETE ON "
+    "search_documents BEGIN INSERT INTO search_fts (search_fts, rowid, "
+    "body) VALUES ('delete', old.id, old.body); END"]
+
+search_trigrams_ddl = [
+    "CREATE VIRTUAL TABLE search_trigrams USING fts5(fragments, "
+    "content='search_documents', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER search_documents_insert_trigrams AFTER INSERT ON "
+    "search_documents BEGIN INSERT INTO search_trigrams (rowid, "
+    "fragments) VALUES (new.id, new.fragments); END",
+    "CREATE TRIGGER search_documents_delete_trigrams AFTER DELETE ON "
+    "search_documents BEGIN INSERT INTO search_trigrams (search_trigrams, "
+    "rowid, fragments) VALUES ('delete', old.id, old.fragments); END"]
+
+
+def _if_sqlite_fts5(ddl, target, bind, **kw):
+    return bind.dialect.name == 'sqlite' and sqlite_fts5 and search_index_enabled
+
+
+def _if_sqlite_trigrams(ddl, target, bind, **kw):
+    return bind.dialect.name == 'sqlite' and sqlite_trigrams and search_index_enabled
+
+
+for statement in search_fts_ddl:
+    event.listen(search_documents_table, 'after_create',
+                 DDL(statement).execute_if(callable_=_if_sqlite_fts5))
+for statement in search_trigrams_ddl:
+    event.listen(search_documents_table, 'after_create',
+                 DDL(statement).execute_if(callable_=_if_sqlite_trigrams))
+event.listen(search_documents_table, 'before_drop',
+             DDL("DROP TABLE IF EXISTS search_fts").execute_if(dialect='sqlite'))
+event.listen(search_documents_table, 'before_drop',
+             DDL("DROP TABLE IF EXISTS search_trigrams").execute_if(dialect='sqlite'))
+
+# Created by create_missing_search_index(), the trigram index only if the
+# pg_trgm extension is, or can be, installed.
+postgresql_search_ddl = [
+    ('search_documents_body', None,
+     "CREATE INDEX CONCURRENTLY search_documents_body ON search_documents "
+     "USING gin (to_tsvector('simple', body))"),
+    ('search_documents_fragments', "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+     "CREATE INDEX CONCURRENTLY search_documents_fragments ON "
+     "search_documents USING gin (fragments gin_trgm_ops)")]
+
+search_fts = sql.table('search_fts', sql.column('rowid'), sql.column('body'))
+search_trigrams = sql.table('search_trigrams', sql.column('rowid'),
+                            sql.column('fragments'))
+
 
 class Service(object):
     def __repr__(self):
         return "<Service s#%d: %s>" % (self.id, self.url)
 
+
+# Parsed public keys: (entity class name, id, pubkey digest) -> ElGamalobj.
+# A changed pubkey gets a new entry, and the stale one ages out. Key objects
+# are only used to encrypt, which doesn't modify them, so they are shared
+# between threads.
+pubkey_cache = LRUCache(1024)
+
+
+def _pubkey_cache_key(kind, id, pubkey):
+    return (kind, id, hashlib.sha1(pubkey).digest())
+
+
+def cached_elgamal(kind, id, pubkey):
+    """Return the ElGamal object for a pubkey, parsing it only if it isn't
+    cached already for that entity."""
+    key = _pubkey_cache_key(kind, id, pubkey)
+    e = pubkey_cache.get(key)
+    if e is None:
+        e = ElGamal.ElGamalobj()
+        (e.p, e.g, e.y) = unserial_elgamal_pubkey(pubkey)
+        pubkey_cache.set(key, e)
+    return e
+
+
+def forget_elgamal(kind, id, pubkey):
+    """Drop the cached ElGamal object of an entity's (old) pubkey."""
+    if pubkey:
+        pubkey_cache.discard(_pubkey_cache_key(kind, id, pubkey))
+
+
 class Machine(object):
     def __repr__(self):
         return "<Machine m#%d: %s (%s %s)>" % (self.id if self.id else 0,
@@ -162,9 +400,7 @@ class User(object):
 
     def elgamal(self):
         """Return the ElGamal object, ready to encrypt stuff."""
-        e = ElGamal.ElGamalobj()
-        (e.p, e.g, e.y) = unserial_elgamal_pubkey(self.pubkey)
-        return e
+        return cached_elgamal(self.__class__.__name__, self.id, self.pubkey)
 
     def __repr__(self):
         return "<User u#%d: %s>" % (self.id, self.username)
@@ -193,9 +429,7 @@ class Group(object):
 
     def elgamal(self):
         """Return the ElGamal object, ready to encrypt stuff."""
-        e = ElGamal.ElGamalobj()
-        (e.p, e.g, e.y) = unserial_elgamal_pubkey(self.pubkey)
-        return e
+        return cached_elgamal(self.__class__.__name__, self.id, self.pubkey)
 
 class Customer(object):
     def __repr__(self):
@@ -220,7 +454,9 @@ class Customer(object):
 #           .user
 #             User
 
-# Map each class to its corresponding table.
+
+# Map each class to its corresponding table. Relations load lazily: the
+# methods that need them choose their loading strategy with options().
 mapper(User, users_table, {
     # Quick access to services...
     'services': relation(
@@ -249,7 +485,6 @@ mapper(ServiceGroup, servicegroups_table, {
 
 mapper(Service, services_table, {
     'children': relation(Service,
-                         lazy=False,
                          backref=backref('parent', uselist=False,
                                          remote_side=[services_table.c.id]),
                          primaryjoin=services_table.c.parent_service_id == services_table.c.id)
@@ -257,10 +492,10 @@ mapper(Service, services_table, {
 Service.groups = association_proxy('groups_assoc', 'group')
 
 mapper(Machine, machines_table, {
-    'services': relation(Service, backref='machine', lazy=False)
+    'services': relation(Service, backref='machine')
 })
 mapper(Customer, customers_table, {
-    'machines': relation(Machine, backref='customer', lazy=False)
+    'machines': relation(Machine, backref='customer')
 })
 
 ################ Helper functions ################
@@ -270,32 +505,343 @@ def query(cls):
     return meta.Session.query(cls)
 
 
-def has_access(user_id, service_id):
-    """ Tells if a user have access to a service
+# What each user can reach: user_id -> (is_admin, frozenset of the ids of
+# the services in the user's groups). Disabled unless
+# sflvault.vault.acl_cache_size is set; invalidated by forget_access().
+acl_cache = LRUCache(0)
 
-    A user has access to a service_id if it is an admin or in a group
-    that has access to the service.
+
+# Read access checks from user_service_access, and keep it up to date.
+# SFLvaultServer sets it from sflvault.vault.access_table.
+access_table_enabled = False
+
+
+def _access_source():
+    """The rows user_service_access should hold"""
+    ug = usergroups_table
+    sg = servicegroups_table
+    return sql.select([ug.c.user_id, sg.c.service_id, ug.c.group_id,
+                       ug.c.id, sg.c.id],
+                      ug.c.group_id == sg.c.group_id)
+
+
+def refresh_access(user_ids=None, service_ids=None, group_ids=None):
+    """Recompute, in the current transaction, the user_service_access rows
+    of the given users, services and groups.
+
+    Call once the memberships are changed, before committing.
+    """
+    if not access_table_enabled:
+        return
+    # Core statements don't autoflush.
+    meta.Session.flush()
+    usa = user_service_access_table
+    delete = usa.delete()
+    source = _access_source()
+    for column, source_column, ids in [
+            (usa.c.user_id, usergroups_table.c.user_id, user_ids),
+            (usa.c.service_id, servicegroups_table.c.service_id, service_ids),
+            (usa.c.group_id, usergroups_table.c.group_id, group_ids)]:
+        if ids is not None:
+            delete = delete.where(column.in_(ids))
+            source = source.where(source_column.in_(ids))
+    meta.Session.execute(delete)
+    meta.Session.execute(usa.insert().from_select(
+        ['user_id', 'service_id', 'group_id', 'usergroup_id',
+         'servicegroup_id'], source))
+    mark_changed(meta.Session())
+
+
+def rebuild_access():
+    """Recompute all of user_service_access, in the current transaction"""
+    global access_table_enabled
+    enabled, access_table_enabled = access_table_enabled, True
+    try:
+        refresh_access()
+    finally:
+        access_table_enabled = enabled
+
+
+def check_access():
+    """Compare user_service_access with what it should hold.
+
+    Return (missing rows, extra rows).
     """
-    user = query(User).get(user_id)
-    service = query(Service).get(service_id)
+    usa = user_service_access_table
+    expected = set(tuple(row) for row in meta.Session.execute(_access_source()))
+    actual = set(tuple(row) for row in meta.Session.execute(
+        sql.select([usa.c.user_id, usa.c.service_id, usa.c.group_id,
+                    usa.c.usergroup_id, usa.c.servicegroup_id])))
+    return sorted(expected - actual), sorted(actual - expected)
 
-    if user.is_admin:
-        return True
 
-    my_groups = set(
-        g.id for g in query(UserGroup).filter_by(
-            user_id=user.id,
-        ).all()
-    )
+# Search through search_documents, and keep it up to date. SFLvaultServer
+# sets it from sflvault.vault.search_index.
+search_index_enabled = False
+
+# The most rows a page of search results can hold. SFLvaultServer sets it
+# from sflvault.vault.search_max_results; 0 for no limit.
+search_max_results = 1000
+
+# Pages of search results, keyed by the normalized words, filters and page.
+# Disabled unless sflvault.vault.search_cache_size is set; invalidated by
+# forget_search() after any change to customers, machines, services or the
+# groups of services. Sizes are estimated from the number of rows.
+SEARCH_ROW_BYTES = 300
+
 
-    service_groups = set(
-        g.id for g in query(ServiceGroup).filter_by(
-            service_id=service.id,
-        ).all()
-    )
+def _search_page_size(page):
+    """Rough size of a page of search results: SEARCH_ROW_BYTES for each of
+    its customers, machines and services"""
+    rows = 0
+    for customer in page['results'].itervalues():
+        rows += 1
+        for machine in customer['machines'].itervalues():
+            rows += 1 + len(machine['services'])
+    return rows * SEARCH_ROW_BYTES
 
-    return my_groups.intersection(service_groups)
 
+search_cache = LRUCache(0, sizeof=_search_page_size)
+
+
+def forget_search():
+    """Invalidate every cached search result"""
+    search_cache.clear()
+
+
+def search_cache_stats():
+    stats = search_cache.stats()
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = float(stats['hits']) / lookups if lookups else 0.0
+    return stats
+
+
+def _search_source():
+    """The rows search_documents should hold"""
+    c, m, s = customers_table, machines_table, services_table
+    fields = [c.c.name, m.c.name, m.c.fqdn, m.c.ip, m.c.location,
+              m.c.notes, s.c.url, s.c.notes]
+
+    def concat(fields):
+        text = sql.func.coalesce(fields[0], u'')
+        for field in fields[1:]:
+            text = text + u' ' + sql.func.coalesce(field, u'')
+        return text
+    return sql.select([c.c.id, m.c.id, s.c.id, concat(fields),
+                       concat([m.c.fqdn, m.c.ip, s.c.url])],
+                      from_obj=c.outerjoin(m).outerjoin(s))
+
+
+def refresh_search(customer_ids=None, machine_ids=None):
+    """Recompute, in the current transaction, the search_documents rows of
+    the given customers and machines.
+
+    Refresh the customer after changing one of its machines, and the
+    machine after changing one of its services. Call before committing.
+    """
+    if not search_index_enabled:
+        return
+    # Core statements don't autoflush.
+    meta.Session.flush()
+    sd = search_documents_table
+    delete = sd.delete()
+    source = _search_source()
+    for column, source_column, ids in [
+            (sd.c.customer_id, customers_table.c.id, customer_ids),
+            (sd.c.machine_id, machines_table.c.id, machine_ids)]:
+        if ids is not None:
+            delete = delete.where(column.in_(ids))
+            source = source.where(source_column.in_(ids))
+    meta.Session.execute(delete)
+    meta.Session.execute(sd.insert().from_select(
+        ['customer_id', 'machine_id', 'service_id', 'body', 'fragments'],
+        source))
+    mark_changed(meta.Session())
+
+
+def _create_missing_postgresql_search_index(engine):
+    invalid = _invalid_postgresql_indexes(engine)
+    conn = engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    created = []
+    try:
+        existing = set(row[0] for row in conn.execute(
+            "SELECT indexname FROM pg_indexes "
+            "WHERE tablename = 'search_documents'"))
+        for name, extension, statement in postgresql_search_ddl:
+            if name in invalid:
+                log.warning("Index %s on search_documents is INVALID, left "
+                            "by a failed build: dropping and building it "
+                            "again", name)
+                conn.execute("DROP INDEX CONCURRENTLY IF EXISTS %s" % name)
+            elif name in existing:
+                continue
+            if extension:
+                try:
+                    conn.execute(extension)
+                except sqlalchemy.exc.DBAPIError, e:
+                    log.warning("Could not install pg_trgm, host names, "
+                                "addresses and urls are searched without "
+                                "the %s index: %s", name, e)
+                    continue
+            log.info("Creating index %s on search_documents", name)
+            try:
+                conn.execute(statement)
+            except sqlalchemy.exc.DBAPIError, e:
+                log.error("Could not create index %s on search_documents: "
+                          "%s", name, e)
+                conn.execute("DROP INDEX CONCURRENTLY IF EXISTS %s" % name)
+                continue
+            created.append(name)
+    finally:
+        conn.close()
+    return created
+
+
+def create_missing_search_index(engine):
+    """Create the full-text tables (SQLite) or indexes (PostgreSQL) of
+    search_documents that the database lacks, e.g. after enabling the index
+    on a database created without it, and index the documents already
+    there. Does nothing unless search_index_enabled.
+
+    Return the names of the tables or indexes created.
+    """
+    if not search_index_enabled:
+        return []
+    if engine.dialect.name == 'postgresql':
+        return _create_missing_postgresql_search_index(engine)
+    if engine.dialect.name != 'sqlite':
+        return []
+    existing = set(sqlalchemy.inspect(engine).get_table_names())
+    created = []
+    for name, statements, available in [
+            ('search_fts', search_fts_ddl, sqlite_fts5),
+            ('search_trigrams', search_trigrams_ddl, sqlite_trigrams)]:
+        if not available or name in existing:
+            continue
+        log.info("Creating the %s full-text table", name)
+        conn = engine.connect()
+        try:
+            with conn.begin():
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute("INSERT INTO %s (%s) VALUES ('rebuild')" % (name, name))
+        finally:
+            conn.close()
+        created.append(name)
+    return created
+
+
+def rebuild_search():
+    """Recompute all of search_documents, in the current transaction"""
+    global search_index_enabled
+    enabled, search_index_enabled = search_index_enabled, True
+    try:
+        refresh_search()
+    finally:
+        search_index_enabled = enabled
+
+
+def _search_match(word):
+    """Clause matching the search_documents with a word starting with
+    `word`, through the full-text index"""
+    sd = search_documents_table
+    if meta.engine.dialect.name == 'postgresql':
+        lexeme = "'%s':*" % word.replace('\\', '\\\\').replace("'", "''")
+        return sql.func.to_tsvector('simple', sd.c.body).op('@@')(
+            sql.func.to_tsquery('simple', lexeme))
+    # A phrase of the tokens in `word`, the last one a prefix.
+    phrase = '"%s"*' % word.replace('"', '""')
+    return sd.c.id.in_(sql.select([search_fts.c.rowid])
+                       .where(search_fts.c.body.match(phrase)))
+
+
+def _fragment_match(word):
+    """Clause matching the search_documents whose machine fqdn or ip, or
+    service url, contain `word`, through the trigram index"""
+    sd = search_documents_table
+    pattern = '%%%s%%' % word
+    if meta.engine.dialect.name == 'postgresql':
+        return sd.c.fragments.ilike(pattern)
+    if sqlite_trigrams:
+        # The trigrams pick candidates, which LIKE then checks.
+        return sd.c.id.in_(sql.select([search_trigrams.c.rowid])
+                           .where(search_trigrams.c.fragments.like(pattern)))
+    return sd.c.fragments.like(pattern)
+
+
+def _search_word(word):
+    """Clause matching the search_documents with a word starting with
+    `word`, or with `word` in a host name, address or url"""
+    clauses = []
+    if any(c.isalnum() for c in word):
+        clauses.append(_search_match(word))
+    # Trigrams need 3 characters, and LIKE wildcards would get in the way.
+    if len(word) >= 3 and '%' not in word and '_' not in word:
+        clauses.append(_fragment_match(word))
+    return clauses
+
+
+def _user_access(user_id):
+    generation = acl_cache.generation
+    access = acl_cache.get(user_id)
+    if access is None:
+        user = query(User).get(user_id)
+        if access_table_enabled:
+            usa = user_service_access_table
+            service_ids = sql.select([usa.c.service_id],
+                                     usa.c.user_id == user_id)
+        else:
+            service_ids = sql.select(
+                [servicegroups_table.c.service_id],
+                servicegroups_table.c.group_id == usergroups_table.c.group_id) \
+                .where(usergroups_table.c.user_id == user_id)
+        access = (bool(user and user.is_admin),
+                  frozenset(row[0] for row in meta.Session.execute(service_ids)))
+        acl_cache.set(user_id, access, generation)
+    return access
+
+
+def _in_service_groups_clause(user_id, service_id):
+    if access_table_enabled:
+        usa = user_service_access_table
+        return sql.exists().where(sql.and_(usa.c.user_id == user_id,
+                                           usa.c.service_id == service_id))
+    return sql.exists().where(sql.and_(
+        usergroups_table.c.user_id == user_id,
+        servicegroups_table.c.service_id == service_id,
+        servicegroups_table.c.group_id == usergroups_table.c.group_id))
+
+
+def in_service_groups(user_id, service_id):
+    """Tells if one of a user's groups has access to a service"""
+    if acl_cache.maxsize:
+        return int(service_id) in _user_access(user_id)[1]
+    req = sql.select([_in_service_groups_clause(user_id, service_id)])
+    return bool(meta.Session.execute(req).scalar())
+
+
+def has_access(user_id, service_id):
+    """ Tells if a user have access to a service
+
+    A user has access to a service_id if it is an admin or in a group
+    that has access to the service.
+    """
+    if acl_cache.maxsize:
+        is_admin, service_ids = _user_access(user_id)
+        return is_admin or int(service_id) in service_ids
+    req = sql.select([sql.or_(
+        sql.exists().where(sql.and_(users_table.c.id == user_id,
+                                    users_table.c.is_admin.is_(True))),
+        _in_service_groups_clause(user_id, service_id))])
+    return bool(meta.Session.execute(req).scalar())
+
+
+def forget_access(user_id=None):
+    """Invalidate the cached access of a user, or of everyone"""
+    if user_id is None:
+        acl_cache.clear()
+    else:
+        acl_cache.discard(user_id)
 
 
 def get_user(user, eagerload_all_=None):
@@ -376,10 +922,16 @@ def get_objects_list(objects_ids, object_type, eagerload_all_=None,
     return (objects if return_objects else None, objects_ids)
 
 
-def search_query(swords, filters=None, verbose=False):
-
+def _search_select(swords, filters=None):
+    """The rows of customers, machines and services matching every word"""
     # Create the join..
-    sel = sql.outerjoin(customers_table, machines_table).outerjoin(services_table)
+    if search_index_enabled:
+        sd = search_documents_table
+        sel = sd.join(customers_table, customers_table.c.id == sd.c.customer_id) \
+                .outerjoin(machines_table, machines_table.c.id == sd.c.machine_id) \
+                .outerjoin(services_table, services_table.c.id == sd.c.service_id)
+    else:
+        sel = sql.outerjoin(customers_table, machines_table).outerjoin(services_table)
 
     if filters:
         # Remove filters that are just None
@@ -394,7 +946,8 @@ def search_query(swords, filters=None, verbose=False):
         if 'groups' in filters:
             sel = sel.join(servicegroups_table)
 
-    sel = sel.select(use_labels=True)
+    sel = sql.select([customers_table, machines_table, services_table],
+                     from_obj=sel, use_labels=True)
 
     if filters:
         if 'groups' in filters:
@@ -422,15 +975,54 @@ def search_query(swords, filters=None, verbose=False):
 
     andlist = []
     for word in swords:
-        orlist = [field.ilike('%%%s%%' % word) for field in textfields]
+        orlist = _search_word(word) if search_index_enabled else []
+        if not orlist:
+            orlist = [field.ilike('%%%s%%' % word) for field in textfields]
         if word.isdigit():
             # Search numeric fields too
             orlist += [field == int(word) for field in numfields]
         orword = sql.or_(*orlist)
         andlist.append(orword)
 
-    sel = sel.where(sql.and_(*andlist))
+    return sel.where(sql.and_(*andlist))
+
 
-    sel = sel.order_by(Machine.name, Service.url)
+# Results are sorted by machine name, service url then ids: a total order,
+# so that a page can start after the last row of the previous one.
+search_order = [sql.func.coalesce(machines_table.c.name, u''),
+                sql.func.coalesce(services_table.c.url, ''),
+                customers_table.c.id,
+                sql.func.coalesce(machines_table.c.id, 0),
+                sql.func.coalesce(services_table.c.id, 0)]
+
+
+def search_position(row):
+    """The position of a search_query() row, to search after it"""
+    return [row.machines_name or u'', row.services_url or '',
+            row.customers_id, row.machines_id or 0, row.services_id or 0]
+
+
+def search_query(swords, filters=None, verbose=False, limit=None,
+                 after=None):
+    """Search customers, machines and services for every word.
+
+    limit - return at most that many rows
+    after - only return the rows after that search_position()
+    """
+    sel = _search_select(swords, filters)
+    if after:
+        sel = sel.where(sql.tuple_(*search_order) > sql.tuple_(*after))
+    sel = sel.order_by(*search_order)
+    if limit:
+        sel = sel.limit(limit)
 
     return meta.Session.execute(sel)
+
+
+def search_count(swords, filters=None, bound=None):
+    """Count the rows search_query() returns, stopping at `bound`"""
+    sel = _search_select(swords, filters)
+    if bound:
+        sel = sel.limit(bound)
+    return meta.Session.execute(
+        sql.select([sql.func.count()]).select_from(sel.alias())).scalar()
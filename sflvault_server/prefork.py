@@ -0,0 +1,128 @@
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Serve the vault from several pre-forked worker processes.
+
+The listening socket is bound once by the parent, when the SFLvaultServer
+is built, and inherited by every worker, which all accept() on it.  The
+parent only supervises: it restarts workers that die, and on SIGTERM (or
+SIGINT) it forwards SIGTERM to the workers, which stop accepting, finish
+the requests they already accepted, and exit.
+"""
+
+import errno
+import logging
+import os
+import signal
+import threading
+import time
+
+from Crypto import Random
+
+log = logging.getLogger(__name__)
+
+
+class PreforkSupervisor(object):
+
+    # Seconds to wait before replacing a dead worker, so that a worker
+    # crashing on startup doesn't turn into a fork loop.
+    restart_delay = 1
+
+    def __init__(self, vault_server, workers):
+        self.vault_server = vault_server
+        self.workers = workers
+        # pid -> worker slot
+        self.children = {}
+        self.stopping = False
+
+    def run(self):
+        """Spawn the workers and supervise them until asked to stop."""
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+
+        for slot in range(self.workers):
+            self.spawn(slot)
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+
+            slot = self.children.pop(pid, None)
+            if slot is None or self.stopping:
+                continue
+
+            log.warning("Worker %d (pid %d) exited with status %d, restarting",
+                        slot, pid, status)
+            time.sleep(self.restart_delay)
+            if not self.stopping:
+                self.spawn(slot)
+
+        log.info("All workers stopped")
+
+    def spawn(self, slot):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = slot
+            log.info("Started worker %d (pid %d)", slot, pid)
+            return
+
+        status = 1
+        try:
+            self._run_worker()
+            status = 0
+        except:
+            log.exception("Worker %d crashed", slot)
+        finally:
+            os._exit(status)
+
+    def _run_worker(self):
+        server = self.vault_server.server
+
+        def stop(signum, frame):
+            # shutdown() waits for serve_forever() to return, so it can't be
+            # called from the thread running it.
+            t = threading.Thread(target=server.shutdown)
+            t.setDaemon(True)
+            t.start()
+
+        signal.signal(signal.SIGTERM, stop)
+        # The supervisor turns ^C into a SIGTERM for every worker.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        # Never share the random pool, nor database connections, with the
+        # parent process.
+        Random.atfork()
+        self.vault_server.engine.dispose()
+
+        self.vault_server.start_server()
+
+    def _handle_stop(self, signum, frame):
+        if self.stopping:
+            return
+        log.info("Stopping %d workers", len(self.children))
+        self.stopping = True
+        for pid in self.children.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
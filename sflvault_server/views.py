@@ -22,6 +22,8 @@ import transaction
 
 from sflvault.common.crypto import *
 from sflvault_server.lib.vault import SFLvaultAccess, vaultMsg
+from sflvault_server.lib.sessions import MemorySessionStore
+from sflvault_server.lib import stats, crypto_pool, keypair_pool
 from sflvault_server.model import *
 from decorator import decorator
 from datetime import datetime, timedelta
@@ -36,8 +38,23 @@ MINIMAL_CLIENT_VERSION = LooseVersion('0.7.6')
 # Permissions decorators for XML-RPC calls
 #
 
-vaultSessions = {}
-vault = SFLvaultAccess()
+# Authentication sessions. SFLvaultServer replaces it with the backend
+# selected in its settings.
+session_store = MemorySessionStore()
+stats.register('sessions', lambda: session_store.stats())
+# Login challenges sent by sflvault.login, keyed by username, waiting for
+# sflvault.authenticate.
+challenge_store = MemorySessionStore()
+stats.register('challenges', lambda: challenge_store.stats())
+stats.register('pubkey_cache', pubkey_cache.stats)
+stats.register('acl_cache', acl_cache.stats)
+stats.register('search_cache', search_cache_stats)
+stats.register('crypto_pool', crypto_pool.executor.stats)
+stats.register('keypair_pool', keypair_pool.pool.stats)
+
+def get_vault(request):
+    """Return a SFLvaultAccess acting on behalf of the request's caller."""
+    return SFLvaultAccess(request)
 
 def test_group_admin(request, group_id):
     if not query(Group).filter_by(id=group_id).first():
@@ -142,12 +159,7 @@ def _authenticated_user_first(request, cryptok):
     if not s:
         return vaultMsg(False, "Permission denied (%s)" % error_msg)
 
-    sess = s
-
-    if 'user_id' in sess:
-        vault.myself_id = sess['user_id']
-    if 'username' in sess:
-        vault.myself_username = sess['username']
+    request.set_user(s.get('user_id'), s.get('username'), s.get('is_admin', False))
 
 @decorator
 def authenticated_admin(func, request, *args, **kwargs):
@@ -159,14 +171,9 @@ def authenticated_admin(func, request, *args, **kwargs):
     ret = _authenticated_user_first(request, cryptok)
     if ret:
         return ret
-    try:
-        sess = get_session(cryptok, request)
-    except SessionNotFoundError:
-        sess = None
 
-    if sess:
-        if not sess['userobj'].is_admin:
-            return vaultMsg(False, "Permission denied, admin priv. required")
+    if not request.is_admin:
+        return vaultMsg(False, "Permission denied, admin priv. required")
 
     return func(request, *args, **kwargs)
 
@@ -203,21 +210,24 @@ def sflvault_authenticate(request, username, cryptok):
     except:
         return vaultMsg(False, 'Invalid user')
 
-    if u.logging_timeout < datetime.now():
-        return vaultMsg(False, 'Login token expired. Now: %s Timeout: %s' % (datetime.now(), u.logging_timeout))
+    # A challenge can only be answered once, right or wrong.
+    challenge = challenge_store.pop(username)
+    if not challenge:
+        return vaultMsg(False, 'Login token expired or not requested')
+
+    if challenge['timeout'] < datetime.now():
+        return vaultMsg(False, 'Login token expired. Now: %s Timeout: %s' % (datetime.now(), challenge['timeout']))
 
-    # str() necessary, to convert buffer to string.
-    if cryptok != str(u.logging_token):
+    if cryptok != challenge['token']:
         #TODO: Ask about this line.
         #raise Exception
         return vaultMsg(False, 'Authentication failed')
     else:
-        newtok = b64encode(randfunc(32))
-        set_session(newtok, {
+        newtok = session_store.create({
             'username': username,
             'timeout': datetime.now() + timedelta(0, int(settings['sflvault.vault.session_timeout'])),
             'remote_addr': request.get('REMOTE_ADDR', None),
-            'userobj': u,
+            'is_admin': u.is_admin,
             'user_id': u.id
         })
         return vaultMsg(True, 'Authentication successful', {'authtok': newtok})
@@ -234,8 +244,7 @@ def sflvault_login(request, username, version):
                         (MINIMAL_CLIENT_VERSION.vstring, version))
 
     # Return 'cryptok', encrypted with pubkey.
-    # Save decoded version to user's db field.
-    #transaction.begin()
+    # Save decoded version in the challenge store.
     try:
         #u = query(User).filter_by(username=username).one()
         u = meta.Session.query(User).filter_by(username=username).one()
@@ -244,19 +253,21 @@ def sflvault_login(request, username, version):
 
     # TODO: implement throttling ?
 
-    rnd = randfunc(32)
-    # 15 seconds to complete login/authenticate round-trip.
-    u.logging_timeout = datetime.now() + timedelta(0, 15)
-    u.logging_token = b64encode(rnd)
     if not u.pubkey:
         return vaultMsg(False, "User %s is not set up. Run user-setup first!" % username)
 
+    rnd = randfunc(32)
+    # 15 seconds to complete login/authenticate round-trip.
+    challenge_store.set(username, {
+        'token': b64encode(rnd),
+        'timeout': datetime.now() + timedelta(0, 15),
+        'user_id': u.id
+    })
+
     #a = meta.Session.query(User).filter_by(username=username).one()
     e = u.elgamal()
     cryptok = serial_elgamal_msg(e.encrypt(rnd, randfunc(32)))
 
-    transaction.commit()
-    #meta.Session.close()
     return vaultMsg(True, 'Authenticate please', {'cryptok': cryptok})
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.user_add')
@@ -266,163 +277,151 @@ def user_add(request, authtok, username, is_admin):
         setup_timeout = request['settings']['sflvault.vault.setup_timeout']
     except KeyError:
         setup_timeout = 300
-    return vault.user_add(username, is_admin, setup_timeout=setup_timeout)
+    return get_vault(request).user_add(username, is_admin, setup_timeout=setup_timeout)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.user_setup')
 def user_setup(request, username, pubkey):
-    return vault.user_setup(username, pubkey)
+    return get_vault(request).user_setup(username, pubkey)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.user_del')
 @authenticated_admin
 def sflvault_user_del(request, authtok, user):
-    return vault.user_del(user)
+    ret = get_vault(request).user_del(user)
+    if not ret['error']:
+        session_store.revoke_user(ret['user_id'])
+    return ret
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.user_list')
 @authenticated_user
 def sflvault_user_list(request, authtok, groups):
-    return vault.user_list(groups)
+    return get_vault(request).user_list(groups)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.machine_get')
 @xmlrpc_method(endpoint='sflvault', method='sflvault.machine.get')
 @authenticated_user
 def sflvault_machine_get(request, authtok, machine_id):
-    return vault.machine_get(machine_id)
+    return get_vault(request).machine_get(machine_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.machine_put')
 @authenticated_user
 def sflvault_machine_put(request, authtok, machine_id, data):
-    return vault.machine_put(machine_id, data)
+    return get_vault(request).machine_put(machine_id, data)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.service_get')
 @authenticated_user
 def sflvault_service_get(request, authtok, service_id, group_id=None):
-    return vault.service_get(service_id, group_id)
-
+    return get_vault(request).service_get(service_id, group_id)
 
-# si ça arrive via /jsonrpc .. on convertie en JSON en sortant
-# si ça arrive via /vault/rpc .. on convertie en XML-RPC
-#  XML-RPC faudrait qu'il passe simplement ses paramètres.. SAUF authtok
-#  - Donc doit gérer aussi le cas du login, ou le auth-tok est requis.
-
-#@rpc_view(method='sflvault.service_get', skip_first=False)
-#def sflvault_service_get(authtok, service_id, group_id=None):
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.service_get_tree')
 @authenticated_user
 def sflvault_service_get_tree(request, authtok, service_id, with_groups):
-    return vault.service_get_tree(service_id)
+    return get_vault(request).service_get_tree(service_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.service_put')
 @authenticated_user
 def sflvault_service_put(request, authtok, service_id, data):
-    # 'user_id' required in session.
-    # TODO: verify I had access to the service previously.
-    sess = get_session(authtok, request)
-    req = sql.join(servicegroups_table, usergroups_table,
-                    ServiceGroup.group_id == UserGroup.group_id) \
-                .join(users_table, User.id == UserGroup.user_id) \
-                .select() \
-                .where(User.id == sess['user_id']) \
-                .where(ServiceGroup.service_id == service_id)
-    res = list(meta.Session.execute(req))
-    if not res:
+    # Only members of the service's groups, global admins or not.
+    if not in_service_groups(request.user_id, service_id):
         return vaultMsg(False, "You don't have access to that service.")
     else:
-        return vault.service_put(service_id, data)
+        return get_vault(request).service_put(service_id, data)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.search')
 @authenticated_user
-def sflvault_search(request, authtok, search_query, group_ids, verbose, filters):
+def sflvault_search(request, authtok, search_query, group_ids, verbose, filters,
+                    limit=0, cursor=''):
     if group_ids and not filters:
         filters = {'groups': group_ids}
     if group_ids and isinstance(filters, dict) and 'groups' not in filters:
         # Please don't do that, use filters instead.
         filters['groups'] = group_ids
 
-    return vault.search(search_query, filters, verbose)
+    return get_vault(request).search(search_query, filters, verbose, limit,
+                                     cursor)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.service_add')
 @authenticated_user
 def sflvault_service_add(
         request, authtok, machine_id, parent_service_id, url, group_ids, secret, notes, metadata):
-    return vault.service_add(machine_id, parent_service_id, url, group_ids, secret, notes, metadata)
+    return get_vault(request).service_add(machine_id, parent_service_id, url, group_ids, secret, notes, metadata)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.service_del')
 @authenticated_admin
 def sflvault_service_del(request, authtok, service_id):
-    return vault.service_del(service_id)
+    return get_vault(request).service_del(service_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.service_list')
 @authenticated_user
 def sflvault_service_list(request, authtok, machine_id=None, customer_id=None):
-    return vault.service_list(machine_id, customer_id)
+    return get_vault(request).service_list(machine_id, customer_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.machine_add')
 @authenticated_user
 def sflvault_machine_add(request, authtok, customer_id, name, fqdn, ip, location, notes):
-    return vault.machine_add(customer_id, name, fqdn, ip, location, notes)
+    return get_vault(request).machine_add(customer_id, name, fqdn, ip, location, notes)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.machine_del')
 @authenticated_admin
 def sflvault_machine_del(request, authtok, machine_id):
-    return vault.machine_del(machine_id)
+    return get_vault(request).machine_del(machine_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.machine_list')
 @authenticated_user
 def sflvault_machine_list(request, authtok, customer_id=None):
-    return vault.machine_list(customer_id)
+    return get_vault(request).machine_list(customer_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.customer_get')
 @xmlrpc_method(endpoint='sflvault', method='sflvault.customer.get')
 @authenticated_user
 def sflvault_customer_get(request, authtok, customer_id):
-    return vault.customer_get(customer_id)
+    return get_vault(request).customer_get(customer_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.customer_put')
 @authenticated_user
 def sflvault_customer_put(request, authtok, customer_id, data):
-    return vault.customer_put(customer_id, data)
+    return get_vault(request).customer_put(customer_id, data)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.customer_add')
 @authenticated_user
 def sflvault_customer_add(request, authtok, customer_name):
-    return vault.customer_add(customer_name)
+    return get_vault(request).customer_add(customer_name)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.customer_del')
 @authenticated_admin
 def sflvault_customer_del(request, authtok, customer_id):
-    return vault.customer_del(customer_id)
+    return get_vault(request).customer_del(customer_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.customer_list')
 @authenticated_user
 def sflvault_customer_list(request, authtok):
-    return vault.customer_list()
+    return get_vault(request).customer_list()
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group_get')
 @authenticated_user
 def sflvault_group_get(request, authtok, group_id):
-    return vault.group_get(group_id)
+    return get_vault(request).group_get(group_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group_put')
 @authenticated_user
 def sflvault_group_put(request, authtok, group_id, data):
-    return vault.group_put(group_id, data)
+    return get_vault(request).group_put(group_id, data)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group_add')
 @authenticated_user
 def sflvault_group_add(request, authtok, group_name):
-    return vault.group_add(group_name)
+    return get_vault(request).group_add(group_name)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group_del')
 @authenticated_admin
 def sflvault_group_del(request, authtok, group_id, delete_cascade):
-    return vault.group_del(group_id,
-                           delete_cascade=delete_cascade)
+    return get_vault(request).group_del(group_id,
+                                        delete_cascade=delete_cascade)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group_add_service')
 @authenticated_user
 def sflvault_group_add_service(request, authtok, group_id, service_id, symkey):
-    return vault.group_add_service(group_id, service_id, symkey)
+    return get_vault(request).group_add_service(group_id, service_id, symkey)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group_del_service')
 @authenticated_user
@@ -430,12 +429,12 @@ def sflvault_group_del_service(request, authtok, group_id, service_id):
     fail = test_group_admin(request, group_id)
     if fail:
         return fail
-    return vault.group_del_service(group_id, service_id)
+    return get_vault(request).group_del_service(group_id, service_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group_add_user')
 @authenticated_user
 def sflvault_group_add_user(request, authtok, group_id, user, is_admin=False, cryptgroupkey=None):
-    return vault.group_add_user(group_id, user, is_admin, cryptgroupkey)
+    return get_vault(request).group_add_user(group_id, user, is_admin, cryptgroupkey)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group_del_user')
 @authenticated_user
@@ -443,54 +442,49 @@ def sflvault_group_del_user(request, authtok, group_id, user):
     fail = test_group_admin(request, group_id)
     if fail:
         return fail
-    return vault.group_del_user(group_id, user)
+    return get_vault(request).group_del_user(group_id, user)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group_list')
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group.list')
 @authenticated_user
 def sflvault_group_list(request, authtok, list_users=False):
-    return vault.group_list(False, list_users)
+    return get_vault(request).group_list(False, list_users)
+
+@xmlrpc_method(endpoint='sflvault', method='sflvault.server_stats')
+@authenticated_admin
+def sflvault_server_stats(request, authtok):
+    return vaultMsg(True, "Here are the server statistics",
+                    {'stats': stats.collect()})
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.service_passwd')
 @authenticated_user
 def sflvault_service_passwd(request, authtok, service_id, newsecret):
-    return vault.service_passwd(service_id, newsecret)
+    return get_vault(request).service_passwd(service_id, newsecret)
 
-#def _setup_sessions():
-#    """DRY out set_session and get_session"""
-#    if not hasattr(, 'vaultSessions'):
-#        .vaultSessions = {}
 def set_session(authtok, value):
-    """Sets in 'g.vaultSessions':
+    """Stores in the session store:
     {authtok1: {'username':  , 'timeout': datetime}, authtok2: {}..}
 
     """
-#   _setup_sessions();
-    vaultSessions[authtok] = value
+    session_store.set(authtok, value)
 
 def get_session(authtok, request):
     """Return the values associated with a session"""
-    #_setup_sessions();
+    sess = session_store.get(authtok)
 
-    if authtok not in vaultSessions:
+    if sess is None:
         raise SessionNotFoundError
-        return None
 
-    # XXX: where does the SESSION_TIMEOUT come from?
-    if 'timeout' not in vaultSessions[authtok]:
-        vaultSessions[authtok]['timeout'] = datetime.now() + timedelta(0, SESSION_TIMEOUT)
-
-    if vaultSessions[authtok]['timeout'] < datetime.now():
-        del(vaultSessions[authtok])
+    if sess['timeout'] < datetime.now():
+        session_store.expire(authtok)
         raise SessionExpiredError
-        return None
 
-    if vaultSessions[authtok]['remote_addr'] != request.get('REMOTE_ADDR', 'gibberish'):
-        del(vaultSessions[authtok])
+    if sess['remote_addr'] != request.get('REMOTE_ADDR', 'gibberish'):
+        session_store.delete(authtok)
         SessionSourceAddressMismatchError
         return None
 
-    return vaultSessions[authtok]
+    return sess
 
 class SessionNotFoundError(Exception):
     pass
@@ -0,0 +1,98 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+"""Benchmark encrypting for many groups, inline and in the crypto pool.
+
+Times encrypt_for() on a service key for 1, 10 and 50 groups, first with
+sflvault.crypto_workers = 0, then with a pool of processes. Groups share
+a pre-generated keypair of SFLVAULT_IN_TEST, as real ones take minutes to
+generate (each group still parses and caches it on its own):
+
+    python -m tests.bench_crypto_pool --processes 4 --repeat 5
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+
+os.environ['SFLVAULT_IN_TEST'] = 'true'
+
+from sflvault.common.crypto import (generate_elgamal_keypair, elgamal_pubkey,
+                                    serial_elgamal_pubkey, randfunc)
+
+from sflvault_server import model
+from sflvault_server.lib.crypto_pool import CryptoExecutor
+
+GROUPS = [1, 10, 50]
+
+
+def make_groups(count):
+    """Return `count` Groups sharing a public key, but no database"""
+    pubkey = serial_elgamal_pubkey(elgamal_pubkey(generate_elgamal_keypair()))
+    groups = []
+    for i in range(count):
+        group = model.Group()
+        group.id = i + 1
+        group.name = u'group%d' % group.id
+        group.pubkey = pubkey
+        groups.append(group)
+    return groups
+
+
+def run(executor, groups, message, repeat):
+    """Return the best time in ms to encrypt `message` for `groups`"""
+    executor.encrypt_for(groups, message)
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        executor.encrypt_for(groups, message)
+        elapsed = (time.time() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--processes', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    groups = make_groups(max(GROUPS))
+    message = randfunc(32)
+    serial = CryptoExecutor(0)
+    pooled = CryptoExecutor(args.processes)
+    pooled.start()
+    try:
+        print "%-8s %10s %10s %8s" % ('groups', 'serial ms',
+                                      '%d procs ms' % args.processes, 'speedup')
+        for count in GROUPS:
+            inline = run(serial, groups[:count], message, args.repeat)
+            pool = run(pooled, groups[:count], message, args.repeat)
+            print "%-8d %10.1f %10.1f %7.1fx" % (count, inline, pool,
+                                                 inline / pool)
+    finally:
+        pooled.shutdown()
+
+
+if __name__ == '__main__':
+    main()
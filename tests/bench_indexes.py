@@ -0,0 +1,173 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+"""Benchmark the lookups indexed by model.create_missing_indexes().
+
+Fills a fresh database without any index (as from before they were
+declared), prints the query plan and best time of each indexed lookup,
+then creates the indexes with create_missing_indexes() and does it again:
+
+    python -m tests.bench_indexes --services 100000
+    python -m tests.bench_indexes --url postgresql://localhost/bench
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import create_engine, text
+
+from sflvault_server import model
+from tests.bench_search import fill
+
+QUERIES = [
+    ('login username',
+     "SELECT id FROM users WHERE username = :username",
+     {'username': u'user250'}),
+    ('group membership',
+     "SELECT id FROM users_groups WHERE user_id = :user_id "
+     "AND group_id = :group_id",
+     {'user_id': 250, 'group_id': 100}),
+    ('group members',
+     "SELECT user_id FROM users_groups WHERE group_id = :group_id",
+     {'group_id': 100}),
+    ('has_access join',
+     "SELECT sg.id FROM users_groups ug JOIN services_groups sg "
+     "ON sg.group_id = ug.group_id "
+     "WHERE ug.user_id = :user_id AND sg.service_id = :service_id",
+     {'user_id': 250, 'service_id': 50000}),
+    ('groups of service',
+     "SELECT group_id FROM services_groups WHERE service_id = :service_id",
+     {'service_id': 50000}),
+    ('children of service',
+     "SELECT id FROM services WHERE parent_service_id = :service_id",
+     {'service_id': 50000}),
+    ('services of machine',
+     "SELECT id FROM services WHERE machine_id = :machine_id",
+     {'machine_id': 5000}),
+    ('machines of customer',
+     "SELECT id FROM machines WHERE customer_id = :customer_id",
+     {'customer_id': 500}),
+]
+
+
+def fill_access(engine, services, users, groups):
+    """Add users and groups, each user in 5 groups, each service in 2"""
+    rnd = random.Random(42)
+    conn = engine.connect()
+    conn.execute(model.users_table.insert(), [
+        {'id': u, 'username': u'user%d' % u} for u in range(users)])
+    conn.execute(model.groups_table.insert(), [
+        {'id': g, 'name': u'group%d' % g} for g in range(groups)])
+    conn.execute(model.usergroups_table.insert(), [
+        {'user_id': u, 'group_id': g}
+        for u in range(users) for g in rnd.sample(range(groups), 5)])
+    # Services whose id isn't a multiple of 10 are children of the one
+    # with the multiple of 10 below.
+    service_id = model.services_table.c.id
+    conn.execute(model.services_table.update()
+                 .where(service_id % 10 != 0)
+                 .values(parent_service_id=service_id - service_id % 10))
+    conn.execute(model.servicegroups_table.insert(), [
+        {'service_id': s, 'group_id': g}
+        for s in range(services) for g in rnd.sample(range(groups), 2)])
+    conn.close()
+
+
+def run(conn, sql, params, repeat):
+    """Return the best time in ms"""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        conn.execute(text(sql), **params).fetchall()
+        elapsed = (time.time() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def explain(conn, sql, params):
+    """Return the query plan, one line per step"""
+    if conn.dialect.name == 'sqlite':
+        return [r[-1] for r in conn.execute(text('EXPLAIN QUERY PLAN ' + sql),
+                                            **params)]
+    return [r[0] for r in conn.execute(text('EXPLAIN ' + sql), **params)]
+
+
+def report(engine, repeat):
+    conn = engine.connect()
+    try:
+        for name, sql, params in QUERIES:
+            print "%-22s %8.2f ms" % (name, run(conn, sql, params, repeat))
+            for step in explain(conn, sql, params):
+                print "    %s" % step
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--services', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--groups', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--url', help="Empty database to fill (default: a "
+                                      "temporary SQLite file)")
+    args = parser.parse_args()
+
+    path = None
+    if not args.url:
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        args.url = 'sqlite:///' + path
+    engine = create_engine(args.url)
+    model.metadata.drop_all(engine)
+    for table in model.metadata.sorted_tables:
+        table.create(engine)
+        for index in table.indexes:
+            index.drop(engine)
+    try:
+        start = time.time()
+        fill(engine, args.services)
+        fill_access(engine, args.services, args.users, args.groups)
+        elapsed = time.time() - start
+        print "Filled %d services in %.1f s" % (args.services, elapsed)
+
+        print "\nWithout indexes:"
+        report(engine, args.repeat)
+
+        start = time.time()
+        created = model.create_missing_indexes(engine)
+        elapsed = time.time() - start
+        print "\nCreated %d indexes in %.1f s" % (len(created), elapsed)
+
+        print "\nWith indexes:"
+        report(engine, args.repeat)
+    finally:
+        model.metadata.drop_all(engine)
+        engine.dispose()
+        if path:
+            os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
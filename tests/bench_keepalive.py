@@ -0,0 +1,129 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Benchmark login, authenticate and show over TLS, with and without
+persistent connections (sflvault.keepalive_timeout).
+
+Starts a threaded server on a temporary database and a self-signed
+certificate, adds a service, then times sequences of sflvault.login,
+sflvault.authenticate and sflvault.service_get_tree (what `sflvault show`
+asks for) from a client reusing its ServerProxy: without keep-alive, each
+call is a new connection and a full TLS handshake.
+
+    python -m tests.bench_keepalive --sequences 200
+"""
+
+import argparse
+import os
+import shutil
+import ssl
+import tempfile
+import threading
+import time
+import xmlrpclib
+from base64 import b64encode
+
+from Crypto.PublicKey import ElGamal
+
+from sflvault.common.crypto import randfunc, serial_elgamal_pubkey, \
+    elgamal_pubkey, unserial_elgamal_msg
+from sflvault_server import SFLvaultServer, http_counters
+from tests.server import make_certificate
+
+INI = """[sflvault]
+sflvault.host = 127.0.0.1
+sflvault.port = %(port)d
+sflvault.server_mode = threaded
+sflvault.keyfile = %(here)s/host.key
+sflvault.certfile = %(here)s/host.cert
+sflvault.vault.session_file = %(here)s/sessions.db
+sqlalchemy.url = sqlite:///%(here)s/vault.db
+"""
+
+
+def login(proxy, key):
+    r = proxy.sflvault.login('admin', '0.8')
+    token = key.decrypt(unserial_elgamal_msg(r['cryptok'])).rjust(32, chr(0))
+    r = proxy.sflvault.authenticate('admin', b64encode(token))
+    assert not r['error'], r
+    return r['authtok']
+
+
+def run(url, key, service_id, sequences):
+    """Return the mean time of a login, authenticate and show, in ms"""
+    proxy = xmlrpclib.ServerProxy(url, context=ssl._create_unverified_context())
+    start = time.time()
+    for i in range(sequences):
+        authtok = login(proxy, key)
+        r = proxy.sflvault.service_get_tree(authtok, service_id, False)
+        assert not r['error'], r
+    elapsed = time.time() - start
+    proxy('close')()
+    return elapsed * 1000 / sequences
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sequences', type=int, default=100)
+    parser.add_argument('--port', type=int, default=5799)
+    args = parser.parse_args()
+
+    here = tempfile.mkdtemp()
+    try:
+        make_certificate(here)
+        ini = os.path.join(here, 'bench.ini')
+        with open(ini, 'w') as f:
+            f.write(INI % {'here': here, 'port': args.port})
+        vault = SFLvaultServer(ini)
+        server = vault.server
+        server.keepalive_timeout = 5
+        thread = threading.Thread(target=vault.start_server)
+        thread.setDaemon(True)
+        thread.start()
+
+        url = 'https://127.0.0.1:%d/vault' % args.port
+        proxy = xmlrpclib.ServerProxy(url, context=ssl._create_unverified_context())
+        key = ElGamal.generate(512, randfunc)
+        proxy.sflvault.user_setup('admin', serial_elgamal_pubkey(elgamal_pubkey(key)))
+        authtok = login(proxy, key)
+        group_id = proxy.sflvault.group_add(authtok, 'bench')['group_id']
+        # Generating the group's keypair may outlast the session.
+        authtok = login(proxy, key)
+        customer_id = proxy.sflvault.customer_add(authtok, 'bench')['customer_id']
+        machine_id = proxy.sflvault.machine_add(authtok, customer_id, 'bench', 'bench.example.com',
+                                                '10.0.0.1', '', '')['machine_id']
+        service_id = proxy.sflvault.service_add(authtok, machine_id, 0, 'ssh://root@bench', [group_id],
+                                                'secret', '', {})['service_id']
+
+        print "%-14s %12s %14s" % ('', 'sequence ms', 'connections')
+        for keepalive in (0, 5):
+            server.keepalive_timeout = keepalive
+            before = http_counters.stats()['connections']
+            mean = run(url, key, service_id, args.sequences)
+            print "%-14s %12.1f %14d" % ('keep-alive' if keepalive else 'no keep-alive',
+                                         mean, http_counters.stats()['connections'] - before)
+        server.shutdown()
+        thread.join()
+    finally:
+        shutil.rmtree(here)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Benchmark searches with and without sflvault.vault.search_index.
+
+Fills a fresh database with a vault of realistic names, addresses and
+urls, then times fragment queries both ways, and counts the rows only one
+of them returns. The index matches the start of words (or any part of host
+names, addresses and urls), where scans match any part of any field:
+
+    python -m tests.bench_search --services 200000
+    python -m tests.bench_search --url postgresql://localhost/bench
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import transaction
+from sqlalchemy import create_engine
+
+from sflvault_server import model
+from sflvault_server.model import meta
+
+QUERIES = [
+    ['10.2.3'],
+    ['192.168.1'],
+    ['.4.1'],
+    ['db-prod'],
+    ['prod-0'],
+    ['client42'],
+    ['example'],
+    [':8443'],
+    ['root@web'],
+    ['mysql', 'prod'],
+    ['montreal', 'db'],
+]
+
+ROLES = ['web', 'db', 'mail', 'vpn', 'backup', 'lb', 'app']
+STAGES = ['prod', 'staging', 'dev']
+CITIES = [u'Montreal', u'Quebec', u'Toronto', u'Paris']
+
+
+def fill(engine, services):
+    """Add `services` services, 10 per machine, 10 machines per customer"""
+    rnd = random.Random(42)
+    machines = max(services // 10, 1)
+    customers = max(machines // 10, 1)
+    conn = engine.connect()
+    conn.execute(model.customers_table.insert(), [
+        {'id': c, 'name': u'Client%d Inc.' % c} for c in range(customers)])
+    rows = []
+    for m in range(machines):
+        name = '%s-%s-%02d' % (rnd.choice(ROLES), rnd.choice(STAGES), m % 100)
+        rows.append({'id': m, 'customer_id': m % customers, 'name': name,
+                     'fqdn': '%s.client%d.example.com' % (name, m % customers),
+                     'ip': '10.%d.%d.%d' % (rnd.randint(0, 9), rnd.randint(0, 9),
+                                            rnd.randint(1, 254))
+                           if m % 4 else '192.168.%d.%d' % (rnd.randint(0, 9),
+                                                            rnd.randint(1, 254)),
+                     'location': rnd.choice(CITIES)})
+    conn.execute(model.machines_table.insert(), rows)
+    urls = ['ssh://root@%s', 'https://admin@%s:8443/', 'mysql://app@%s/app',
+            'ssh://deploy@%s', 'vnc://%s']
+    conn.execute(model.services_table.insert(), [
+        {'id': s, 'machine_id': s % machines,
+         'url': rnd.choice(urls) % rows[s % machines]['fqdn'],
+         'notes': u'Service %d' % s} for s in range(services)])
+    conn.close()
+
+
+def run(words, repeat):
+    """Return (best time in ms, result rows)"""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        rows = set((r.customers_id, r.machines_id, r.services_id)
+                   for r in model.search_query(words))
+        elapsed = (time.time() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--services', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--url', help="Empty database to fill (default: a "
+                                      "temporary SQLite file)")
+    args = parser.parse_args()
+
+    path = None
+    if not args.url:
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        args.url = 'sqlite:///' + path
+    engine = create_engine(args.url)
+    model.init_model(engine)
+    meta.metadata.drop_all(engine)
+    # The full-text tables are only created along with search_documents
+    # while the index is enabled, the PostgreSQL indexes afterwards.
+    model.search_index_enabled = True
+    meta.metadata.create_all(engine)
+    model.create_missing_search_index(engine)
+    try:
+        start = time.time()
+        fill(engine, args.services)
+        elapsed = time.time() - start
+        print "Filled %d services in %.1f s" % (args.services, elapsed)
+        start = time.time()
+        model.rebuild_search()
+        transaction.commit()
+        print "Built the search index in %.1f s" % (time.time() - start)
+
+        print "%-16s %8s %10s %10s %8s %8s" % (
+            'query', 'rows', 'scan ms', 'index ms', 'missing', 'extra')
+        for words in QUERIES:
+            model.search_index_enabled = False
+            scan, expected = run(words, args.repeat)
+            model.search_index_enabled = True
+            indexed, rows = run(words, args.repeat)
+            print "%-16s %8d %10.1f %10.1f %8d %8d" % (
+                ' '.join(words), len(expected), scan, indexed,
+                len(expected - rows), len(rows - expected))
+            transaction.abort()
+    finally:
+        meta.Session.remove()
+        if path:
+            os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
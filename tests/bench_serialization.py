@@ -0,0 +1,120 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Benchmark encoding and decoding responses as XML-RPC and as JSON-RPC.
+
+Fills a fresh database with tests/bench_search.py's vault, and groups and
+users, then times marshalling the responses of sflvault.search,
+sflvault.group_list and sflvault.user_list both ways (xmlrpclib, and
+sflvault_server.lib.jsonrpc with json), as the server and a Python client
+do:
+
+    python -m tests.bench_serialization --services 20000 --users 500
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+import xmlrpclib
+from datetime import datetime
+
+import transaction
+from sqlalchemy import create_engine
+
+from sflvault_server import model
+from sflvault_server.lib import jsonrpc
+from sflvault_server.lib.context import RequestContext
+from sflvault_server.lib.vault import SFLvaultAccess
+from sflvault_server.model import meta
+from tests.bench_search import fill
+
+
+def fill_groups(engine, groups, users):
+    """Add `groups` groups and `users` users, each in 5 groups"""
+    conn = engine.connect()
+    conn.execute(model.groups_table.insert(), [
+        {'id': g, 'name': u'Group %d' % g, 'hidden': False, 'pubkey': 'x' * 300}
+        for g in range(1, groups + 1)])
+    conn.execute(model.users_table.insert(), [
+        {'id': u, 'username': u'user%d' % u, 'is_admin': u == 1,
+         'created_time': datetime.now(), 'pubkey': 'x' * 300}
+        for u in range(1, users + 1)])
+    conn.execute(model.usergroups_table.insert(), [
+        {'user_id': u, 'group_id': (u * 7 + i) % groups + 1, 'is_admin': i == 0,
+         'cryptgroupkey': 'x' * 200}
+        for u in range(1, users + 1) for i in range(5)])
+    conn.close()
+
+
+def best(function, repeat):
+    """Return the best time of `function`, in ms, and its result"""
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        result = function()
+        times.append((time.time() - start) * 1000)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--services', type=int, default=20000)
+    parser.add_argument('--groups', type=int, default=100)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    engine = create_engine('sqlite:///' + path)
+    model.init_model(engine)
+    meta.metadata.create_all(engine)
+    try:
+        fill(engine, args.services)
+        fill_groups(engine, args.groups, args.users)
+        context = RequestContext()
+        context.set_user(1, u'user1', True)
+        vault = SFLvaultAccess(context)
+        payloads = [
+            ('search', vault.search(['example'], verbose=True)),
+            ('group_list', vault.group_list()),
+            ('user_list', vault.user_list(groups=True)),
+        ]
+        transaction.abort()
+
+        print "%-12s %-8s %10s %10s %10s" % ('', '', 'bytes', 'encode ms', 'decode ms')
+        for name, payload in payloads:
+            encode, data = best(lambda: xmlrpclib.dumps((payload,), methodresponse=True,
+                                                        allow_none=True), args.repeat)
+            decode, _ = best(lambda: xmlrpclib.loads(data), args.repeat)
+            print "%-12s %-8s %10d %10.1f %10.1f" % (name, 'XML-RPC', len(data), encode, decode)
+            encode, data = best(lambda: jsonrpc.dumps({'jsonrpc': '2.0', 'id': 1,
+                                                       'result': payload}), args.repeat)
+            decode, _ = best(lambda: json.loads(data), args.repeat)
+            print "%-12s %-8s %10d %10.1f %10.1f" % ('', 'JSON-RPC', len(data), encode, decode)
+    finally:
+        meta.Session.remove()
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Benchmark session lookups under contention.
+
+Fills each session backend (memory, sqlite, signed, and signed with its
+revocations in an SQLite vault database) with sessions, then times get()
+on random tokens from several threads, then several processes, at once:
+
+    python -m tests.bench_sessions --sessions 10000 --lookups 2000 --concurrency 1 4 16
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+
+from sflvault_server.lib.sessions import MemorySessionStore, SQLiteSessionStore, \
+    SignedTokenSessionStore
+
+
+def make_stores(directory):
+    engine = create_engine('sqlite:///%s/vault.db' % directory)
+    return [
+        ('memory', lambda: MemorySessionStore()),
+        ('sqlite', lambda: SQLiteSessionStore('%s/sessions.db' % directory)),
+        ('signed', lambda: SignedTokenSessionStore('secret', 3600)),
+        ('signed+db', lambda: SignedTokenSessionStore('secret', 3600, engine)),
+    ]
+
+
+def fill(store, sessions):
+    """Return the tokens of `sessions` new sessions"""
+    timeout = datetime.now() + timedelta(0, 3600)
+    return [store.create({'username': u'user%d' % i, 'user_id': i,
+                          'timeout': timeout, 'remote_addr': '127.0.0.1',
+                          'is_admin': False})
+            for i in range(sessions)]
+
+
+def lookups(store, tokens, count, seed):
+    """Return the latencies of `count` get() on random tokens, in seconds"""
+    rnd = random.Random(seed)
+    latencies = []
+    for i in range(count):
+        authtok = rnd.choice(tokens)
+        start = time.time()
+        assert store.get(authtok) is not None
+        latencies.append(time.time() - start)
+    return latencies
+
+
+def run_threads(store, tokens, count, concurrency):
+    results = []
+
+    def worker(seed):
+        results.extend(lookups(store, tokens, count, seed))
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def run_processes(store, tokens, count, concurrency):
+    # Forked after filling the store: memory stores are copied, others are
+    # shared.
+    queue = multiprocessing.Queue()
+
+    def worker(seed):
+        queue.put(lookups(store, tokens, count, seed))
+    processes = [multiprocessing.Process(target=worker, args=(i,))
+                 for i in range(concurrency)]
+    for p in processes:
+        p.start()
+    results = []
+    for p in processes:
+        results.extend(queue.get())
+    for p in processes:
+        p.join()
+    return results
+
+
+def summary(latencies, elapsed):
+    latencies = sorted(latencies)
+    n = len(latencies)
+    return "%8.1f %8.1f %8.1f %10.0f" % (
+        sum(latencies) / n * 1e6, latencies[n // 2] * 1e6,
+        latencies[min(n - 1, n * 99 // 100)] * 1e6, n / elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sessions', type=int, default=10000)
+    parser.add_argument('--lookups', type=int, default=2000,
+                        help="get() calls by each thread or process")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        print "%-10s %-10s %4s %8s %8s %8s %10s" % (
+            'backend', 'mode', 'n', 'mean us', 'p50 us', 'p99 us', 'gets/s')
+        for name, factory in make_stores(directory):
+            store = factory()
+            tokens = fill(store, args.sessions)
+            for mode, run in [('threads', run_threads), ('processes', run_processes)]:
+                for concurrency in args.concurrency:
+                    start = time.time()
+                    latencies = run(store, tokens, args.lookups, concurrency)
+                    print "%-10s %-10s %4d %s" % (name, mode, concurrency,
+                                                  summary(latencies, time.time() - start))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import random
+from datetime import datetime
+from unittest import TestCase
+
+import transaction
+
+from sflvault_server import model
+from sflvault_server.lib.context import RequestContext
+from sflvault_server.lib.vault import SFLvaultAccess
+from sflvault_server.model import meta, query, User, Group, Service, \
+    UserGroup, ServiceGroup
+from tests.server import ModelFixtures
+
+
+class AccessTests(ModelFixtures):
+    """Access checks, with the ACL cache of size `acl_cache_size`, using
+    user_service_access if `access_table`"""
+
+    acl_cache_size = 0
+    access_table = False
+
+    def setUp(self):
+        self.old_size = model.acl_cache.maxsize
+        model.acl_cache.maxsize = self.acl_cache_size
+        model.acl_cache.clear()
+        self.old_access_table = model.access_table_enabled
+        model.access_table_enabled = self.access_table
+
+        suffix = str(random.randint(0, 100000))
+        self.user = self.add(User(), username=u'acl_user_' + suffix,
+                             created_time=datetime.now(), is_admin=False)
+        self.admin = self.add(User(), username=u'acl_admin_' + suffix,
+                              created_time=datetime.now(), is_admin=True)
+        self.group = self.add(Group(), name=u'acl_group_' + suffix)
+        self.other_group = self.add(Group(), name=u'acl_other_' + suffix)
+        self.service = self.add(Service(), url='ssh://acl' + suffix)
+        self.other_service = self.add(Service(), url='ssh://acl_other' + suffix)
+        self.add(UserGroup(), user_id=self.user, group_id=self.group)
+        self.add(UserGroup(), user_id=self.admin, group_id=self.other_group)
+        self.add(ServiceGroup(), service_id=self.service, group_id=self.group)
+        self.add(ServiceGroup(), service_id=self.service,
+                 group_id=self.other_group)
+        model.refresh_access()
+        transaction.commit()
+
+    def tearDown(self):
+        model.acl_cache.maxsize = self.old_size
+        model.acl_cache.clear()
+        services = [self.service, self.other_service]
+        groups = [self.group, self.other_group]
+        query(ServiceGroup).filter(ServiceGroup.service_id.in_(services))\
+            .delete(synchronize_session=False)
+        query(UserGroup).filter(UserGroup.group_id.in_(groups))\
+            .delete(synchronize_session=False)
+        query(Service).filter(Service.id.in_(services))\
+            .delete(synchronize_session=False)
+        query(Group).filter(Group.id.in_(groups))\
+            .delete(synchronize_session=False)
+        query(User).filter(User.id.in_([self.user, self.admin]))\
+            .delete(synchronize_session=False)
+        model.refresh_access()
+        transaction.commit()
+        model.access_table_enabled = self.old_access_table
+
+    def test_member(self):
+        self.assertTrue(model.has_access(self.user, self.service))
+        self.assertTrue(model.in_service_groups(self.user, self.service))
+
+    def test_not_member(self):
+        self.assertFalse(model.has_access(self.user, self.other_service))
+        self.assertFalse(model.in_service_groups(self.user, self.other_service))
+
+    def test_admin(self):
+        self.assertTrue(model.has_access(self.admin, self.other_service))
+        # Being global admin doesn't put you in the service's groups
+        self.assertFalse(model.in_service_groups(self.admin, self.other_service))
+        self.assertTrue(model.in_service_groups(self.admin, self.service))
+
+    def test_string_service_id(self):
+        self.assertTrue(model.has_access(self.user, str(self.service)))
+
+    def test_group_del_service(self):
+        self.assertTrue(model.has_access(self.user, self.service))
+        context = RequestContext()
+        context.set_user(self.admin, u'admin', True)
+        ret = SFLvaultAccess(context).group_del_service(self.group,
+                                                        self.service)
+        self.assertFalse(ret['error'], ret['message'])
+        self.assertFalse(model.has_access(self.user, self.service))
+
+
+class TestAccess(AccessTests, TestCase):
+    pass
+
+
+class TestCachedAccess(AccessTests, TestCase):
+
+    acl_cache_size = 10
+
+    def test_cached(self):
+        self.assertFalse(model.has_access(self.user, self.other_service))
+        self.add(ServiceGroup(), service_id=self.other_service,
+                 group_id=self.group)
+        transaction.commit()
+        self.assertFalse(model.has_access(self.user, self.other_service))
+        model.forget_access(self.user)
+        self.assertTrue(model.has_access(self.user, self.other_service))
+
+
+class TestAccessTable(AccessTests, TestCase):
+
+    access_table = True
+
+    def test_consistent(self):
+        self.assertEqual(model.check_access(), ([], []))
+        context = RequestContext()
+        context.set_user(self.admin, u'admin', True)
+        SFLvaultAccess(context).group_del_service(self.group, self.service)
+        self.assertEqual(model.check_access(), ([], []))
+
+    def test_check(self):
+        usa = model.user_service_access_table
+        meta.Session.execute(usa.delete().where(
+            usa.c.user_id == self.user))
+        meta.Session.execute(usa.insert().values(
+            user_id=self.user, service_id=self.other_service,
+            group_id=self.group))
+        missing, extra = model.check_access()
+        self.assertEqual([row[:3] for row in missing],
+                         [(self.user, self.service, self.group)])
+        self.assertEqual([row[:3] for row in extra],
+                         [(self.user, self.other_service, self.group)])
+        transaction.abort()
@@ -0,0 +1,104 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from unittest import TestCase
+
+from sflvault.common.crypto import generate_elgamal_keypair, \
+    serial_elgamal_pubkey, elgamal_pubkey
+
+from sflvault_server.lib.cache import LRUCache
+from sflvault_server.model import cached_elgamal, forget_elgamal, \
+    pubkey_cache
+
+
+class TestLRUCache(TestCase):
+
+    def test_get_and_set(self):
+        cache = LRUCache(2)
+        self.assertEqual(cache.get('a'), None)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats(), {'size': 1, 'hits': 1, 'misses': 1})
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+
+    def test_sizes(self):
+        cache = LRUCache(2, sizeof=len)
+        cache.set('a', 'xx')
+        cache.set('b', 'yyy')
+        cache.set('a', 'x')
+        self.assertEqual(cache.stats()['bytes'], 4)
+        cache.set('c', 'zzzz')
+        self.assertEqual(cache.stats()['bytes'], 5)
+        cache.discard('a')
+        self.assertEqual(cache.stats()['bytes'], 4)
+        cache.clear()
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+    def test_discard(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.discard('a')
+        cache.discard('a')
+        self.assertEqual(cache.get('a'), None)
+
+    def test_disabled(self):
+        cache = LRUCache(0)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), None)
+
+
+class TestPubkeyCache(TestCase):
+
+    def setUp(self):
+        pubkey_cache.clear()
+        self.pubkey = serial_elgamal_pubkey(
+            elgamal_pubkey(generate_elgamal_keypair()))
+
+    def test_parsed_once(self):
+        e = cached_elgamal('User', 1, self.pubkey)
+        self.assertTrue(cached_elgamal('User', 1, self.pubkey) is e)
+        self.assertEqual(serial_elgamal_pubkey(elgamal_pubkey(e)),
+                         self.pubkey)
+
+    def test_entities_are_separate(self):
+        e = cached_elgamal('User', 1, self.pubkey)
+        self.assertFalse(cached_elgamal('Group', 1, self.pubkey) is e)
+
+    def test_changed_pubkey(self):
+        e = cached_elgamal('User', 1, self.pubkey)
+        # Test keypairs are picked among two, so make sure this one differs.
+        p, g, y = elgamal_pubkey(generate_elgamal_keypair())
+        other = serial_elgamal_pubkey((p, g, y + 1))
+        self.assertFalse(cached_elgamal('User', 1, other) is e)
+
+    def test_forget(self):
+        e = cached_elgamal('User', 1, self.pubkey)
+        forget_elgamal('User', 1, self.pubkey)
+        self.assertFalse(cached_elgamal('User', 1, self.pubkey) is e)
@@ -0,0 +1,99 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import httplib
+import xmlrpclib
+import zlib
+from unittest import TestCase
+
+from sflvault_server import SFLvaultRequestHandler, http_counters
+from tests.server import start_test_server, stop_test_server
+
+
+class TestCompression(TestCase):
+
+    def setUp(self):
+        # sflvault.login's answers are small.
+        self.server = start_test_server(compress_threshold=100)
+        self.body = xmlrpclib.dumps(('nobody', '0.8'), 'sflvault.login')
+
+    def tearDown(self):
+        stop_test_server(self.server)
+
+    def post(self, headers, body=None):
+        """Return the response, and its body"""
+        conn = httplib.HTTPConnection(*self.server.server_address)
+        headers['Content-Type'] = 'text/xml'
+        conn.request('POST', '/vault', body or self.body, headers)
+        response = conn.getresponse()
+        return response, response.read()
+
+    def result(self, body):
+        result = xmlrpclib.loads(body)[0][0]
+        self.assertTrue(result['message'].startswith('User unknown'))
+
+    def test_gzip(self):
+        before = http_counters.stats()
+        response, body = self.post({'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.getheader('Content-Encoding'), 'gzip')
+        self.result(zlib.decompress(body, 16 + zlib.MAX_WBITS))
+        after = http_counters.stats()
+        self.assertEqual(after['compressed_responses'] - before['compressed_responses'], 1)
+        self.assertTrue(after['bytes_saved'] > before['bytes_saved'])
+
+    def test_deflate(self):
+        response, body = self.post({'Accept-Encoding': 'gzip;q=0.5, deflate'})
+        self.assertEqual(response.getheader('Content-Encoding'), 'deflate')
+        self.result(zlib.decompress(body))
+
+    def test_not_accepted(self):
+        for accept in ['identity', 'gzip;q=0', 'br']:
+            response, body = self.post({'Accept-Encoding': accept})
+            self.assertEqual(response.getheader('Content-Encoding'), None)
+            self.result(body)
+
+    def test_threshold(self):
+        self.server.compress_threshold = 10000
+        response, body = self.post({'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.getheader('Content-Encoding'), None)
+        self.result(body)
+        self.server.compress_threshold = None
+        response, body = self.post({'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.getheader('Content-Encoding'), None)
+
+    def test_request(self):
+        for coding, wbits in [('gzip', 16 + zlib.MAX_WBITS), ('deflate', zlib.MAX_WBITS)]:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+            data = compressor.compress(self.body) + compressor.flush()
+            response, body = self.post({'Content-Encoding': coding}, data)
+            self.assertEqual(response.status, 200)
+            self.result(body)
+
+    def test_bad_request(self):
+        response, body = self.post({'Content-Encoding': 'gzip'}, 'not gzip')
+        self.assertEqual(response.status, 400)
+
+    def test_request_too_large(self):
+        class Handler(SFLvaultRequestHandler):
+            max_request_size = 100
+        self.server.RequestHandlerClass = Handler
+        data = zlib.compress(self.body)
+        response, body = self.post({'Content-Encoding': 'deflate'}, data)
+        self.assertEqual(response.status, 413)
@@ -0,0 +1,68 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from unittest import TestCase
+
+from sflvault.common.crypto import generate_elgamal_keypair, \
+    serial_elgamal_pubkey, elgamal_pubkey, decrypt_longmsg
+
+from sflvault_server.lib.crypto_pool import CryptoExecutor
+from sflvault_server.model import Group, User
+
+
+def recipient(cls, id):
+    keys = generate_elgamal_keypair()
+    r = cls()
+    r.id = id
+    r.pubkey = serial_elgamal_pubkey(elgamal_pubkey(keys))
+    return r, keys
+
+
+class TestCryptoExecutor(TestCase):
+
+    def setUp(self):
+        self.recipients = [recipient(Group, 1), recipient(Group, 2),
+                           recipient(User, 1)]
+
+    def check(self, executor):
+        out = executor.encrypt_for([r for r, keys in self.recipients],
+                                   'secret key')
+        self.assertEqual(len(out), len(self.recipients))
+        for (r, keys), encrypted in zip(self.recipients, out):
+            self.assertEqual(decrypt_longmsg(keys, encrypted), 'secret key')
+
+    def test_inline(self):
+        executor = CryptoExecutor(0)
+        executor.start()
+        self.check(executor)
+        self.assertEqual(executor.stats(),
+                         {'processes': 0, 'batches': 0, 'encryptions': 3})
+
+    def test_pool(self):
+        executor = CryptoExecutor(2)
+        executor.start()
+        try:
+            self.check(executor)
+            self.assertEqual(executor.stats(),
+                             {'processes': 2, 'batches': 1, 'encryptions': 3})
+        finally:
+            executor.shutdown()
+        # Encrypts inline once stopped.
+        self.check(executor)
@@ -0,0 +1,68 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import sqlalchemy
+from sqlalchemy import create_engine
+
+from sflvault_server import model
+
+
+class TestCreateMissingIndexes(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite:///%s' %
+                                    os.path.join(self.tmpdir, 'vault.db'))
+        # A database from before the indexes existed.
+        for table in model.metadata.sorted_tables:
+            table.create(self.engine)
+            for index in table.indexes:
+                index.drop(self.engine)
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def indexes(self, table):
+        return set(i['name'] for i in
+                   sqlalchemy.inspect(self.engine).get_indexes(table))
+
+    def test_creates_missing(self):
+        self.assertEqual(self.indexes('services'), set())
+        created = model.create_missing_indexes(self.engine)
+        self.assertTrue('users_username' in created)
+        self.assertEqual(self.indexes('services'),
+                         set(['services_parent_service_id',
+                              'services_machine_id']))
+        # Nothing left to do
+        self.assertEqual(model.create_missing_indexes(self.engine), [])
+
+    def test_duplicate_usernames(self):
+        users = model.users_table
+        self.engine.execute(users.insert(), [{'username': u'bob'},
+                                             {'username': u'bob'}])
+        created = model.create_missing_indexes(self.engine)
+        self.assertFalse('users_username' in created)
+        self.assertTrue('services_machine_id' in created)
@@ -0,0 +1,196 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import httplib
+import json
+import random
+import xmlrpclib
+from base64 import b64encode
+from datetime import datetime
+from unittest import TestCase
+
+import transaction
+from sflvault.common.crypto import generate_elgamal_keypair, elgamal_pubkey, \
+    serial_elgamal_pubkey, unserial_elgamal_msg
+
+from sflvault_server.lib import jsonrpc
+from sflvault_server.model import meta, query, refresh_search, User, \
+    Customer, Machine
+from tests.server import start_test_server, stop_test_server
+
+
+class TestJSONRPC(TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def dispatch(self, method, params):
+        self.calls.append((method, params))
+        if method == 'fail':
+            raise ValueError('failed')
+        if method == 'fault':
+            raise xmlrpclib.Fault(42, 'fault')
+        return {'method': method, 'params': params}
+
+    def call(self, request):
+        data = request if isinstance(request, basestring) else json.dumps(request)
+        response = jsonrpc.marshaled_dispatch(data, self.dispatch,
+                                              ['echo', 'fail', 'fault'])
+        return response and json.loads(response)
+
+    def test_call(self):
+        response = self.call({'jsonrpc': '2.0', 'method': 'echo', 'params': [1, 'a'], 'id': 3})
+        self.assertEqual(response, {'jsonrpc': '2.0', 'id': 3,
+                                    'result': {'method': 'echo', 'params': [1, 'a']}})
+        self.assertEqual(self.calls, [('echo', (1, 'a'))])
+
+    def test_errors(self):
+        for request, code in [
+                ('{', jsonrpc.PARSE_ERROR),
+                ([], jsonrpc.INVALID_REQUEST),
+                ({'method': 'echo', 'id': 1}, jsonrpc.INVALID_REQUEST),
+                ({'jsonrpc': '2.0', 'method': 'nope', 'id': 1}, jsonrpc.METHOD_NOT_FOUND),
+                ({'jsonrpc': '2.0', 'method': 'echo', 'params': {'a': 1}, 'id': 1},
+                 jsonrpc.INVALID_PARAMS),
+                ({'jsonrpc': '2.0', 'method': 'fail', 'id': 1}, jsonrpc.INTERNAL_ERROR),
+                ({'jsonrpc': '2.0', 'method': 'fault', 'id': 1}, 42),
+                ({'jsonrpc': '2.0', 'method': 'echo', 'id': True},
+                 jsonrpc.INVALID_REQUEST)]:
+            self.assertEqual(self.call(request)['error']['code'], code)
+
+    def test_arity(self):
+        def method(request, a, b=None):
+            return a
+        methods = {'method': method}
+        for params, code in [([], jsonrpc.INVALID_PARAMS),
+                             ([1], None),
+                             ([1, 2], None),
+                             ([1, 2, 3], jsonrpc.INVALID_PARAMS)]:
+            response = json.loads(jsonrpc.marshaled_dispatch(
+                json.dumps({'jsonrpc': '2.0', 'method': 'method',
+                            'params': params, 'id': 1}),
+                lambda name, params: methods[name](None, *params), methods))
+            self.assertEqual(response.get('error', {}).get('code'), code)
+
+    def test_notifications_and_batch(self):
+        self.assertEqual(self.call({'jsonrpc': '2.0', 'method': 'echo'}), None)
+        response = self.call([{'jsonrpc': '2.0', 'method': 'echo', 'params': [1], 'id': 'a'},
+                              {'jsonrpc': '2.0', 'method': 'echo', 'params': [2]},
+                              {'jsonrpc': '2.0', 'method': 'nope', 'id': 'b'}])
+        self.assertEqual([r['id'] for r in response], ['a', 'b'])
+        self.assertEqual(response[0]['result']['params'], [1])
+        self.assertEqual(response[1]['error']['code'], jsonrpc.METHOD_NOT_FOUND)
+        self.assertEqual(len(self.calls), 3)
+
+    def test_encoding(self):
+        when = datetime(2014, 5, 8, 10, 30, 15)
+        self.assertEqual(json.loads(jsonrpc.dumps({
+            'secret_last_modified': when,
+            'created_stamp': xmlrpclib.DateTime(when),
+            'binary': xmlrpclib.Binary('\x00\xff'),
+        })), {
+            'secret_last_modified': '2014-05-08T10:30:15',
+            'created_stamp': '2014-05-08T10:30:15',
+            'binary': 'AP8=',
+        })
+
+
+class TestJSONRPCEndpoint(TestCase):
+    """Through SFLvaultRequestHandler and XMLRPCDispatcher"""
+
+    def setUp(self):
+        self.server = start_test_server()
+
+    def tearDown(self):
+        stop_test_server(self.server)
+
+    def post(self, request):
+        conn = httplib.HTTPConnection(*self.server.server_address)
+        conn.request('POST', '/jsonrpc', json.dumps(request),
+                     {'Content-Type': 'application/json'})
+        return conn.getresponse()
+
+    def result(self, method, *params):
+        response = self.post({'jsonrpc': '2.0', 'method': method,
+                              'params': params, 'id': 1})
+        result = json.loads(response.read())['result']
+        self.assertFalse(result['error'], result['message'])
+        return result
+
+    def test_call(self):
+        response = self.post({'jsonrpc': '2.0', 'method': 'sflvault.login',
+                              'params': ['nobody', '0.8'], 'id': 1})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader('Content-Type'), 'application/json')
+        result = json.loads(response.read())['result']
+        self.assertTrue(result['error'])
+        self.assertTrue(result['message'].startswith('User unknown'))
+
+    def test_wrong_number_of_params(self):
+        response = self.post({'jsonrpc': '2.0', 'method': 'sflvault.login',
+                              'params': ['nobody'], 'id': 1})
+        error = json.loads(response.read())['error']
+        self.assertEqual(error['code'], jsonrpc.INVALID_PARAMS)
+
+    def test_notification(self):
+        response = self.post({'jsonrpc': '2.0', 'method': 'sflvault.login',
+                              'params': ['nobody', '0.8']})
+        self.assertEqual(response.status, 204)
+        self.assertEqual(response.read(), '')
+
+    def test_search(self):
+        """login, authenticate then search, with every string sent as
+        unicode"""
+        suffix = str(random.randint(0, 100000))
+        key = generate_elgamal_keypair()
+        user = User()
+        user.username = u'jsonrpc_user_' + suffix
+        user.created_time = datetime.now()
+        user.is_admin = True
+        user.pubkey = serial_elgamal_pubkey(elgamal_pubkey(key))
+        customer = Customer()
+        customer.name = u'JSON-RPC Customer ' + suffix
+        meta.Session.add_all([user, customer])
+        meta.Session.flush()
+        machine = Machine()
+        machine.customer_id = customer.id
+        machine.name = u'jsonrpc-web-' + suffix
+        meta.Session.add(machine)
+        meta.Session.flush()
+        ids = user.id, customer.id, machine.id
+        # Keeps search_documents up to date, when the index is enabled.
+        refresh_search(customer_ids=[customer.id])
+        transaction.commit()
+        try:
+            login = self.result('sflvault.login', u'jsonrpc_user_' + suffix, '0.8')
+            token = key.decrypt(unserial_elgamal_msg(login['cryptok']))
+            auth = self.result('sflvault.authenticate', u'jsonrpc_user_' + suffix,
+                               b64encode(token.rjust(32, chr(0))))
+            found = self.result('sflvault.search', auth['authtok'],
+                                ['jsonrpc-web-' + suffix], None, False, None)
+            customers = found['results']
+            self.assertEqual(customers.keys(), [str(ids[1])])
+            self.assertEqual(customers[str(ids[1])]['machines'].keys(), [str(ids[2])])
+        finally:
+            query(Machine).filter_by(id=ids[2]).delete()
+            query(Customer).filter_by(id=ids[1]).delete()
+            query(User).filter_by(id=ids[0]).delete()
+            refresh_search(customer_ids=[ids[1]])
+            transaction.commit()
@@ -0,0 +1,143 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import httplib
+import shutil
+import ssl
+import tempfile
+import time
+import xmlrpclib
+from unittest import TestCase
+
+from sflvault_server import ThreadedSecureXMLRPCServer, http_counters
+from tests.server import make_certificate, start_test_server, \
+    stop_test_server
+
+
+class KeepAliveTests(object):
+    """Mixed into a TestCase starting `self.server`."""
+
+    def tearDown(self):
+        stop_test_server(self.server)
+
+    def call(self, conn):
+        body = xmlrpclib.dumps(('nobody', '0.8'), 'sflvault.login')
+        conn.request('POST', '/vault/rpc', body, {'Content-Type': 'text/xml'})
+        response = conn.getresponse()
+        result = xmlrpclib.loads(response.read())[0][0]
+        self.assertTrue(result['error'])
+        return response
+
+    def test_one_request_per_connection(self):
+        self.server.keepalive_timeout = 0
+        conn = self.connect()
+        response = self.call(conn)
+        self.assertEqual(response.version, 10)
+        self.assertTrue(response.will_close)
+
+    def test_persistent(self):
+        self.server.keepalive_timeout = 5
+        before = http_counters.stats()
+        conn = self.connect()
+        response = self.call(conn)
+        self.assertEqual(response.version, 11)
+        self.assertFalse(response.will_close)
+        sock = conn.sock
+        for i in range(3):
+            self.call(conn)
+        self.assertTrue(conn.sock is sock)
+        after = http_counters.stats()
+        self.assertEqual(after['connections'] - before['connections'], 1)
+        self.assertEqual(after['requests'] - before['requests'], 4)
+
+    def test_max_requests(self):
+        self.server.keepalive_timeout = 5
+        self.server.keepalive_max_requests = 2
+        conn = self.connect()
+        self.assertFalse(self.call(conn).will_close)
+        response = self.call(conn)
+        self.assertEqual(response.getheader('Connection'), 'close')
+        self.assertTrue(response.will_close)
+
+    def test_max_idle(self):
+        self.server.keepalive_timeout = 5
+        before = http_counters.stats()
+        idle = self.connect()
+        self.assertFalse(self.call(idle).will_close)
+        time.sleep(0.2)
+        # The other worker serves a new connection, but can't keep it open.
+        conn = self.connect()
+        self.call(conn)
+        time.sleep(0.2)
+        self.assertRaises((httplib.BadStatusLine, httplib.HTTPException, IOError),
+                          self.call, conn)
+        self.call(idle)
+        after = http_counters.stats()
+        self.assertEqual(after['idle_closed'] - before['idle_closed'], 1)
+
+    def test_pipelined(self):
+        self.server.keepalive_timeout = 5
+        conn = self.connect()
+        conn.connect()
+        body = xmlrpclib.dumps(('nobody', '0.8'), 'sflvault.login')
+        request = ('POST /vault/rpc HTTP/1.1\r\nHost: localhost\r\n'
+                   'Content-Type: text/xml\r\nContent-Length: %d\r\n\r\n%s'
+                   % (len(body), body))
+        conn.sock.sendall(request * 2)
+        for i in range(2):
+            response = httplib.HTTPResponse(conn.sock, method='POST')
+            response.begin()
+            self.assertTrue(xmlrpclib.loads(response.read())[0][0]['error'])
+
+    def test_idle_timeout(self):
+        self.server.keepalive_timeout = 0.2
+        conn = self.connect()
+        self.assertFalse(self.call(conn).will_close)
+        time.sleep(0.5)
+        # Closed by the server: the next request fails.
+        self.assertRaises((httplib.BadStatusLine, httplib.HTTPException, IOError),
+                          self.call, conn)
+
+
+class TestKeepAlive(KeepAliveTests, TestCase):
+
+    def setUp(self):
+        self.server = start_test_server()
+
+    def connect(self):
+        return httplib.HTTPConnection(*self.server.server_address)
+
+
+class TestSecureKeepAlive(KeepAliveTests, TestCase):
+
+    def setUp(self):
+        self.certdir = tempfile.mkdtemp()
+        keyfile, certfile = make_certificate(self.certdir)
+        self.server = start_test_server(ThreadedSecureXMLRPCServer,
+                                        {'keyfile': keyfile, 'certfile': certfile})
+
+    def tearDown(self):
+        KeepAliveTests.tearDown(self)
+        shutil.rmtree(self.certdir)
+
+    def connect(self):
+        host, port = self.server.server_address
+        return httplib.HTTPSConnection(host, port,
+                                       context=ssl._create_unverified_context())
@@ -0,0 +1,65 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import time
+from unittest import TestCase
+
+from sflvault.common.crypto import unserial_elgamal_pubkey, \
+    unserial_elgamal_privkey
+
+from sflvault_server.lib.keypair_pool import KeypairPool
+
+
+class TestKeypairPool(TestCase):
+
+    def wait_for_depth(self, pool, depth):
+        for i in range(100):
+            if pool.stats()['depth'] == depth:
+                return
+            time.sleep(0.1)
+        self.fail("Pool depth stuck at %d" % pool.stats()['depth'])
+
+    def check_keypair(self, keypair):
+        pubkey, bothkeys = keypair
+        p, x, g, y = unserial_elgamal_privkey(bothkeys)
+        self.assertEqual(unserial_elgamal_pubkey(pubkey), (p, g, y))
+
+    def test_disabled(self):
+        pool = KeypairPool(0)
+        pool.start()
+        self.check_keypair(pool.take())
+        self.assertEqual(pool.stats(), {'size': 0, 'depth': 0, 'taken': 0,
+                                        'generated_inline': 1})
+
+    def test_refills(self):
+        pool = KeypairPool(2)
+        pool.start()
+        try:
+            self.wait_for_depth(pool, 2)
+            self.check_keypair(pool.take())
+            self.check_keypair(pool.take())
+            self.assertEqual(pool.stats()['taken'], 2)
+            self.wait_for_depth(pool, 2)
+        finally:
+            pool.shutdown()
+        self.assertEqual(pool.stats()['depth'], 0)
+        # Generates inline once stopped.
+        self.check_keypair(pool.take())
+        self.assertEqual(pool.stats()['generated_inline'], 1)
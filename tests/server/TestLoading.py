@@ -0,0 +1,240 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import random
+from datetime import datetime
+from unittest import TestCase
+
+import transaction
+
+from sflvault_server.lib.context import RequestContext
+from sflvault_server.lib.vault import SFLvaultAccess
+from sflvault_server.model import meta, query, User, Group, UserGroup, \
+    Customer, Machine, Service
+from tests.server import ModelFixtures, QueryCounter
+
+
+class TestLoading(ModelFixtures, TestCase):
+    """A customer with 3 machines of 2 services, each with a child
+    service: reading one of them mustn't load the rest of the graph"""
+
+    def setUp(self):
+        suffix = str(random.randint(0, 100000))
+        self.user = self.add(User(), username=u'load_user_' + suffix,
+                             created_time=datetime.now(), is_admin=True)
+        self.customer = self.add(Customer(), name=u'load_' + suffix)
+        self.machines = []
+        self.services = []
+        for i in range(3):
+            machine = self.add(Machine(), customer_id=self.customer,
+                               name=u'load_%s_%d' % (suffix, i))
+            self.machines.append(machine)
+            for j in range(2):
+                service = self.add(Service(), machine_id=machine,
+                                   url='ssh://load_%d_%d' % (i, j))
+                child = self.add(Service(), machine_id=machine,
+                                 parent_service_id=service,
+                                 url='ssh://load_%d_%d_child' % (i, j))
+                self.services.extend([service, child])
+        transaction.commit()
+        # Start from an empty identity map, as a fresh request would.
+        meta.Session.expunge_all()
+
+        context = RequestContext()
+        context.set_user(self.user, u'load_user_' + suffix, True)
+        self.vault = SFLvaultAccess(context)
+
+    def tearDown(self):
+        query(Service).filter(Service.parent_service_id.isnot(None))\
+            .filter(Service.id.in_(self.services))\
+            .delete(synchronize_session=False)
+        query(Service).filter(Service.id.in_(self.services))\
+            .delete(synchronize_session=False)
+        query(Machine).filter(Machine.id.in_(self.machines))\
+            .delete(synchronize_session=False)
+        query(Customer).filter(Customer.id == self.customer)\
+            .delete(synchronize_session=False)
+        query(User).filter(User.id == self.user)\
+            .delete(synchronize_session=False)
+        transaction.commit()
+
+    def test_customer_list(self):
+        with QueryCounter() as counter:
+            ret = self.vault.customer_list()
+        self.assertTrue(self.customer in [c['id'] for c in ret['list']])
+        self.assertEqual(counter.count, 1)
+        self.assertEqual(counter.loaded.keys(), ['Customer'])
+
+    def test_customer_get(self):
+        with QueryCounter() as counter:
+            ret = self.vault.customer_get(self.customer)
+        self.assertEqual(ret['customer']['id'], self.customer)
+        self.assertEqual(counter.count, 1)
+        self.assertEqual(counter.loaded, {'Customer': 1})
+
+    def test_machine_get(self):
+        with QueryCounter() as counter:
+            ret = self.vault.machine_get(self.machines[0])
+        self.assertEqual(ret['machine']['id'], self.machines[0])
+        self.assertEqual(counter.count, 1)
+        self.assertEqual(counter.loaded, {'Machine': 1})
+
+    def test_service_get(self):
+        with QueryCounter() as counter:
+            ret = self.vault.service_get(self.services[0])
+        self.assertEqual(ret['service']['id'], self.services[0])
+        # The service, its ciphers and its groups.
+        self.assertEqual(counter.count, 3)
+        self.assertEqual(counter.loaded, {'Service': 1})
+
+    def test_customer_del(self):
+        with QueryCounter() as counter:
+            ret = self.vault.customer_del(self.customer)
+        self.assertFalse(ret['error'], ret['message'])
+        self.assertFalse(query(Machine).filter(
+            Machine.id.in_(self.machines)).count())
+        self.assertEqual(counter.loaded, {'Customer': 1, 'Machine': 3,
+                                          'Service': 12})
+
+
+class TestUserListLoading(ModelFixtures, TestCase):
+    """3 users in 2 groups each: listing them takes one query, whatever
+    their number"""
+
+    def setUp(self):
+        suffix = str(random.randint(0, 100000))
+        self.users = [self.add(User(), username=u'list_%s_%d' % (suffix, i),
+                               created_time=datetime.now(), is_admin=False)
+                      for i in range(3)]
+        self.groups = [self.add(Group(), name=u'list_%s_%d' % (suffix, i))
+                       for i in range(2)]
+        for user in self.users:
+            for group in self.groups:
+                self.add(UserGroup(), user_id=user, group_id=group,
+                         is_admin=False)
+        transaction.commit()
+        meta.Session.expunge_all()
+
+        context = RequestContext()
+        context.set_user(self.users[0], u'list_%s_0' % suffix, True)
+        self.vault = SFLvaultAccess(context)
+
+    def tearDown(self):
+        query(UserGroup).filter(UserGroup.user_id.in_(self.users))\
+            .delete(synchronize_session=False)
+        query(Group).filter(Group.id.in_(self.groups))\
+            .delete(synchronize_session=False)
+        query(User).filter(User.id.in_(self.users))\
+            .delete(synchronize_session=False)
+        transaction.commit()
+
+    def test_user_list(self):
+        with QueryCounter() as counter:
+            ret = self.vault.user_list()
+        self.assertEqual(counter.count, 1)
+        self.assertEqual(counter.loaded.keys(), ['User'])
+        for user in ret['list']:
+            self.assertFalse('groups' in user)
+
+    def test_user_list_groups(self):
+        with QueryCounter() as counter:
+            ret = self.vault.user_list(groups=True)
+        self.assertEqual(counter.count, 1)
+        users = dict((u['id'], u) for u in ret['list'])
+        for user in self.users:
+            self.assertEqual(sorted(g['id'] for g in users[user]['groups']),
+                             self.groups)
+            self.assertEqual(users[user]['groups'][0]['is_admin'], False)
+
+
+class TestGroupListLoading(ModelFixtures, TestCase):
+    """group_list takes one query, and hides the hidden groups I'm not in"""
+
+    def setUp(self):
+        suffix = str(random.randint(0, 100000))
+        self.me = self.add(User(), username=u'glist_me_' + suffix,
+                           created_time=datetime.now(), is_admin=False)
+        self.other = self.add(User(), username=u'glist_other_' + suffix,
+                              created_time=datetime.now(), is_admin=False)
+        self.admin = self.add(User(), username=u'glist_admin_' + suffix,
+                              created_time=datetime.now(), is_admin=True)
+        self.mine = self.add(Group(), name=u'glist_mine_' + suffix,
+                             hidden=False)
+        self.hidden = self.add(Group(), name=u'glist_hidden_' + suffix,
+                               hidden=True)
+        self.hidden_mine = self.add(Group(), name=u'glist_hmine_' + suffix,
+                                    hidden=True)
+        self.empty = self.add(Group(), name=u'glist_empty_' + suffix,
+                              hidden=False)
+        self.groups = [self.mine, self.hidden, self.hidden_mine, self.empty]
+        self.add(UserGroup(), user_id=self.me, group_id=self.mine,
+                 is_admin=True, cryptgroupkey=u'mine')
+        self.add(UserGroup(), user_id=self.other, group_id=self.mine,
+                 is_admin=False, cryptgroupkey=u'other')
+        self.add(UserGroup(), user_id=self.other, group_id=self.hidden,
+                 is_admin=True, cryptgroupkey=u'other')
+        self.add(UserGroup(), user_id=self.me, group_id=self.hidden_mine,
+                 is_admin=False, cryptgroupkey=u'hmine')
+        transaction.commit()
+        meta.Session.expunge_all()
+
+    def tearDown(self):
+        query(UserGroup).filter(UserGroup.group_id.in_(self.groups))\
+            .delete(synchronize_session=False)
+        query(Group).filter(Group.id.in_(self.groups))\
+            .delete(synchronize_session=False)
+        query(User).filter(User.id.in_([self.me, self.other, self.admin]))\
+            .delete(synchronize_session=False)
+        transaction.commit()
+
+    def group_list(self, user_id, **kwargs):
+        context = RequestContext()
+        context.set_user(user_id, u'')
+        with QueryCounter() as counter:
+            ret = SFLvaultAccess(context).group_list(**kwargs)
+        self.assertEqual(counter.count, 1)
+        return dict((g['id'], g) for g in ret['list'] if g['id'] in self.groups)
+
+    def test_member(self):
+        groups = self.group_list(self.me)
+        self.assertEqual(sorted(groups), sorted([self.mine, self.hidden_mine,
+                                                 self.empty]))
+        mine = groups[self.mine]
+        self.assertEqual((mine['member'], mine['admin'], mine['hidden'],
+                          mine['cryptgroupkey']), (True, True, False, u'mine'))
+        self.assertEqual(sorted(m[0] for m in mine['members']),
+                         [self.me, self.other])
+        hidden_mine = groups[self.hidden_mine]
+        self.assertEqual((hidden_mine['member'], hidden_mine['admin'],
+                          hidden_mine['hidden']), (True, False, True))
+        self.assertEqual(groups[self.empty]['members'], [])
+        self.assertFalse('cryptgroupkey' in groups[self.empty])
+        self.assertFalse(groups[self.empty]['member'])
+
+    def test_show_hidden(self):
+        groups = self.group_list(self.me, show_hidden=True)
+        self.assertEqual(sorted(groups), sorted(self.groups))
+        self.assertFalse(groups[self.hidden]['member'])
+        self.assertEqual(groups[self.hidden]['members'][0][:1], (self.other,))
+
+    def test_global_admin(self):
+        groups = self.group_list(self.admin)
+        self.assertEqual(sorted(groups), sorted(self.groups))
+        self.assertFalse(any(g['member'] for g in groups.values()))
@@ -0,0 +1,135 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import os
+import shutil
+import signal
+import socket
+import SocketServer
+import tempfile
+import time
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+
+from sflvault_server.prefork import PreforkSupervisor
+
+
+class PidHandler(SocketServer.StreamRequestHandler):
+    """Answers with the pid of the worker"""
+
+    def handle(self):
+        self.wfile.write(str(os.getpid()))
+
+
+class WorkerServer(object):
+    """What PreforkSupervisor uses of an SFLvaultServer. Every worker
+    leaves a file named after its pid in `directory` when it starts."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.server = SocketServer.TCPServer(('127.0.0.1', 0), PidHandler)
+        self.engine = create_engine('sqlite://')
+
+    def start_server(self):
+        open(os.path.join(self.directory, str(os.getpid())), 'w').close()
+        self.server.serve_forever(poll_interval=0.1)
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+class TestPreforkSupervisor(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.vault_server = WorkerServer(self.dir)
+        self.supervisor = os.fork()
+        if not self.supervisor:
+            # Never return into the test runner from the supervisor.
+            status = 1
+            try:
+                supervisor = PreforkSupervisor(self.vault_server, 2)
+                supervisor.restart_delay = 0
+                supervisor.run()
+                status = 0
+            finally:
+                os._exit(status)
+
+    def tearDown(self):
+        if self.supervisor:
+            os.kill(self.supervisor, signal.SIGKILL)
+            os.waitpid(self.supervisor, 0)
+        for pid in self.started():
+            if alive(pid):
+                os.kill(pid, signal.SIGKILL)
+        self.vault_server.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def started(self):
+        """Pids of the workers started so far"""
+        return set(int(name) for name in os.listdir(self.dir))
+
+    def wait_for(self, condition, timeout=10):
+        deadline = time.time() + timeout
+        while not condition():
+            self.assertTrue(time.time() < deadline, "timed out")
+            time.sleep(0.05)
+
+    def request(self):
+        sock = socket.create_connection(self.vault_server.server.server_address)
+        try:
+            return int(sock.recv(64))
+        finally:
+            sock.close()
+
+    def test_workers_serve(self):
+        self.wait_for(lambda: len(self.started()) == 2)
+        workers = self.started()
+        self.assertFalse(self.supervisor in workers)
+        for i in range(4):
+            self.assertTrue(self.request() in workers)
+
+    def test_restart_killed_worker(self):
+        self.wait_for(lambda: len(self.started()) == 2)
+        killed = min(self.started())
+        os.kill(killed, signal.SIGKILL)
+        self.wait_for(lambda: len(self.started()) == 3)
+        self.wait_for(lambda: not alive(killed))
+        workers = self.started() - set([killed])
+        self.assertTrue(all(alive(pid) for pid in workers))
+        for i in range(4):
+            self.assertTrue(self.request() in workers)
+
+    def test_sigterm_stops_workers(self):
+        self.wait_for(lambda: len(self.started()) == 2)
+        os.kill(self.supervisor, signal.SIGTERM)
+        pid, status = os.waitpid(self.supervisor, 0)
+        self.supervisor = None
+        self.assertTrue(os.WIFEXITED(status))
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+        # The supervisor waited for them, and didn't restart them.
+        self.assertEqual(len(self.started()), 2)
+        self.assertFalse(any(alive(pid) for pid in self.started()))
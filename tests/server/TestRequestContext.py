@@ -0,0 +1,140 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import random
+import threading
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+import transaction
+
+from sflvault_server import views
+from sflvault_server.lib.context import RequestContext
+from sflvault_server.model import meta, query, User, Customer
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestRequestContext(TestCase):
+    """The caller's identity must never bleed between concurrent requests."""
+
+    callers = 4
+    calls_per_caller = 10
+
+    def setUp(self):
+        self.dispatcher = views.XMLRPCDispatcher()
+        self.suffix = str(random.randint(0, 100000))
+        self.users = {}
+        for i in range(self.callers):
+            u = User()
+            u.username = u'ctx_user%d_%s' % (i, self.suffix)
+            u.created_time = datetime.now()
+            meta.Session.add(u)
+            meta.Session.flush()
+            self.users[u.username] = u.id
+        transaction.commit()
+
+        self.tokens = {}
+        for username, user_id in self.users.items():
+            authtok = views.session_store.create({
+                'username': username,
+                'timeout': datetime.now() + timedelta(0, 300),
+                'remote_addr': '127.0.0.1',
+                'is_admin': False,
+                'user_id': user_id,
+            })
+            self.tokens[username] = authtok
+
+        self.handler = RecordingHandler()
+        self.logger = logging.getLogger('sflvault')
+        self.old_level = self.logger.level
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.logger.setLevel(self.old_level)
+        query(Customer).filter(Customer.name.like(u'%%-%s-%%' % self.suffix))\
+            .delete(synchronize_session=False)
+        query(User).filter(User.id.in_(self.users.values()))\
+            .delete(synchronize_session=False)
+        transaction.commit()
+
+    def _call(self, username, name):
+        authtok = self.tokens[username]
+        request = RequestContext(remote_addr='127.0.0.1', port=0,
+                                 rpc_args=(authtok, name), settings={})
+        try:
+            return self.dispatcher._dispatch(request, 'sflvault.customer_add',
+                                             (authtok, name))
+        finally:
+            transaction.abort()
+            meta.Session.remove()
+
+    def test_interleaved_callers(self):
+        """Interleaved calls from different users are attributed correctly"""
+        start = threading.Event()
+        errors = []
+
+        def caller(username):
+            start.wait()
+            for i in range(self.calls_per_caller):
+                try:
+                    res = self._call(username, u'%s-%s-%d' % (username, self.suffix, i))
+                    if res['error']:
+                        errors.append(res['message'])
+                except Exception, e:
+                    errors.append(str(e))
+
+        threads = [threading.Thread(target=caller, args=(username,))
+                   for username in self.users]
+        for t in threads:
+            t.start()
+        start.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+
+        # The customer's creator is the caller whose name it bears.
+        customers = query(Customer).filter(
+            Customer.name.like(u'%%-%s-%%' % self.suffix)).all()
+        self.assertEqual(len(customers), self.callers * self.calls_per_caller)
+        for cust in customers:
+            self.assertEqual(cust.name.split('-')[0], cust.created_user)
+
+        # And so is the audit log entry of the command.
+        logged = [json.loads(m) for m in self.handler.messages
+                  if m.startswith('{')]
+        logged = [m for m in logged if m['command'] == 'customer_add']
+        self.assertEqual(len(logged), self.callers * self.calls_per_caller)
+        for entry in logged:
+            name = entry['arguments']['customer_name']
+            username = name.split('-')[0]
+            self.assertEqual(entry['username'], username)
+            self.assertEqual(entry['user_id'], self.users[username])
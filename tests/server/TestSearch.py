@@ -0,0 +1,304 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import random
+import shutil
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+import sqlalchemy
+import transaction
+from sqlalchemy import create_engine
+
+from sflvault_server import model
+from sflvault_server.lib.context import RequestContext
+from sflvault_server.lib.vault import SFLvaultAccess
+from sflvault_server.model import meta, query, User, Customer, Machine, \
+    Service
+from tests.server import ModelFixtures
+
+
+class SearchTests(ModelFixtures):
+    """Searches, through the full-text index if `search_index`"""
+
+    search_index = False
+
+    def setUp(self):
+        self.old_search_index = model.search_index_enabled
+        model.search_index_enabled = self.search_index
+        model.create_missing_search_index(meta.engine)
+        model.rebuild_search()
+        transaction.commit()
+
+        suffix = str(random.randint(0, 100000))
+        self.user = self.add(User(), username=u'search_user_' + suffix,
+                             created_time=datetime.now(), is_admin=True)
+        context = RequestContext()
+        context.set_user(self.user, u'search_user_' + suffix, True)
+        self.vault = SFLvaultAccess(context)
+
+        self.customer = self.vault.customer_add(u'Acme Corp')['customer_id']
+        self.empty = self.vault.customer_add(u'Empty Inc')['customer_id']
+        self.web = self.vault.machine_add(
+            self.customer, u'alpha-web', u'web.acme.example.com',
+            u'10.1.2.3', u'Montreal', u'')['machine_id']
+        self.db = self.vault.machine_add(
+            self.customer, u'bravo-db', u'db.acme.example.com',
+            u'10.1.2.4', u'Quebec', u'Nightly backups')['machine_id']
+        self.ssh = self.add_service(self.web, 'ssh://root@web.acme.example.com')
+        self.http = self.add_service(self.web, 'https://admin@web.acme.example.com',
+                                     notes=u'Control panel')
+        self.pgsql = self.add_service(self.db, 'pgsql://postgres@db')
+
+    def tearDown(self):
+        customers = [self.customer, self.empty]
+        machines = query(Machine).filter(Machine.customer_id.in_(customers))
+        machine_ids = [m.id for m in machines]
+        if machine_ids:
+            query(Service).filter(Service.machine_id.in_(machine_ids))\
+                .delete(synchronize_session=False)
+        machines.delete(synchronize_session=False)
+        query(Customer).filter(Customer.id.in_(customers))\
+            .delete(synchronize_session=False)
+        query(User).filter(User.id == self.user)\
+            .delete(synchronize_session=False)
+        model.search_index_enabled = self.old_search_index
+        model.refresh_search(customer_ids=customers)
+        transaction.commit()
+        model.forget_search()
+
+    def add_service(self, machine_id, url, notes=None):
+        # service_add() needs groups with keys: add it by hand.
+        service_id = self.add(Service(), machine_id=machine_id, url=url,
+                              notes=notes)
+        model.refresh_search(machine_ids=[machine_id])
+        transaction.commit()
+        return service_id
+
+    def search(self, *words, **kwargs):
+        """Return the matching (customer, machine, service) ids"""
+        return self.found(self.search_page(*words, **kwargs))
+
+    def search_page(self, *words, **kwargs):
+        customers = [c for c in [self.customer, self.empty]
+                     if query(Customer).get(c)]
+        ret = self.vault.search(list(words), {'customers': customers},
+                                **kwargs)
+        self.assertFalse(ret['error'], ret['message'])
+        return ret
+
+    def found(self, ret):
+        found = set()
+        for cid, customer in ret['results'].items():
+            for mid, machine in customer['machines'].items():
+                for sid in machine['services']:
+                    found.add((int(cid),
+                               int(mid) if mid != 'None' else None,
+                               int(sid) if sid != 'None' else None))
+        return found
+
+    def rows(self, machine_id, *service_ids):
+        customer_id = query(Machine).get(machine_id).customer_id
+        return set((customer_id, machine_id, s) for s in service_ids)
+
+    def test_words(self):
+        self.assertEqual(self.search('alpha'),
+                         self.rows(self.web, self.ssh, self.http))
+        self.assertEqual(self.search('acme'),
+                         self.rows(self.web, self.ssh, self.http) |
+                         self.rows(self.db, self.pgsql))
+        self.assertEqual(self.search('ACME', 'https'),
+                         self.rows(self.web, self.http))
+        self.assertEqual(self.search('quebec', 'backups', 'pgsql'),
+                         self.rows(self.db, self.pgsql))
+        self.assertEqual(self.search('acme', 'nothing'), set())
+
+    def test_prefixes(self):
+        self.assertEqual(self.search('contr'), self.rows(self.web, self.http))
+        self.assertEqual(self.search('10.1.2'),
+                         self.rows(self.web, self.ssh, self.http) |
+                         self.rows(self.db, self.pgsql))
+        self.assertEqual(self.search('10.1.2.4'), self.rows(self.db, self.pgsql))
+        self.assertEqual(self.search('web.acme'),
+                         self.rows(self.web, self.ssh, self.http))
+
+    def test_fragments(self):
+        self.assertEqual(self.search('eb.acm'),
+                         self.rows(self.web, self.ssh, self.http))
+        self.assertEqual(self.search('0.1.2.4'), self.rows(self.db, self.pgsql))
+        self.assertEqual(self.search('RES@D'), self.rows(self.db, self.pgsql))
+        self.assertEqual(self.search('acme.ex', 'oot@'),
+                         self.rows(self.web, self.ssh))
+
+    def test_pages(self):
+        first = self.search_page('acme', limit=2)
+        self.assertEqual(self.found(first),
+                         self.rows(self.web, self.ssh, self.http))
+        self.assertEqual(first['total_estimate'], 3)
+        second = self.search_page('acme', limit=2, cursor=first['cursor'])
+        self.assertEqual(self.found(second), self.rows(self.db, self.pgsql))
+        self.assertEqual(second['cursor'], '')
+        self.assertFalse('total_estimate' in second)
+
+    def test_single_page(self):
+        ret = self.search_page('acme', limit=3)
+        self.assertEqual(ret['cursor'], '')
+        self.assertEqual(ret['total_estimate'], 3)
+
+    def test_max_results(self):
+        old_max, model.search_max_results = model.search_max_results, 1
+        try:
+            first = self.search_page('acme', limit=100)
+            self.assertEqual(self.found(first), self.rows(self.web, self.http))
+            second = self.search_page('acme', cursor=first['cursor'])
+            self.assertEqual(self.found(second), self.rows(self.web, self.ssh))
+        finally:
+            model.search_max_results = old_max
+
+    def test_bad_limit(self):
+        old_max, model.search_max_results = model.search_max_results, 0
+        try:
+            for limit in [-5, 'many']:
+                ret = self.vault.search(['acme'], limit=limit)
+                self.assertTrue(ret['error'])
+                self.assertTrue(ret['message'].startswith('Invalid search limit'))
+        finally:
+            model.search_max_results = old_max
+
+    def test_bad_cursor(self):
+        for cursor in ['garbage', 'WzFd']:
+            ret = self.vault.search(['acme'], cursor=cursor)
+            self.assertTrue(ret['error'])
+
+    def test_cache(self):
+        old_size, model.search_cache.maxsize = model.search_cache.maxsize, 10
+        try:
+            before = model.search_cache_stats()
+            self.assertEqual(self.search('Bravo', 'acme'),
+                             self.rows(self.db, self.pgsql))
+            self.assertEqual(self.search('acme', 'bravo'),
+                             self.rows(self.db, self.pgsql))
+            stats = model.search_cache_stats()
+            self.assertEqual(stats['hits'], before['hits'] + 1)
+            self.assertEqual(stats['size'], 1)
+            self.assertTrue(stats['bytes'] > 0)
+            self.assertTrue(0 < stats['hit_ratio'] <= 1)
+
+            self.vault.machine_put(self.db, {'name': u'charlie-db'})
+            self.assertEqual(len(model.search_cache), 0)
+            self.assertEqual(self.search('acme', 'bravo'), set())
+        finally:
+            model.search_cache.maxsize = old_size
+            model.forget_search()
+
+    def test_ids(self):
+        # The id may also be part of other fields.
+        self.assertTrue(self.rows(self.db, self.pgsql) <=
+                        self.search(str(self.pgsql)))
+
+    def test_empty_customer(self):
+        self.assertEqual(self.search('empty'), set([(self.empty, None, None)]))
+
+    def test_put(self):
+        self.vault.customer_put(self.empty, {'name': u'Vacant Inc'})
+        self.vault.machine_put(self.db, {'name': u'charlie-db',
+                                         'customer_id': self.empty})
+        self.vault.service_put(self.ssh, {'url': 'ssh://deploy@web'})
+        self.assertEqual(self.search('bravo'), set())
+        self.assertEqual(self.search('vacant', 'charlie'),
+                         self.rows(self.db, self.pgsql))
+        self.assertEqual(self.search('empty'), set())
+        self.assertEqual(self.search('deploy'), self.rows(self.web, self.ssh))
+        self.assertEqual(self.search('root'), set())
+
+    def test_del(self):
+        self.vault.service_del(self.pgsql)
+        self.assertEqual(self.search('pgsql'), set())
+        self.assertEqual(self.search('bravo'), set([(self.customer, self.db,
+                                                     None)]))
+        self.vault.machine_del(self.db)
+        self.assertEqual(self.search('bravo'), set())
+        self.vault.customer_del(self.empty)
+        self.assertEqual(self.search('empty'), set())
+
+
+class TestSearch(SearchTests, TestCase):
+    pass
+
+
+class TestSearchIndex(SearchTests, TestCase):
+    search_index = True
+
+    def test_documents(self):
+        """The documents maintained along the way are the ones a rebuild
+        gives"""
+        self.vault.machine_put(self.db, {'customer_id': self.empty})
+        self.vault.service_del(self.http)
+        sd = model.search_documents_table
+        columns = [sd.c.customer_id, sd.c.machine_id, sd.c.service_id,
+                   sd.c.body]
+        before = sorted(meta.Session.execute(model.sql.select(columns)))
+        model.rebuild_search()
+        self.assertEqual(
+            sorted(meta.Session.execute(model.sql.select(columns))), before)
+        transaction.commit()
+
+
+class TestCreateMissingSearchIndex(TestCase):
+
+    def setUp(self):
+        self.old_search_index = model.search_index_enabled
+        self.tmpdir = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite:///%s' %
+                                    os.path.join(self.tmpdir, 'vault.db'))
+        model.search_index_enabled = False
+        model.search_documents_table.create(self.engine)
+
+    def tearDown(self):
+        model.search_index_enabled = self.old_search_index
+        self.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def tables(self):
+        return set(sqlalchemy.inspect(self.engine).get_table_names())
+
+    def test_not_created_while_disabled(self):
+        self.assertFalse('search_fts' in self.tables())
+        self.assertEqual(model.create_missing_search_index(self.engine), [])
+
+    def test_created_once_enabled(self):
+        if not model.sqlite_fts5:
+            self.skipTest("SQLite without FTS5")
+        sd = model.search_documents_table
+        self.engine.execute(sd.insert(), [
+            {'customer_id': 1, 'body': u'Acme alpha-web', 'fragments': u'10.1.2.3'}])
+        model.search_index_enabled = True
+        created = model.create_missing_search_index(self.engine)
+        self.assertTrue('search_fts' in created)
+        self.assertEqual(model.create_missing_search_index(self.engine), [])
+        # Documents already there are indexed, new ones by the triggers.
+        self.engine.execute(sd.insert(), [
+            {'customer_id': 2, 'body': u'Beta alpha-db', 'fragments': u''}])
+        rows = self.engine.execute(
+            "SELECT rowid FROM search_fts WHERE search_fts MATCH 'alpha' "
+            "ORDER BY rowid").fetchall()
+        self.assertEqual([r[0] for r in rows], [1, 2])
@@ -0,0 +1,111 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import random
+from datetime import datetime
+from unittest import TestCase
+
+import transaction
+
+from sflvault_server.lib.context import RequestContext
+from sflvault_server.lib.vault import SFLvaultAccess
+from sflvault_server.model import meta, query, refresh_access, \
+    User, Group, Service, UserGroup, ServiceGroup
+from tests.server import ModelFixtures
+
+
+class TestServiceGetTree(ModelFixtures, TestCase):
+    """bastion <- jump <- host <- db, the user's group only has jump and db"""
+
+    def setUp(self):
+        suffix = str(random.randint(0, 100000))
+        self.user = self.add(User(), username=u'tree_user_' + suffix,
+                             created_time=datetime.now(), is_admin=False)
+        self.group = self.add(Group(), name=u'tree_group_' + suffix)
+        self.other_group = self.add(Group(), name=u'tree_other_' + suffix)
+        self.add(UserGroup(), user_id=self.user, group_id=self.group,
+                 cryptgroupkey='cgk')
+
+        self.services = []
+        parent = None
+        for name in ['bastion', 'jump', 'host', 'db']:
+            parent = self.add(Service(), url='ssh://%s-%s' % (name, suffix),
+                              parent_service_id=parent)
+            self.services.append(parent)
+        for i, service in enumerate(self.services):
+            self.add(ServiceGroup(), service_id=service,
+                     group_id=self.other_group, cryptsymkey='other')
+            if i % 2:
+                self.add(ServiceGroup(), service_id=service,
+                         group_id=self.group, cryptsymkey='csk%d' % i)
+        refresh_access(service_ids=self.services)
+        transaction.commit()
+
+        context = RequestContext()
+        context.set_user(self.user, u'tree_user_' + suffix)
+        self.vault = SFLvaultAccess(context)
+
+    def tearDown(self):
+        groups = [self.group, self.other_group]
+        query(ServiceGroup).filter(ServiceGroup.service_id.in_(self.services))\
+            .delete(synchronize_session=False)
+        query(UserGroup).filter(UserGroup.group_id.in_(groups))\
+            .delete(synchronize_session=False)
+        query(Service).filter(Service.id.in_(self.services))\
+            .delete(synchronize_session=False)
+        query(Group).filter(Group.id.in_(groups))\
+            .delete(synchronize_session=False)
+        query(User).filter(User.id == self.user)\
+            .delete(synchronize_session=False)
+        refresh_access(service_ids=self.services)
+        transaction.commit()
+
+    def test_chain(self):
+        ret = self.vault.service_get_tree(self.services[-1])
+        self.assertFalse(ret['error'], ret['message'])
+        out = ret['services']
+        # Top-most parent first
+        self.assertEqual([s['id'] for s in out], self.services)
+        self.assertEqual([s['cryptsymkey'] for s in out],
+                         ['', 'csk1', '', 'csk3'])
+        self.assertEqual([s['group_id'] for s in out],
+                         ['', self.group, '', self.group])
+        for s in out:
+            self.assertEqual(sorted(g[0] for g in s['groups_list']),
+                             sorted([self.group, self.other_group])
+                             if s['cryptsymkey'] else [self.other_group])
+
+    def test_middle_of_chain(self):
+        ret = self.vault.service_get_tree(self.services[1])
+        self.assertEqual([s['id'] for s in ret['services']],
+                         self.services[:2])
+
+    def test_circular(self):
+        query(Service).get(self.services[0]).parent_service_id = \
+            self.services[2]
+        transaction.commit()
+        ret = self.vault.service_get_tree(self.services[-1])
+        self.assertTrue(ret['error'])
+        self.assertTrue('Circular' in ret['message'])
+
+    def test_unknown(self):
+        ret = self.vault.service_get_tree(self.services[-1] + 1000)
+        self.assertTrue(ret['error'])
+        self.assertTrue('not found' in ret['message'])
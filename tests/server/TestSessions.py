@@ -0,0 +1,278 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import base64
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+
+from sflvault_server.lib.sessions import MemorySessionStore, SQLiteSessionStore, \
+    SignedTokenSessionStore
+
+
+def new_session(user_id=1, seconds=60):
+    return {'username': u'user%d' % user_id,
+            'timeout': datetime.now() + timedelta(0, seconds),
+            'remote_addr': '127.0.0.1',
+            'is_admin': False,
+            'user_id': user_id}
+
+
+class SessionStoreTests(object):
+    """Behaviour expected from every session backend"""
+
+    def test_set_and_get(self):
+        sess = new_session()
+        self.store.set('tok', sess)
+        self.assertEqual(self.store.get('tok'), sess)
+
+    def test_get_unknown(self):
+        self.assertEqual(self.store.get('nope'), None)
+
+    def test_delete(self):
+        self.store.set('tok', new_session())
+        self.store.delete('tok')
+        self.assertEqual(self.store.get('tok'), None)
+        # Deleting twice is harmless
+        self.store.delete('tok')
+
+    def test_pop(self):
+        sess = new_session()
+        self.store.set('tok', sess)
+        self.assertEqual(self.store.pop('tok'), sess)
+        self.assertEqual(self.store.pop('tok'), None)
+        self.assertEqual(self.store.get('tok'), None)
+
+    def test_returned_session_is_a_copy(self):
+        self.store.set('tok', new_session())
+        self.store.get('tok')['user_id'] = 42
+        self.assertEqual(self.store.get('tok')['user_id'], 1)
+
+    def test_create(self):
+        sess = new_session()
+        tok = self.store.create(sess)
+        self.assertEqual(self.store.get(tok), sess)
+        self.assertNotEqual(self.store.create(sess), tok)
+
+    def test_revoke_user(self):
+        self.store.set('a', new_session(1))
+        self.store.set('b', new_session(1))
+        self.store.set('other', new_session(2))
+        self.store.revoke_user(1)
+        self.assertEqual(self.store.get('a'), None)
+        self.assertEqual(self.store.get('b'), None)
+        self.assertNotEqual(self.store.get('other'), None)
+
+    def test_sweep(self):
+        """Sweeping removes expired sessions only, and counts them"""
+        self.store.set('old1', new_session(1, -10))
+        self.store.set('old2', new_session(2, -5))
+        self.store.set('new', new_session(3, 60))
+        self.assertEqual(self.store.sweep(), 2)
+        self.assertEqual(self.store.get('old1'), None)
+        self.assertEqual(self.store.get('old2'), None)
+        self.assertNotEqual(self.store.get('new'), None)
+        self.assertEqual(self.store.stats(),
+                         {'live': 1, 'expired': 2, 'evicted': 0})
+
+    def test_sweep_replaced_session(self):
+        """A session whose timeout was pushed back survives the sweep"""
+        self.store.set('tok', new_session(1, -10))
+        self.store.set('tok', new_session(1, 60))
+        self.assertEqual(self.store.sweep(), 0)
+        self.assertNotEqual(self.store.get('tok'), None)
+
+    def test_max_sessions_per_user(self):
+        self.store.max_sessions_per_user = 2
+        for tok in ['a', 'b', 'c']:
+            self.store.set(tok, new_session(1))
+        self.store.set('other', new_session(2))
+        self.assertEqual(self.store.get('a'), None)
+        self.assertNotEqual(self.store.get('b'), None)
+        self.assertNotEqual(self.store.get('c'), None)
+        self.assertNotEqual(self.store.get('other'), None)
+        self.assertEqual(self.store.stats()['evicted'], 1)
+
+    def test_max_sessions(self):
+        self.store.max_sessions = 2
+        for i, tok in enumerate(['a', 'b', 'c']):
+            self.store.set(tok, new_session(i))
+        self.assertEqual(self.store.get('a'), None)
+        self.assertEqual(self.store.stats(),
+                         {'live': 2, 'expired': 0, 'evicted': 1})
+
+
+class TestMemorySessionStore(SessionStoreTests, TestCase):
+
+    def setUp(self):
+        self.store = MemorySessionStore()
+
+    def test_evicts_least_recently_used(self):
+        self.store.max_sessions = 2
+        self.store.set('a', new_session(1))
+        self.store.set('b', new_session(2))
+        self.store.get('a')
+        self.store.set('c', new_session(3))
+        self.assertNotEqual(self.store.get('a'), None)
+        self.assertEqual(self.store.get('b'), None)
+
+    def test_expiry_heap_bounded(self):
+        """Refreshing the same sessions doesn't grow the expiry heap forever"""
+        for i in range(1000):
+            self.store.set('tok%d' % (i % 5), new_session(i))
+        self.assertTrue(len(self.store.expiry) <= 2 * 5 + 16)
+        self.assertEqual(self.store.count(), 5)
+
+
+class TestSQLiteSessionStore(SessionStoreTests, TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'sessions.db')
+        self.store = SQLiteSessionStore(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_shared_between_stores(self):
+        """Workers opening the same file see each other's sessions"""
+        other = SQLiteSessionStore(self.path)
+        sess = new_session()
+        self.store.set('tok', sess)
+        self.assertEqual(other.get('tok'), sess)
+        other.delete('tok')
+        self.assertEqual(self.store.get('tok'), None)
+
+    def test_separate_tables(self):
+        challenges = SQLiteSessionStore(self.path, table='challenges')
+        challenges.set('tok', new_session(2))
+        self.assertEqual(self.store.get('tok'), None)
+        self.assertEqual(challenges.count(), 1)
+        self.assertEqual(self.store.count(), 0)
+
+
+class SignedTokenSessionStoreTests(object):
+
+    def test_create_and_get(self):
+        sess = new_session()
+        tok = self.store.create(sess)
+        got = self.store.get(tok)
+        self.assertEqual(got['user_id'], 1)
+        self.assertEqual(got['username'], u'user1')
+        self.assertEqual(got['is_admin'], False)
+        self.assertEqual(got['remote_addr'], '127.0.0.1')
+        self.assertTrue(abs(got['timeout'] - sess['timeout']) < timedelta(0, 1))
+
+    def test_other_secret(self):
+        tok = SignedTokenSessionStore('other', 60).create(new_session())
+        self.assertEqual(self.store.get(tok), None)
+
+    def test_tampered_token(self):
+        tok = self.store.create(new_session())
+        payload, signature = tok.split('.')
+        forged = base64.urlsafe_b64decode(payload).replace('false', 'true ')
+        tok = '%s.%s' % (base64.urlsafe_b64encode(forged), signature)
+        self.assertEqual(self.store.get(tok), None)
+
+    def test_malformed_token(self):
+        for tok in ['', 'garbage', 'a.b.c', '!!!.???', u'\xe9t\xe9.x']:
+            self.assertEqual(self.store.get(tok), None)
+
+    def test_delete(self):
+        tok = self.store.create(new_session())
+        other = self.store.create(new_session())
+        self.store.delete(tok)
+        self.assertEqual(self.store.get(tok), None)
+        self.assertNotEqual(self.store.get(other), None)
+
+    def test_revoke_user(self):
+        old = self.store.create(new_session(1))
+        other = self.store.create(new_session(2))
+        self.store.revoke_user(1)
+        self.assertEqual(self.store.get(old), None)
+        self.assertNotEqual(self.store.get(other), None)
+        # Logging in again after the revocation works
+        time.sleep(0.01)
+        new = self.store.create(new_session(1))
+        self.assertNotEqual(self.store.get(new), None)
+
+    def test_sweep_revocations(self):
+        self.store.delete(self.store.create(new_session(1)))
+        self.store.revoke_user(2)
+        self.store.sweep(datetime.now() + timedelta(0, 30))
+        self.assertEqual(self.store.count(), 2)
+        self.store.sweep(datetime.now() + timedelta(0, 90))
+        self.assertEqual(self.store.count(), 0)
+
+    def test_expire(self):
+        tok = self.store.create(new_session(1, seconds=-1))
+        self.store.expire(tok)
+        self.assertEqual(self.store.count(), 0)
+        self.assertEqual(self.store.stats()['expired'], 1)
+
+
+class TestSignedTokenSessionStore(SignedTokenSessionStoreTests, TestCase):
+
+    def setUp(self):
+        self.store = SignedTokenSessionStore('secret', 60)
+
+
+class TestSharedSignedTokenSessionStore(SignedTokenSessionStoreTests, TestCase):
+    """Revocations in a database"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite:///%s/vault.db' % self.dir)
+        self.store = SignedTokenSessionStore('secret', 60, self.engine)
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.dir)
+
+    def test_shared_revocations(self):
+        # Another worker, or node.
+        other = SignedTokenSessionStore('secret', 60, self.engine)
+        tok = self.store.create(new_session(1))
+        kept = self.store.create(new_session(3))
+        user = self.store.create(new_session(2))
+        self.store.delete(tok)
+        self.store.delete(tok)
+        other.revoke_user(2)
+        self.assertEqual(other.get(tok), None)
+        self.assertEqual(self.store.get(user), None)
+        self.assertNotEqual(other.get(kept), None)
+
+    def test_own_pool(self):
+        """Threads checking tokens don't keep connections, and don't take
+        them from the vault's pool"""
+        tok = self.store.create(new_session(1))
+        threads = [threading.Thread(target=self.store.get, args=(tok,))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.store.pool_engine.pool.checkedout(), 0)
+        self.assertFalse(self.store.pool_engine is self.engine)
@@ -0,0 +1,116 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import shutil
+import socket
+import tempfile
+import time
+import xmlrpclib
+from unittest import TestCase
+
+from OpenSSL import SSL
+
+from sflvault_server import ThreadedSecureXMLRPCServer, tls_counters, \
+    session_reused
+from tests.server import make_certificate, start_test_server, \
+    stop_test_server
+
+
+class TestTLS(TestCase):
+
+    def setUp(self):
+        self.certdir = tempfile.mkdtemp()
+        self.keyfile, self.certfile = make_certificate(self.certdir)
+        self.server = None
+
+    def tearDown(self):
+        if self.server:
+            stop_test_server(self.server)
+        shutil.rmtree(self.certdir)
+
+    def start(self, **kw):
+        kw.update(keyfile=self.keyfile, certfile=self.certfile)
+        self.server = start_test_server(ThreadedSecureXMLRPCServer, kw)
+
+    def call(self, session=None, options=0):
+        """Send a request over a new connection, resuming `session`. Return
+        the connection, closed."""
+        ctx = SSL.Context(SSL.SSLv23_METHOD)
+        if options:
+            ctx.set_options(options)
+        conn = SSL.Connection(ctx, socket.create_connection(self.server.server_address))
+        conn.set_connect_state()
+        if session:
+            conn.set_session(session)
+        body = xmlrpclib.dumps(('nobody', '0.8'), 'sflvault.login')
+        conn.sendall('POST /vault HTTP/1.0\r\nContent-Type: text/xml\r\n'
+                     'Content-Length: %d\r\n\r\n%s' % (len(body), body))
+        response = ''
+        try:
+            while True:
+                response += conn.recv(4096)
+        except (SSL.ZeroReturnError, SSL.SysCallError):
+            pass
+        self.assertTrue(response.startswith('HTTP/1.0 200'))
+        # Sessions of connections closed without a shutdown can't be resumed.
+        conn.shutdown()
+        conn.close()
+        return conn
+
+    def handshakes(self, sessions, options=0):
+        """Return the (full, resumed) handshakes of calls resuming `sessions`"""
+        before = tls_counters.stats()
+        for session in sessions:
+            self.call(session, options)
+        after = tls_counters.stats()
+        return (after['full_handshakes'] - before['full_handshakes'],
+                after['resumed_handshakes'] - before['resumed_handshakes'])
+
+    def test_resume_ticket(self):
+        self.start()
+        session = self.call().get_session()
+        self.assertEqual(self.handshakes([session, session]), (0, 2))
+
+    def test_resume_cache(self):
+        self.start(session_tickets=False)
+        session = self.call(options=SSL.OP_NO_TLSv1_3).get_session()
+        self.assertEqual(self.handshakes([session], SSL.OP_NO_TLSv1_3), (0, 1))
+
+    def test_no_resumption(self):
+        self.start(session_timeout=0)
+        session = self.call().get_session()
+        self.assertEqual(self.handshakes([session, session]), (2, 0))
+
+    def test_ticket_key_lifetime(self):
+        self.start(ticket_key_lifetime=1)
+        session = self.call().get_session()
+        self.assertEqual(self.handshakes([session]), (0, 1))
+        time.sleep(1.2)
+        self.assertEqual(self.handshakes([session]), (1, 0))
+
+    def test_ciphers(self):
+        self.start(ciphers='ECDHE+AESGCM', ecdh_curve='secp384r1')
+        conn = self.call(options=SSL.OP_NO_TLSv1_3)
+        self.assertTrue(conn.get_cipher_name().startswith('ECDHE-RSA-AES'))
+        self.assertTrue('GCM' in conn.get_cipher_name())
+
+    def test_session_reused_unknown(self):
+        """Without pyOpenSSL's internals, resumption is unknown, not an error"""
+        self.assertEqual(session_reused(object()), None)
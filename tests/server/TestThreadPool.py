@@ -0,0 +1,139 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2016 Savoir-faire Linux inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+from SimpleXMLRPCServer import SimpleXMLRPCServer
+from unittest import TestCase
+
+from sflvault_server import SFLvaultServer, ThreadPoolMixIn, \
+    ThreadedXMLRPCServer
+
+
+class BlockingPool(ThreadPoolMixIn):
+    """A pool whose requests are served when `release` is set"""
+
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.release = threading.Event()
+        self.served = []
+        self.lock = threading.Lock()
+
+    def finish_request(self, request, client_address):
+        with self.lock:
+            self.served.append(request)
+        self.release.wait()
+
+    def shutdown_request(self, request):
+        pass
+
+    def running(self):
+        with self.lock:
+            return len(self.served)
+
+
+class TestThreadPoolMixIn(TestCase):
+
+    def wait_for(self, condition, timeout=10):
+        deadline = time.time() + timeout
+        while not condition():
+            self.assertTrue(time.time() < deadline, "timed out")
+            time.sleep(0.01)
+
+    def test_workers(self):
+        """As many requests are served at once as there are workers"""
+        pool = BlockingPool(workers=3, queue_size=10)
+        pool.start_workers()
+        for i in range(5):
+            pool.process_request(i, None)
+        self.wait_for(lambda: pool.running() == 3)
+        time.sleep(0.1)
+        self.assertEqual(pool.running(), 3)
+        pool.release.set()
+        pool.drain()
+        self.assertEqual(sorted(pool.served), range(5))
+
+    def test_queue_bound(self):
+        """The accept loop blocks once queue_size requests wait"""
+        pool = BlockingPool(workers=1, queue_size=2)
+        pool.start_workers()
+        pool.process_request(0, None)
+        self.wait_for(lambda: pool.running() == 1)
+        pool.process_request(1, None)
+        pool.process_request(2, None)
+        self.assertTrue(pool.request_queue.full())
+        accept = threading.Thread(target=pool.process_request, args=(3, None))
+        accept.setDaemon(True)
+        accept.start()
+        accept.join(0.1)
+        self.assertTrue(accept.is_alive())
+        pool.release.set()
+        accept.join(10)
+        self.assertFalse(accept.is_alive())
+        pool.drain()
+        self.assertEqual(pool.served, range(4))
+
+
+class TestServerMode(TestCase):
+    """The server SFLvaultServer.initialize_server() builds"""
+
+    def setUp(self):
+        self.settings = SFLvaultServer.settings
+        SFLvaultServer.settings = dict(self.settings)
+        SFLvaultServer.settings.update({
+            'sflvault.host': '127.0.0.1',
+            'sflvault.port': '0',
+            'sflvault.keyfile': None,
+            'sflvault.certfile': None,
+            'sflvault.keepalive_timeout': '5',
+        })
+        self.vault_server = SFLvaultServer.__new__(SFLvaultServer)
+        self.vault_server.server = None
+
+    def tearDown(self):
+        SFLvaultServer.settings = self.settings
+        if self.vault_server.server:
+            self.vault_server.server.server_close()
+
+    def test_single(self):
+        """One request at a time, without keep-alive"""
+        SFLvaultServer.settings['sflvault.server_mode'] = 'single'
+        self.vault_server.initialize_server()
+        server = self.vault_server.server
+        self.assertTrue(server.__class__ is SimpleXMLRPCServer)
+        self.assertFalse(isinstance(server, ThreadPoolMixIn))
+        self.assertEqual(server.keepalive_timeout, 0)
+
+    def test_threaded(self):
+        SFLvaultServer.settings.update({
+            'sflvault.server_mode': 'threaded',
+            'sflvault.workers': '3',
+            'sflvault.queue_size': '7',
+        })
+        self.vault_server.initialize_server()
+        server = self.vault_server.server
+        self.assertTrue(isinstance(server, ThreadedXMLRPCServer))
+        self.assertEqual(server.workers, 3)
+        self.assertEqual(server.queue_size, 7)
+        self.assertEqual(server.keepalive_timeout, 5)
+
+    def test_invalid(self):
+        SFLvaultServer.settings['sflvault.server_mode'] = 'forking'
+        self.assertRaises(ValueError, self.vault_server.initialize_server)
@@ -40,11 +40,20 @@ from unittest import TestCase
 
 import threading
 
+from OpenSSL import crypto
+from sqlalchemy import event
+from sqlalchemy.orm import Mapper
+
 from sflvault.client import SFLvaultClient
-from sflvault_server import SFLvaultServer
+from sflvault_server import SFLvaultServer, SFLvaultRequestHandler, \
+    ThreadedXMLRPCServer
+from sflvault_server import views
+from sflvault_server.model import meta
 import logging
 log = logging.getLogger(__name__)
-__all__ = ['url_for', 'TestController', 'setUp', 'tearDown']
+__all__ = ['url_for', 'TestController', 'ModelFixtures', 'QueryCounter',
+           'make_certificate', 'start_test_server', 'stop_test_server',
+           'setUp', 'tearDown']
 
 here_dir = os.path.dirname(os.path.abspath(__file__))
 conf_dir = os.path.join(here_dir, '..', 'sandbox')
@@ -118,6 +127,112 @@ def delete_all_customers(self):
         self.customer_del(customer['id'])
 
 
+class QueryCounter(object):
+    """Count the SQL statements run, and the ORM instances loaded, in a
+    `with` block:
+
+        with QueryCounter() as counter:
+            vault.customer_list()
+        self.assertEqual(counter.count, 1)
+    """
+
+    def __init__(self):
+        self.statements = []
+        self.loaded = {}
+
+    def __enter__(self):
+        event.listen(meta.engine, 'before_cursor_execute', self._execute)
+        event.listen(Mapper, 'load', self._load)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(meta.engine, 'before_cursor_execute', self._execute)
+        event.remove(Mapper, 'load', self._load)
+
+    @property
+    def count(self):
+        """Number of statements run"""
+        return len(self.statements)
+
+    def _execute(self, conn, cursor, statement, parameters, context,
+                 executemany):
+        self.statements.append(statement)
+
+    def _load(self, target, context):
+        name = target.__class__.__name__
+        self.loaded[name] = self.loaded.get(name, 0) + 1
+
+
+class ModelFixtures(object):
+    """Mixed into the TestCases adding rows to the vault's database"""
+
+    def add(self, obj, **kwargs):
+        """Set the attributes of a new model instance, add it to the
+        session and flush it. Return its id."""
+        for key, value in kwargs.items():
+            setattr(obj, key, value)
+        meta.Session.add(obj)
+        meta.Session.flush()
+        return obj.id
+
+
+def make_certificate(directory):
+    """Write a self-signed host.key and host.cert in `directory`, return
+    their paths."""
+    keyfile = os.path.join(directory, 'host.key')
+    certfile = os.path.join(directory, 'host.cert')
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    cert = crypto.X509()
+    cert.get_subject().CN = 'localhost'
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(3600)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+    with open(keyfile, 'w') as f:
+        f.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+    with open(certfile, 'w') as f:
+        f.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+    return keyfile, certfile
+
+
+def start_test_server(server_class=ThreadedXMLRPCServer, server_args=None,
+                      **attrs):
+    """Serve the vault's calls from a `server_class` on a free port of
+    127.0.0.1, with 2 worker threads, and return it.
+
+    `server_args` are more arguments for its constructor (e.g. keyfile and
+    certfile), `attrs` are set on it before it starts (e.g.
+    compress_threshold). Stop it with stop_test_server().
+    """
+    server = server_class(('127.0.0.1', 0),
+                          requestHandler=SFLvaultRequestHandler,
+                          logRequests=False, allow_none=True,
+                          **(server_args or {}))
+    server.workers = 2
+    for name, value in attrs.items():
+        setattr(server, name, value)
+    dispatcher = views.XMLRPCDispatcher()
+    dispatcher.scan(views)
+    server.register_instance(dispatcher)
+    thread = threading.Thread(target=server.serve_forever,
+                              kwargs={'poll_interval': 0.05})
+    thread.setDaemon(True)
+    thread.start()
+    return server
+
+
+def stop_test_server(server):
+    server.shutdown()
+    server.server_close()
+
+
+# Not tests, despite their names.
+start_test_server.__test__ = stop_test_server.__test__ = False
+
+
 class TestController(TestCase):
 
     def __init__(self, *args, **kwargs):